@@ -86,7 +86,7 @@ class ArlequinWrapper:
     def outputArpFile(self, group):
 
         dataLoci = [l for l in group \
-                    if len(self.matrix.filterOut(l, self.untypedAllele)) > 0]
+                    if len(self.matrix.getTypedRows(l, self.untypedAllele)) > 0]
 
         if len(dataLoci) == 1:
             keys = dataLoci[0]
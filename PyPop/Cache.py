@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+
+# This file is part of PyPop
+
+# Copyright (C) 2003. The Regents of the University of California (Regents)
+# All Rights Reserved.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA
+# 02111-1307, USA.
+
+# IN NO EVENT SHALL REGENTS BE LIABLE TO ANY PARTY FOR DIRECT,
+# INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING
+# LOST PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS
+# DOCUMENTATION, EVEN IF REGENTS HAS BEEN ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+# REGENTS SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE. THE SOFTWARE AND ACCOMPANYING
+# DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS
+# IS". REGENTS HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT,
+# UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""Persistent caches of parsed population data and test results.
+
+   Parsing a large .pop file and running it through the filters can
+   take longer than the analysis itself.  'DataCache' saves the
+   final matrix, along with the population metadata and the filter
+   log, in a compact NumPy '.npz' sidecar file next to the input file.
+   Later runs with the same input file and the same parsing and
+   filtering options read this file instead.
+
+   'ResultCache' keeps the results of the exact Hardy-Weinberg tests
+   for each genotype table, shared between loci, 'alleleLump' levels
+   and input files, in a JSON file.
+"""
+
+import os, json, tempfile, zipfile
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+import Utils
+from Utils import StringMatrix, CodedStringMatrix
+from ParseFile import ParseGenotypeFile
+
+# bump this whenever the layout of the saved data changes
+CACHE_FORMAT_VERSION = 2
+
+class CachedParseGenotypeFile(ParseGenotypeFile):
+    """A ParseGenotypeFile restored from a data cache.
+
+    Provides the same metadata and matrix accessors as
+    ParseGenotypeFile, without having to read the original file.
+    Note that 'getMatrix()' returns the matrix as it was saved, i.e.
+    after filtering."""
+
+    def __init__(self, matrix, popData, popName):
+        self.matrix = matrix
+        self.popData = popData
+        self.popName = popName
+
+class DataCache:
+    """Sidecar cache of the parsed and filtered genotype matrix.
+
+    The cache is keyed on the SHA-1 hash of the contents of the input
+    file, together with every option of the configuration sections
+    that determine the parsed and filtered matrix (e.g. the
+    [ParseGenotypeFile], [Filters] and individual filter sections).
+    If any of these change, the cache is simply regenerated.
+
+    The cache holds the int32 allele codes of each locus as arrays and
+    everything else as a single JSON field, and is read without
+    unpickling, so a stale or foreign file can never run code.
+    """
+
+    def __init__(self,
+                 fileName=None,
+                 cacheFileName=None,
+                 config=None,
+                 sections=[],
+                 version=None,
+                 debug=0):
+        """Constructor for DataCache.
+
+        - 'fileName': input .pop file.
+
+        - 'cacheFileName': location of cache (default: 'fileName' with
+          '.cache' appended).
+
+        - 'config': ConfigParser instance.
+
+        - 'sections': list of configuration sections that affect the
+          parsed and filtered data.
+
+        - 'version': the PyPop version, also part of the key.
+        """
+        self.fileName = fileName
+        self.debug = debug
+
+        if cacheFileName:
+            self.cacheFileName = cacheFileName
+        else:
+            self.cacheFileName = fileName + '.cache'
+
+        self.key = self._genKey(config, sections, version)
+
+    def _genKey(self, config, sections, version):
+        """Generate the key for the input file and configuration.
+
+        *For internal use only.*"""
+        digest = hashlib.sha1()
+
+        f = open(self.fileName, 'rb')
+        while 1:
+            block = f.read(1048576)
+            if block == '':
+                break
+            digest.update(block)
+        f.close()
+
+        # the filename itself appears in the filter log
+        digest.update(self.fileName)
+        digest.update(str(version))
+        digest.update(str(CACHE_FORMAT_VERSION))
+
+        for section in sections:
+            if config.has_section(section):
+                items = config.items(section, raw=1)
+                items.sort()
+                digest.update(repr((section, items)))
+
+        return digest.hexdigest()
+
+    def load(self):
+        """Returns the cached data, or 'None' if there is no valid cache.
+
+        The data is returned as a 3-tuple consisting of a
+        'CachedParseGenotypeFile' instance, whose matrix is the saved
+        (filtered) matrix, the unsequenced site designator and the
+        text of the filter log (or 'None' if no filters were run)."""
+        if not os.path.isfile(self.cacheFileName):
+            return None
+        try:
+            data = np.load(self.cacheFileName, allow_pickle=False)
+            try:
+                state = _loadJSON(data['state'].item())
+                if state.get('key') != self.key:
+                    if self.debug:
+                        print "LOG: data cache %s is out of date" % \
+                              self.cacheFileName
+                    return None
+                arrays = {}
+                for name in data.files:
+                    arrays[name] = data[name]
+            finally:
+                data.close()
+        except (IOError, ValueError, KeyError, IndexError, AttributeError,
+                zipfile.BadZipfile):
+            print "LOG: could not read data cache %s, ignoring it" % \
+                  self.cacheFileName
+            return None
+
+        matrix = _decodeMatrix(state['matrix'], arrays)
+        if state['popData'] is None:
+            popData = None
+        else:
+            popData = Utils.OrderedDict()
+            for field, value in state['popData']:
+                popData[field] = value
+        parsed = CachedParseGenotypeFile(matrix,
+                                         popData,
+                                         state['popName'])
+        print "LOG: using cached data from %s" % self.cacheFileName
+        return parsed, state['unsequencedSite'], state['filterLog']
+
+    def save(self, parsed, matrix, unsequencedSite=None, filterLog=None):
+        """Save the final matrix and associated data to the cache.
+
+        A failure to write the cache is not fatal, the run continues
+        without it."""
+        matrixState, arrays = _encodeMatrix(matrix)
+        popData = parsed.getPopData()
+        if popData is not None:
+            popData = popData.items()
+        state = {'key': self.key,
+                 'matrix': matrixState,
+                 'popData': popData,
+                 'popName': parsed.popName,
+                 'unsequencedSite': unsequencedSite,
+                 'filterLog': filterLog}
+        arrays['state'] = np.array(_dumpJSON(state))
+
+        try:
+            _replaceFile(self.cacheFileName, lambda f: np.savez(f, **arrays))
+        except (IOError, OSError), e:
+            print "LOG: could not write data cache %s: %s" % \
+                  (self.cacheFileName, e)
+            return
+
+        if self.debug:
+            print "LOG: saved data cache to %s" % self.cacheFileName
+
+def _replaceFile(fileName, write):
+    """Replace 'fileName' with the data written by 'write(f)'.
+
+    The data are written to a uniquely named temporary file in the
+    same directory, which is then renamed over 'fileName'.  An
+    interrupted run never leaves a truncated file behind, and runs
+    saving the same file at the same time each replace it with a
+    complete file of their own.  Raises IOError or OSError on
+    failure.
+
+    *For internal use only.*"""
+    fd, tmpFileName = tempfile.mkstemp(prefix=os.path.basename(fileName) + '.',
+                                       suffix='.tmp',
+                                       dir=os.path.dirname(fileName) or os.curdir)
+    try:
+        # mkstemp creates the file private, give it the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpFileName, 0666 & ~umask)
+
+        f = os.fdopen(fd, 'wb')
+        try:
+            write(f)
+        finally:
+            f.close()
+        try:
+            os.rename(tmpFileName, fileName)
+        except OSError:
+            # on Windows, rename doesn't replace an existing file
+            os.remove(fileName)
+            os.rename(tmpFileName, fileName)
+    except:
+        if os.path.exists(tmpFileName):
+            os.remove(tmpFileName)
+        raise
+
+def _dumpJSON(value):
+    """Encode 'value' as JSON, keeping any byte string intact.
+
+    *For internal use only.*"""
+    return json.dumps(value, encoding='latin-1')
+
+def _loadJSON(text):
+    """Decode JSON from '_dumpJSON', with plain strings for strings.
+
+    *For internal use only.*"""
+    return _toStr(json.loads(text, encoding='latin-1'))
+
+def _toStr(value):
+    """Convert the unicode strings of decoded JSON back to str.
+
+    *For internal use only.*"""
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    elif isinstance(value, list):
+        return [_toStr(item) for item in value]
+    elif isinstance(value, dict):
+        return dict([(_toStr(k), _toStr(v)) for k, v in value.items()])
+    else:
+        return value
+
+def _encodeMatrix(matrix):
+    """Convert a matrix into a description and a dictionary of arrays.
+
+    Alleles of the i-th locus are stored as the int32 array of codes
+    'codes<i>' plus a list of allele names in the description,
+    whatever the backend of the matrix.  The description holds only
+    lists, strings and numbers."""
+    if isinstance(matrix, CodedStringMatrix):
+        coded = matrix
+    else:
+        coded = CodedStringMatrix(matrix.rowCount,
+                                  matrix.colList,
+                                  matrix.extraList,
+                                  matrix.colSep,
+                                  matrix.headerLines)
+        for locus in matrix.colList:
+            pairs = matrix[locus]
+            coded.setColumn(locus,
+                            [pair[0] for pair in pairs],
+                            [pair[1] for pair in pairs])
+        coded.extras = matrix.array[:, :matrix.extraCount].copy()
+
+    arrays = {}
+    labels = []
+    for i in range(len(coded.colList)):
+        locus = coded.colList[i]
+        arrays['codes%d' % i] = np.ascontiguousarray(coded.getCodes(locus),
+                                                     dtype=np.int32)
+        labels.append(list(coded.getLabels(locus)))
+
+    state = {'coded': isinstance(matrix, CodedStringMatrix),
+             'rowCount': coded.rowCount,
+             'colList': coded.colList,
+             'extraList': coded.extraList,
+             'colSep': coded.colSep,
+             'headerLines': coded.headerLines,
+             'labels': labels,
+             'extras': coded.extras.tolist()}
+    return state, arrays
+
+def _decodeMatrix(state, arrays):
+    """Rebuild a matrix of the original class from '_encodeMatrix'."""
+    if state['coded']:
+        matrixClass = CodedStringMatrix
+    else:
+        matrixClass = StringMatrix
+    matrix = matrixClass(state['rowCount'],
+                         state['colList'],
+                         state['extraList'],
+                         state['colSep'],
+                         state['headerLines'])
+
+    for i in range(len(state['colList'])):
+        locus = state['colList'][i]
+        codes = arrays['codes%d' % i]
+        labels = state['labels'][i]
+        if state['coded']:
+            matrix._getWritableCodes(locus)[:] = codes
+            matrix.labelLists[locus] = labels
+            matrix.labelMaps[locus] = dict([(labels[i], i) \
+                                            for i in range(len(labels))])
+        else:
+            labelArray = np.empty(len(labels), dtype='O')
+            labelArray[:] = labels
+            matrix.setColumn(locus,
+                             labelArray[codes[:, 0]],
+                             labelArray[codes[:, 1]])
+
+    for i in range(matrix.extraCount):
+        matrix.setColumn(matrix.extraList[i],
+                         [row[i] for row in state['extras']])
+
+    return matrix
+
+class ResultCache:
+    """Persistent cache of the results of the exact Hardy-Weinberg tests.
+
+    Results are stored under a key made from the name of the test,
+    the flattened genotype table and the parameters of the test (see
+    'makeKey'), so that identical tables, e.g. at low-polymorphism
+    loci in many populations, are only tested once.  The cache holds
+    at most 'maxEntries' results, evicting the least recently used
+    ones first, and is kept in a single JSON file that can be shared
+    between runs on different input files.  Results must therefore be
+    plain strings, numbers, lists, tuples (read back as lists),
+    dictionaries with string keys and 'None'.
+
+    Several runs may share the file at the same time.  'save' reads
+    the entries other runs have saved since, merges them with its own
+    and replaces the file with a complete new one, so the file is
+    never left corrupt, and a run's results are only lost if another
+    run saves in the moment between that run reading and replacing
+    the file.
+    """
+
+    def __init__(self,
+                 cacheFileName=None,
+                 maxEntries=10000,
+                 version=None,
+                 debug=0):
+        """Constructor for ResultCache.
+
+        - 'cacheFileName': location of the cache file, read if it
+          already exists.
+
+        - 'maxEntries': maximum number of results kept (default 10000).
+
+        - 'version': the PyPop version, also part of every key.
+        """
+        self.cacheFileName = cacheFileName
+        self.maxEntries = maxEntries
+        self.version = version
+        self.debug = debug
+        self.modified = 0
+        self.hits = 0
+
+        self.entries = self._readEntries()
+
+    def _readEntries(self):
+        """Returns the entries saved in the cache file, least recently
+        used first, or no entries if there is no valid file.
+
+        *For internal use only.*"""
+        entries = OrderedDict()
+        if not os.path.isfile(self.cacheFileName):
+            return entries
+        try:
+            f = open(self.cacheFileName, 'rb')
+            try:
+                state = _loadJSON(f.read())
+            finally:
+                f.close()
+            if state.get('format') == CACHE_FORMAT_VERSION:
+                for key, value in state['entries']:
+                    entries[key] = value
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            print "LOG: could not read result cache %s, ignoring it" % \
+                  self.cacheFileName
+            return OrderedDict()
+        return entries
+
+    def makeKey(self, test, table, parameters=()):
+        """Generate the key for a test of a genotype table.
+
+        - 'test': name of the test (e.g. 'mcmc').
+
+        - 'table': sequence of genotype counts (e.g. the flattened
+          lower-triangular matrix).
+
+        - 'parameters': tuple of everything else that determines the
+          result, such as the sampling parameters and seed mode.
+        """
+        digest = hashlib.sha1()
+        digest.update(repr((str(self.version), test,
+                            tuple([int(count) for count in table]),
+                            tuple(parameters))))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns the result stored under 'key', or 'None'."""
+        if not self.entries.has_key(key):
+            return None
+        # mark as most recently used
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store a result, evicting the least recently used results if
+        the cache is full."""
+        if self.entries.has_key(key):
+            del self.entries[key]
+        self.entries[key] = value
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+        self.modified = 1
+
+    def save(self):
+        """Write the cache back to its file, if anything was added.
+
+        Entries saved to the file by other runs in the meantime are
+        kept, as less recently used than the entries of this run.  A
+        failure to write the cache is not fatal."""
+        if not self.modified:
+            return
+
+        entries = self._readEntries()
+        for key, value in self.entries.items():
+            if entries.has_key(key):
+                del entries[key]
+            entries[key] = value
+        while len(entries) > self.maxEntries:
+            entries.popitem(last=False)
+        self.entries = entries
+
+        try:
+            text = _dumpJSON({'format': CACHE_FORMAT_VERSION,
+                              'entries': self.entries.items()})
+            _replaceFile(self.cacheFileName, lambda f: f.write(text))
+        except (IOError, OSError, TypeError, ValueError), e:
+            print "LOG: could not write result cache %s: %s" % \
+                  (self.cacheFileName, e)
+            return
+
+        self.modified = 0
+        if self.debug:
+            print "LOG: saved %d results (%d reused) to %s" % \
+                  (len(self.entries), self.hits, self.cacheFileName)
@@ -35,7 +35,8 @@
 
 """Module for storing genotype and allele count data."""
 
-import sys, os, string, types, re
+import sys, os, string, types, re, collections
+import numpy as np
 
 from Utils import getStreamType, StringMatrix, OrderedDict, TextOutputStream
 
@@ -106,6 +107,10 @@ def _serializeAlleleCountDataAt(stream, alleleTable,
 class Genotypes:
     """Base class that stores and caches basic genotype statistics.
     """
+
+    # number of lumped (locus, lumpValue) levels to keep cached
+    lumpCacheSize = 16
+
     def __init__(self,
                  matrix=None,
                  untypedAllele='****',
@@ -159,86 +164,95 @@ class Genotypes:
         self.freqcount = {}
         self.locusTable = {}
 
+        # allele names and codes of the genotypes in locusTable,
+        # used to relabel them when lumping
+        self._genotypeCodes = {}
+
+        # most recently used lumped data, see '_getLumpedData'
+        self._lumpCache = collections.OrderedDict()
+
         for locus in self.locusKeys:
             if self.debug:
                print "locus name:", locus
                print "column tuple:", self.matrix[locus]
 
-            # initialise blank dictionary
-            self.alleleTable = {}
-
-            # initialise blank list
-            self.locusTable[locus] = []
-      
-            self.total = 0
-            untypedIndividuals = 0
-            unsequencedSites = 0
+            self._genLocusDataStructures(locus)
 
-            # first pass runs a filter of alleles through the
-            # anthonynolan data filter/cleaner
+            untypedIndividuals = self.freqcount[locus][2]
 
-            # re-initialise the row count on each iteration of the locus
-            rowCount = 0
-
-            subMatrix = self.matrix[locus]
-
-            for line in range(0, len(subMatrix)):
-
-                if self.debug:
-                    print rowCount, subMatrix[line],
+            # if all individuals in a locus aren't untyped
+            # then count this locus as having usable data
+            if untypedIndividuals < self.totalIndivCount:
+                self.totalLociWithData += 1
 
-                allele1, allele2 = [str(i) for i in subMatrix[line]]
+    def _genLocusDataStructures(self, locus):
+        """Generates allele counts and genotype list for one locus.
 
-                if self.debug:
-                    print allele1, allele2
-                
-                # increment row count
-                rowCount += 1
-
-                if self.allowSemiTyped:
-                    self._checkAllele(allele1, allele2, unsequencedSites)
-                    if (self.untypedAllele == allele1):
-                        untypedIndividuals += 0.5
-                    if (self.untypedAllele == allele2):
-                        untypedIndividuals += 0.5
-                else:
-                    # ensure that *both* alleles are typed
-                    if (self.untypedAllele != allele1) and \
-                           (self.untypedAllele != allele2):
-                        # check to see if the "allele" isn't a missing sequence site
-                        if (self.unsequencedSite != allele1) and \
-                           (self.unsequencedSite != allele2):
-                            self._checkAllele(allele1, allele2, unsequencedSites)
-                        else:
-                            if self.unsequencedSite == allele1:
-                                unsequencedSites += 1
-                            if self.unsequencedSite == allele2:
-                                unsequencedSites += 1
-                            if self.debug:
-                                print locus, allele1, allele2, unsequencedSites
-                            continue
-                    # if either allele is untyped it is we throw out the
-                    # entire individual and go to the next individual
-                    else:
-                        untypedIndividuals += 1
-                        continue
-
-                # save alleles as a tuple, sorted alphabetically
-                if allele2 < allele1:
-                  self.locusTable[locus].append((allele2, allele1))
-                else:
-                  self.locusTable[locus].append((allele1, allele2))
+        Rather than visiting each individual in turn, the alleles of
+        the locus are factorized into integer codes once, and all
+        tallies are computed on the codes.  The results are identical
+        to checking each individual with '_checkAllele': alleles are
+        added to the allele table in order of first appearance and
+        genotypes are stored as tuples sorted alphabetically.
 
-                if self.debug:
-                    print allele1, allele2, self.total
+        *For internal use only.*"""
 
-            # assign frequency, counts
-            self.freqcount[locus] = self.alleleTable, self.total, untypedIndividuals, unsequencedSites
+        # alleles as strings, exactly as str() of each cell
+        cells = self.matrix.getColumnView(locus).astype(str)
+        alleles, codes = np.unique(cells.ravel(), return_inverse=True)
+        codes = codes.reshape(cells.shape)
 
-            # if all individuals in a locus aren't untyped
-            # then count this locus as having usable data
-            if untypedIndividuals < self.totalIndivCount:
-                self.totalLociWithData += 1
+        # classify each distinct allele, then each cell
+        untypedCells = (alleles == self.untypedAllele)[codes]
+        if self.unsequencedSite is None:
+            unsequencedCells = np.zeros(codes.shape, dtype=bool)
+        else:
+            unsequencedCells = (alleles == self.unsequencedSite)[codes]
+
+        if self.allowSemiTyped:
+            # every individual is kept, but only typed and sequenced
+            # alleles are counted
+            keptRows = np.ones(len(codes), dtype=bool)
+            countedCodes = codes.ravel()[~(untypedCells | unsequencedCells).ravel()]
+            untypedCount = int(untypedCells.sum())
+            if untypedCount:
+                untypedIndividuals = untypedCount * 0.5
+            else:
+                untypedIndividuals = 0
+            # unsequenced sites are only tallied for genotyped data
+            unsequencedSites = 0
+        else:
+            # ensure that *both* alleles are typed, and neither
+            # is a missing sequence site
+            typedRows = ~(untypedCells[:, 0] | untypedCells[:, 1])
+            unsequencedRows = unsequencedCells[:, 0] | unsequencedCells[:, 1]
+            keptRows = typedRows & ~unsequencedRows
+            countedCodes = codes[keptRows].ravel()
+            untypedIndividuals = int(len(codes) - typedRows.sum())
+            unsequencedSites = int(unsequencedCells[typedRows].sum())
+
+        # count the alleles, adding them to the table in order of
+        # first appearance
+        self.alleleTable = {}
+        if len(countedCodes) > 0:
+            counts = np.bincount(countedCodes, minlength=len(alleles))
+            seenCodes, firstSeen = np.unique(countedCodes, return_index=True)
+            for code in seenCodes[np.argsort(firstSeen)]:
+                self.alleleTable[str(alleles[code])] = int(counts[code])
+        self.total = len(countedCodes)
+
+        # save alleles as a tuple, sorted alphabetically: the codes
+        # are in the same order as the allele names
+        keptCodes = codes[keptRows]
+        lowCodes = keptCodes.min(axis=1)
+        highCodes = keptCodes.max(axis=1)
+        names = [str(allele) for allele in alleles]
+        self.locusTable[locus] = zip([names[code] for code in lowCodes.tolist()],
+                                     [names[code] for code in highCodes.tolist()])
+        self._genotypeCodes[locus] = names, lowCodes, highCodes
+
+        # assign frequency, counts
+        self.freqcount[locus] = self.alleleTable, self.total, untypedIndividuals, unsequencedSites
 
     def getLocusList(self):
         """Returns the list of loci.
@@ -275,22 +289,7 @@ class Genotypes:
 
         # need to recalculate values
         if (lumpValue != 0):
-
-            alleles, totalAlleles, untyped, unsequenced = self.freqcount[locus]
-
-            lumpedAlleles = {}
-            for allele in alleles.keys():
-                count = alleles[allele]
-                if count <= lumpValue:
-                    if lumpedAlleles.has_key('lump'):
-                        lumpedAlleles['lump'] += count
-                    else:
-                        lumpedAlleles['lump'] = count
-                else:
-                    lumpedAlleles[allele] = count
-            lumpedTuple = lumpedAlleles, totalAlleles, untyped, unsequenced
-            ## print lumpedTuple
-            
+            locusData, lumpedTuple = self._getLumpedData(locus, lumpValue)
             return lumpedTuple
         else:
             return self.freqcount[locus]
@@ -352,44 +351,63 @@ class Genotypes:
 
         # need to recalculate values
         if (lumpValue != 0):
-
-            alleles, totalAlleles, untyped, unsequenced = self.freqcount[locus]
-
-            lumpedAlleles = {}
-            listLumped = []
-            for allele in alleles.keys():
-                count = alleles[allele]
-                if count <= lumpValue:
-                    listLumped.append(allele)
-                    if lumpedAlleles.has_key('lump'):
-                        lumpedAlleles['lump'] += count
-                    else:
-                        lumpedAlleles['lump'] = count
-                else:
-                    lumpedAlleles[allele] = count
-            ##print listLumped
-            copyTable = (self.locusTable[locus])[:]
-            newTable = []
-            for li in copyTable:
-                allele1, allele2 = li
-                if allele1 in listLumped:
-                    newAllele1 = 'lump'
-                else:
-                    newAllele1 = allele1
-                if allele2 in listLumped:
-                    newAllele2 = 'lump'
-                else:
-                    newAllele2 = allele2
-                newTable.append((newAllele1, newAllele2))
-                    
-            ##print copyTable
-            ##print newTable
-            
-            return newTable
+            locusData, lumpedTuple = self._getLumpedData(locus, lumpValue)
+            return locusData[:]
         else:
             # returns a clone of the list, so that this instance variable
             # can't be modified inadvertantly
             return (self.locusTable[locus])[:]
+
+    def _getLumpedData(self, locus, lumpValue):
+        """Returns lumped genotypes and allele counts for a locus.
+
+        Returns a 2-tuple of the lumped genotype list and allele count
+        tuple (see 'getLocusDataAt()' and 'getAlleleCountAt()').  The
+        results are cached for each (locus, lumpValue), keeping only
+        the 'lumpCacheSize' most recently used.
+
+        *For internal use only.*"""
+        key = (locus, lumpValue)
+        if self._lumpCache.has_key(key):
+            # re-inserted below as the most recently used
+            lumpData = self._lumpCache.pop(key)
+        else:
+            lumpData = self._genLumpedData(locus, lumpValue)
+            if len(self._lumpCache) >= self.lumpCacheSize:
+                self._lumpCache.popitem(last=False)
+        self._lumpCache[key] = lumpData
+        return lumpData
+
+    def _genLumpedData(self, locus, lumpValue):
+        """Lump all alleles with a count of at most 'lumpValue'.
+
+        *For internal use only.*"""
+
+        alleles, totalAlleles, untyped, unsequenced = self.freqcount[locus]
+
+        lumpedAlleles = {}
+        listLumped = []
+        for allele in alleles.keys():
+            count = alleles[allele]
+            if count <= lumpValue:
+                listLumped.append(allele)
+                if lumpedAlleles.has_key('lump'):
+                    lumpedAlleles['lump'] += count
+                else:
+                    lumpedAlleles['lump'] = count
+            else:
+                lumpedAlleles[allele] = count
+        lumpedTuple = lumpedAlleles, totalAlleles, untyped, unsequenced
+
+        # relabel all genotypes at once, via their allele codes
+        names, lowCodes, highCodes = self._genotypeCodes[locus]
+        position = dict(zip(names, range(len(names))))
+        labels = np.empty(len(names), dtype='O')
+        labels[:] = names
+        labels[[position[allele] for allele in listLumped]] = 'lump'
+        newTable = zip(labels[lowCodes].tolist(), labels[highCodes].tolist())
+
+        return newTable, lumpedTuple
     
     def getLocusData(self):
         """Returns the genotyped data for all loci.
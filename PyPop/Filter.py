@@ -213,9 +213,11 @@ class AnthonyNolanFilter(Filter):
             # initialize first pass
             self.startFirstPass(locus)
 
+            # read-only view of the locus, used for both passes
+            view = self.matrix.getColumnView(locus)
+
             # loop through all lines in locus, adding each allele
-            for individ in self.matrix[locus]:
-                allele1, allele2 = individ
+            for allele1, allele2 in zip(view[:,0], view[:,1]):
                 self.addAllele(allele1)
                 self.addAllele(allele2)
 
@@ -225,24 +227,21 @@ class AnthonyNolanFilter(Filter):
             # now we start doing the actual filtering
             self.startFiltering()
 
-            rowCount = 0
-            for individ in self.matrix[locus]:
-
-                # get current data out of matrix
-                cur_allele1, cur_allele2 = individ
+            alleles1 = []
+            alleles2 = []
+            for cur_allele1, cur_allele2 in zip(view[:,0], view[:,1]):
 
                 # put all alleles through filter and regenerate data
                 # structures
-                allele1 = self.filterAllele(cur_allele1)
-                allele2 = self.filterAllele(cur_allele2)
-
-                self.matrix[rowCount,locus] = (allele1, allele2)
+                alleles1.append(self.filterAllele(cur_allele1))
+                alleles2.append(self.filterAllele(cur_allele2))
 
-                if self.debug:
-                    print rowCount, self.matrix[rowCount,locus]
+            # store the whole filtered locus at once
+            self.matrix.setColumn(locus, alleles1, alleles2)
 
-                # increment row count
-                rowCount += 1
+            if self.debug:
+                for rowCount in range(len(alleles1)):
+                    print rowCount, (alleles1[rowCount], alleles2[rowCount])
 
             # end filtering for this locus
             self.endFiltering()
@@ -912,17 +911,17 @@ class BinningFilter:
     
     def doDigitBinning(self,matrix=None):
 
-        allele = ['','']
         for locus in matrix.colList:
-            individCount = 0
-            for individ in matrix[locus]:
+            binned = [[], []]
+            view = matrix.getColumnView(locus)
+            for individ in zip(view[:,0], view[:,1]):
                 for i in range(2):
-                    allele[i] = individ[i]
-                    if allele[i] != self.untypedAllele and len(allele[i]) > self.binningDigits:
-                        allele[i] = allele[i][:self.binningDigits]
-                        
-                matrix[individCount,locus] = (allele[0],allele[1])
-                individCount += 1
+                    allele = individ[i]
+                    if allele != self.untypedAllele and len(allele) > self.binningDigits:
+                        allele = allele[:self.binningDigits]
+                    binned[i].append(allele)
+
+            matrix.setColumn(locus, binned[0], binned[1])
 
         return matrix
 
@@ -933,13 +932,13 @@ class BinningFilter:
         self.logFile.writeln('<![CDATA[')
 
         # go through each cell of the matrix and make necessary substitutions
-        allele = ['','']
         for locus in matrix.colList:
-            individCount = 0
 
             if locus.lower() in self.customBinningDict.keys():
             
-                for individ in matrix[locus]:
+                binned = [[], []]
+                view = matrix.getColumnView(locus)
+                for individ in zip(view[:,0], view[:,1]):
                     for i in range(2):
 
                         if len(individ[i].split("/")) > 1:
@@ -948,14 +947,13 @@ class BinningFilter:
                             for subname in individ[i].split("/"):
                                 allele_collection += [self.lookupCustomBinning(testAllele=subname, locus=locus)]
 
-                            allele[i] = string.join(list(set(allele_collection)),"/")
+                            binned[i].append(string.join(list(set(allele_collection)),"/"))
 
                         else:
-                            allele[i] = self.lookupCustomBinning(testAllele=individ[i], locus=locus)
+                            binned[i].append(self.lookupCustomBinning(testAllele=individ[i], locus=locus))
 
-                    
-                    matrix[individCount,locus] = (allele[0],allele[1])
-                    individCount += 1
+                # store the whole binned locus at once
+                matrix.setColumn(locus, binned[0], binned[1])
                          
             else:
                self.logFile.writeln("Skipping CustomBinning filter for locus " + locus + " because no rules found.")
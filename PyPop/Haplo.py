@@ -43,7 +43,7 @@ import math
 import itertools as it
 
 from Arlequin import ArlequinBatch
-from Utils import getStreamType, appendTo2dList, GENOTYPE_SEPARATOR, GENOTYPE_TERMINATOR, XMLOutputStream
+from Utils import getStreamType, appendTo2dList, GENOTYPE_SEPARATOR, XMLOutputStream
 from DataTypes import checkIfSequenceData, getLocusPairs
 
 class Haplo:
@@ -364,7 +364,8 @@ class Emhaplofreq(Haplo):
                         haploSuppressFlag=None,
                         showHaplo=None,
                         mode=None,
-                        testing=0):
+                        testing=0,
+                        numProcesses=1):
         
         """Internal method to call _Emhaplofreq shared library.
 
@@ -389,6 +390,10 @@ class Emhaplofreq(Haplo):
         - haploSuppressFlag: sets whether haplotype information is
           generated in the output.   No default.
 
+        - numProcesses: if more than 1, the permutations are split
+          into that many batches, each run in a worker process.
+          Default: 1 (run in this process).
+
         """
 
         # create an in-memory file instance for the C program to write
@@ -419,23 +424,26 @@ class Emhaplofreq(Haplo):
 
             if lociCount <= self._Emhaplofreq.MAX_LOCI:
 
-                # filter-out all individual untyped at any position
-                #subMatrix = appendTo2dList(self.matrix.filterOut(group, self.untypedAllele), ':')
-                subMatrix = appendTo2dList(self.matrix.filterOut(group, self.untypedAllele), GENOTYPE_SEPARATOR)
+                # filter-out all individual untyped at any position,
+                # as integer codes into the allele names of each locus
+                genoCodes, alleleLabels = \
+                           self.matrix.getTypedCodes(group, self.untypedAllele)
+                # emhaplofreq expects each name to end with a separator
+                alleleLabels = appendTo2dList(alleleLabels, GENOTYPE_SEPARATOR)
 
                 # calculate the new number of individuals emhaplofreq is
                 # being run on
-                groupNumIndiv = len(subMatrix)
+                groupNumIndiv = len(genoCodes)
 
                 if self.debug:
                     print "debug: key for matrix:", group
-                    print "debug: subMatrix:", subMatrix
+                    print "debug: allele names:", alleleLabels
                     print "debug: dump matrix in form for command-line input"
-                    for line in range(0, len(subMatrix)):
-                        theline = subMatrix[line]
+                    for line in range(0, len(genoCodes)):
+                        theline = genoCodes[line]
                         print "dummyid",
                         for allele in range(0, len(theline)):
-                            print theline[allele], " ",
+                            print alleleLabels[allele / 2][theline[allele]], " ",
                         print
                     
                 fp.write(os.linesep)
@@ -453,27 +461,10 @@ class Emhaplofreq(Haplo):
                 else:
                     lociAttr = "loci=\"%s\"" % group
 
-                # check maximum length of allele
-                maxAlleleLength = 0
-                for line in range(0, len(subMatrix)):
-                    theline = subMatrix[line]
-                    for allelePos in range(0, len(theline)):
-                        allele = theline[allelePos]
-                        if len(allele) > maxAlleleLength:
-                            maxAlleleLength = len(allele)
-                        if len(allele) > (self._Emhaplofreq.NAME_LEN)-2:
-                            print "WARNING: '%s' (%d) exceeds max allele length (%d) for LD and haplo est in %s" % (allele, len(allele), self._Emhaplofreq.NAME_LEN-2, lociAttr)
-
-                if groupNumIndiv > self._Emhaplofreq.MAX_ROWS:
-                    fp.write("<group %s role=\"too-many-lines\" %s %s/>%s" % (modeAttr, lociAttr, haploAttr, os.linesep))
-                    continue
                 # if nothing left after filtering, simply continue
-                elif groupNumIndiv == 0:
+                if groupNumIndiv == 0:
                     fp.write("<group %s role=\"no-data\" %s %s/>%s" % (modeAttr, lociAttr, haploAttr, os.linesep))
                     continue
-                elif maxAlleleLength > (self._Emhaplofreq.NAME_LEN-2):
-                    fp.write("<group %s role=\"max-allele-length-exceeded\" %s %s>%d</group>%s" % (modeAttr, lociAttr, haploAttr, self._Emhaplofreq.NAME_LEN-2, os.linesep))
-                    continue
                 
                 if mode:
                     fp.write("<group %s %s %s>%s" % (modeAttr, lociAttr, haploAttr, os.linesep))
@@ -496,20 +487,35 @@ class Emhaplofreq(Haplo):
                 fp.write("<individcount role=\"after-filtering\">%d</individcount>" % groupNumIndiv)
                 fp.write(os.linesep)
                 
-                # pass this submatrix to the SWIG-ed C function
-                self._Emhaplofreq.main_proc(fp,
-                                            subMatrix,
-                                            lociCount,
-                                            groupNumIndiv,
-                                            permutationFlag,
-                                            haploSuppressFlag,
-                                            numInitCond,
-                                            numPermutations,
-                                            numPermuInitCond,
-                                            permutationPrintFlag,
-                                            testing,
-                                            GENOTYPE_SEPARATOR,
-                                            GENOTYPE_TERMINATOR)
+                # pass the coded submatrix to the SWIG-ed C function
+                if permutationFlag and numProcesses > 1 \
+                       and numPermutations > 2:
+                    self._runPermutationBatches(fp,
+                                                genoCodes,
+                                                alleleLabels,
+                                                lociCount,
+                                                groupNumIndiv,
+                                                haploSuppressFlag,
+                                                numInitCond,
+                                                numPermutations,
+                                                numPermuInitCond,
+                                                permutationPrintFlag,
+                                                testing,
+                                                numProcesses)
+                else:
+                    self._Emhaplofreq.main_proc_coded(fp,
+                                                      genoCodes,
+                                                      alleleLabels,
+                                                      map(len, alleleLabels),
+                                                      lociCount,
+                                                      groupNumIndiv,
+                                                      permutationFlag,
+                                                      haploSuppressFlag,
+                                                      numInitCond,
+                                                      numPermutations,
+                                                      numPermuInitCond,
+                                                      permutationPrintFlag,
+                                                      testing)
 
                 fp.write("</group>")
 
@@ -532,6 +538,81 @@ class Emhaplofreq(Haplo):
         # flush any buffered output to the stream
         self.stream.flush()
 
+    def _runPermutationBatches(self, fp, genoCodes, alleleLabels,
+                               lociCount, groupNumIndiv, haploSuppressFlag,
+                               numInitCond, numPermutations,
+                               numPermuInitCond, permutationPrintFlag,
+                               testing, numProcesses):
+        """Run the LD permutation test for one group in worker processes.
+
+        The observed data is estimated here, writing the same output
+        to 'fp' as 'main_proc_coded' does.  The remaining
+        'numPermutations' - 1 permutations are split into 'numProcesses' batches, each
+        run from its own seed, and the likelihood ratios of all
+        batches merged into a single permutation summary, written by
+        'permu_summary'.
+
+        *For internal use only.*"""
+
+        status, ok, dfLRtest, likeRatios, errorFlags = \
+                self._Emhaplofreq.main_proc_batch_coded(fp,
+                                                        genoCodes,
+                                                        alleleLabels,
+                                                        map(len, alleleLabels),
+                                                        lociCount,
+                                                        groupNumIndiv,
+                                                        haploSuppressFlag,
+                                                        numInitCond,
+                                                        1,
+                                                        numPermuInitCond,
+                                                        testing,
+                                                        0,
+                                                        0,
+                                                        1, 1)
+        # as in 'main_proc', no summary unless the observed data could
+        # be estimated
+        if not ok:
+            return
+
+        # split the permutations as evenly as possible between batches
+        numBatches = min(numProcesses, numPermutations - 1)
+        batchSize, remainder = divmod(numPermutations - 1, numBatches)
+
+        if testing:
+            baseSeed = 1234567
+        else:
+            import time
+            baseSeed = int(time.time())
+
+        tasks = []
+        for i in range(numBatches):
+            seed = (baseSeed + i + 1) & 0x7fffffff
+            numBatchPermutations = batchSize + (i < remainder)
+            tasks.append((genoCodes, alleleLabels, lociCount, groupNumIndiv,
+                          haploSuppressFlag, numInitCond,
+                          numBatchPermutations, numPermuInitCond,
+                          testing, seed))
+
+        import multiprocessing
+        pool = multiprocessing.Pool(numBatches)
+        try:
+            batches = pool.map(_runEmhaplofreqPermutations, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for batchRatios, batchFlags in batches:
+            likeRatios.extend(batchRatios)
+            errorFlags.extend(batchFlags)
+
+        self._Emhaplofreq.permu_summary(fp,
+                                        len(likeRatios),
+                                        groupNumIndiv,
+                                        dfLRtest,
+                                        permutationPrintFlag,
+                                        likeRatios,
+                                        errorFlags)
+
     def estHaplotypes(self,
                       locusKeys=None,
                       numInitCond=None):
@@ -562,7 +643,8 @@ class Emhaplofreq(Haplo):
                                  permutationPrintFlag=0,
                                  numInitCond=None,
                                  numPermutations=None,
-                                 numPermuInitCond=None):
+                                 numPermuInitCond=None,
+                                 numProcesses=1):
         """Estimate linkage disequilibrium (LD) for listed groups in
         'locusKeys'.
 
@@ -576,6 +658,14 @@ class Emhaplofreq(Haplo):
         e.g. '*DQA1:*DPB1,*DRB1:*DQB1', means to est. LD for
          'DQA1' and 'DPB1' loci followed by est. of LD for
          'DRB1' and 'DQB1' loci.
+
+        If 'numProcesses' is more than 1, the permutations are run in
+        that many worker processes.  Each process permutes the data
+        from its own seed, so, even in test mode, the permutation
+        p-value and LR statistics differ with 'numProcesses' (unlike
+        the 'numProcesses' option of Haplostats, which leaves the
+        output unchanged).  The estimates for the observed data, and
+        the number of permutations, do not.
         """
         self._runEmhaplofreq(locusKeys,
                              permutationFlag=1,
@@ -586,7 +676,8 @@ class Emhaplofreq(Haplo):
                              haploSuppressFlag=1,
                              showHaplo='no',
                              mode='LD',
-                             testing=self.testing)
+                             testing=self.testing,
+                             numProcesses=numProcesses)
 
     def allPairwise(self,
                     permutationPrintFlag=0,
@@ -595,13 +686,16 @@ class Emhaplofreq(Haplo):
                     numPermuInitCond=None,
                     haploSuppressFlag=None,
                     haplosToShow=None,
-                    mode=None):
+                    mode=None,
+                    numProcesses=1):
         """Run pairwise statistics.
 
         Estimate pairwise statistics for a given set of loci.
         Depending on the flags passed, can be used to estimate both LD
         (linkage disequilibrium) and HF (haplotype frequencies), an
-        optional permutation test on LD can be run """
+        optional permutation test on LD can be run, in 'numProcesses'
+        worker processes if more than 1 (see estLinkageDisequilibrium()
+        for how the results depend on 'numProcesses') """
 
         if numPermutations > 0:
             permuMode = 'with-permu'
@@ -639,7 +733,8 @@ class Emhaplofreq(Haplo):
                                  haploSuppressFlag=haploSuppressFlag,
                                  showHaplo=showHaplo,
                                  mode=mode,
-                                 testing=self.testing)
+                                 testing=self.testing,
+                                 numProcesses=numProcesses)
 
             # def allPairwiseLD(self, haplosToShow=None):
             #     """Estimate all pairwise LD and haplotype frequencies.
@@ -662,6 +757,41 @@ class Emhaplofreq(Haplo):
             #                      mode='all-pairwise-ld-with-permu')
 
 
+def _runEmhaplofreqPermutations(args):
+    """Run one batch of permutations of the LD permutation test.
+
+    Returns the likelihood ratios and error flags of the permutations.
+    Called in a worker process, so must be at module level.
+
+    *For internal use only.*"""
+    import _Emhaplofreq
+
+    genoCodes, alleleLabels, lociCount, groupNumIndiv, haploSuppressFlag, \
+               numInitCond, numPermutations, numPermuInitCond, testing, \
+               seed = args
+
+    # the observed data is not fitted again, and what little output
+    # there is for it discarded, only the permutations are kept
+    fp = cStringIO.StringIO()
+    status, ok, dfLRtest, likeRatios, errorFlags = \
+            _Emhaplofreq.main_proc_batch_coded(fp,
+                                               genoCodes,
+                                               alleleLabels,
+                                               map(len, alleleLabels),
+                                               lociCount,
+                                               groupNumIndiv,
+                                               haploSuppressFlag,
+                                               numInitCond,
+                                               numPermutations + 1,
+                                               numPermuInitCond,
+                                               testing,
+                                               seed,
+                                               1,
+                                               numPermutations + 1,
+                                               numPermutations + 1)
+    fp.close()
+    return likeRatios[1:], errorFlags[1:]
+
 def _compute_LD(haplos, freqs, compute_ALD=False, debug=False):
     """Compute LD for pairwise haplotypes from haplotype names and frequencies
 
@@ -836,12 +966,19 @@ class Haplostats(Haplo):
                       weight=None,
                       control=None,
                       numInitCond=10,
-                      testMode=False):
+                      testMode=False,
+                      numProcesses=1):
         """Estimate haplotypes for the submatrix given in locusKeys, if
         locusKeys is None, assume entire matrix
         
         LD is estimated if there are locusKeys consists of only two loci
 
+        If 'numProcesses' is more than 1, the 'numInitCond' initial
+        conditions are run in that many worker processes.  Their seeds
+        are all drawn beforehand, and the fit with the highest
+        likelihood picked once they are done, so the result does not
+        depend on the number of processes.
+
         FIXME: this does *not* yet remove missing data before haplotype estimations
         """
 
@@ -849,12 +986,39 @@ class Haplostats(Haplo):
         if locusKeys == '*' or locusKeys == None:
             locusKeys=string.join(self.matrix.colList,':')
 
+        fitArgs, allele_labels = self._setupFit(locusKeys, weight, control,
+                                                numInitCond, testMode)
+
+        seeds = fitArgs[-2]
+        if numProcesses > 1 and len(seeds) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(numProcesses, len(seeds)))
+            try:
+                fits = pool.map(_fitHaplostatsRestart,
+                                [(fitArgs, seed) for seed in seeds])
+            finally:
+                pool.close()
+                pool.join()
+            fit = _bestFit(fits, self.debug)
+        else:
+            fit = _fitHaplostats(fitArgs)
+
+        return self._serializeFit(locusKeys, numInitCond, allele_labels, fit)
+
+    def _setupFit(self, locusKeys, weight, control, numInitCond, testMode):
+        """Set up the EM fit for the loci in 'locusKeys'.
+
+        Returns a 2-tuple: the arguments for '_fitHaplostats', including
+        the random seeds of all 'numInitCond' initial conditions, and
+        the allele names for each locus.
+
+        *For internal use only.*"""
+
         geno = self.matrix.getNewStringMatrix(locusKeys)
 
         n_loci = geno.colCount
         n_subject = geno.rowCount
 
-        subj_id = range(1, n_subject + 1)
         if n_loci < 2:
             print "Must have at least 2 loci for haplotype estimation!"
             exit(-1)
@@ -866,19 +1030,13 @@ class Haplostats(Haplo):
             print "Length of weight != number of subjects (nrow of geno)"
             exit(-1)
 
-        temp_geno = geno.convertToInts()   # simulates setupGeno
-        geno_vec = temp_geno.flattenCols() # gets the columns as integers
-
-        n_alleles = []
-        allele_labels = []
-
-        for locus in geno.colList:
-            unique_alleles = geno.getUniqueAlleles(locus)
-            allele_labels.append(unique_alleles)
-            n_alleles.append(len(unique_alleles))
+        # simulates setupGeno: gets the columns as integers, along
+        # with the allele names for each locus, in one step
+        geno_vec, allele_labels = geno.factorize()
+        n_alleles = [len(unique_alleles) for unique_alleles in allele_labels]
 
         # Compute the max number of pairs of haplotypes over all subjects
-        max_pairs = temp_geno.countPairs()
+        max_pairs = geno.countPairs()
         max_haps = 2*sum(max_pairs)
 
         # FIXME: do we need this?
@@ -897,24 +1055,7 @@ class Haplostats(Haplo):
             iseed2 = int(10000 + 20000*seed_array[1])
             iseed3 = int(10000 + 20000*seed_array[2])
             random_start = control['random_start']
-
-        converge, lnlike, n_u_hap, n_hap_pairs, hap_prob, u_hap, u_hap_code, subj_id, post, hap1_code, hap2_code = \
-                  self._haplo_em_fitter(n_loci,
-                                        n_subject,
-                                        weight,
-                                        geno_vec,
-                                        n_alleles,
-                                        max_haps,
-                                        control['max_iter'],
-                                        loci_insert_order,
-                                        control['min_posterior'],
-                                        control['tol'],
-                                        control['insert_batch_size'],
-                                        random_start,
-                                        iseed1,
-                                        iseed2,
-                                        iseed3,
-                                        control['verbose'])
+        seeds = [(random_start, iseed1, iseed2, iseed3)]
 
         if numInitCond > 1:
             for i in range(1, numInitCond):
@@ -935,37 +1076,21 @@ class Haplostats(Haplo):
 
                 if self.debug:
                     print "random seeds for initial condition", i, ":", iseed1, iseed2, iseed3
+                seeds.append((random_start, iseed1, iseed2, iseed3))
 
-                converge_new, lnlike_new, n_u_hap_new, n_hap_pairs_new, hap_prob_new, \
-                              u_hap_new, u_hap_code_new, subj_id_new, post_new, hap1_code_new, \
-                              hap2_code_new = \
-                              self._haplo_em_fitter(n_loci,
-                                                    n_subject,
-                                                    weight,
-                                                    geno_vec,
-                                                    n_alleles,
-                                                    max_haps,
-                                                    control['max_iter'],
-                                                    loci_insert_order,
-                                                    control['min_posterior'],
-                                                    control['tol'],
-                                                    control['insert_batch_size'],
-                                                    random_start,
-                                                    iseed1,
-                                                    iseed2,
-                                                    iseed3,
-                                                    control['verbose'])
-
-                if lnlike_new > lnlike:
-                    if self.debug:
-                        print "found a better lnlikelihood!", lnlike_new
-                    # FIXME: need more elegant data structure
-                    converge, lnlike, n_u_hap, n_hap_pairs, hap_prob, \
-                              u_hap, u_hap_code, subj_id, post, hap1_code, \
-                              hap2_code = \
-                              converge_new, lnlike_new, n_u_hap_new, n_hap_pairs_new, hap_prob_new, \
-                              u_hap_new, u_hap_code_new, subj_id_new, post_new, hap1_code_new, \
-                              hap2_code_new 
+        fitArgs = (n_loci, n_subject, weight, geno_vec, n_alleles, max_haps,
+                   control, loci_insert_order, seeds, self.debug)
+        return fitArgs, allele_labels
+
+    def _serializeFit(self, locusKeys, numInitCond, allele_labels, fit):
+        """Serialize the best EM fit for the loci in 'locusKeys' (as
+        returned by '_fitHaplostats') to the XML stream, along with LD
+        for two loci.
+
+        *For internal use only.*"""
+
+        n_loci = len(allele_labels)
+        converge, lnlike, n_u_hap, n_hap_pairs, hap_prob, u_hap, u_hap_code, subj_id, post, hap1_code, hap2_code = fit
 
         # convert u_hap back into original allele names
         haplotype = numpy.array(u_hap, dtype='O').reshape(n_u_hap, -1)
@@ -1056,18 +1181,44 @@ class Haplostats(Haplo):
                     weight=None,
                     control=None,
                     numInitCond=10,
-                    mode=None):
-        """Estimate pairwise statistics for all pairs of loci."""
+                    mode=None,
+                    numProcesses=1):
+        """Estimate pairwise statistics for all pairs of loci.
+
+        If 'numProcesses' is more than 1, the pairs are estimated in
+        that many worker processes (the haplo-stats extension keeps
+        global state, so cannot be run in threads).  The random seeds
+        are drawn, and the results written, in the order of the pairs,
+        so the output does not depend on the number of processes."""
 
         # FIXME: sequence data *not* currently supported for haplostats
         locusPairs = getLocusPairs(self.matrix, False)
         if self.debug: print locusPairs, len(locusPairs)
+
+        fits = []
         for pair in locusPairs:
-            self.estHaplotypes(locusKeys=pair,
-                               weight=weight,
-                               control=control,
-                               numInitCond=numInitCond,
-                               testMode=self.testMode)
+            fits.append(self._setupFit(pair, weight, control,
+                                       numInitCond, self.testMode))
+
+        pool = None
+        if numProcesses > 1 and len(locusPairs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(numProcesses, len(locusPairs)))
+        try:
+            if pool:
+                # imap keeps the order of the pairs, and lets the
+                # output be written as the results come in
+                results = pool.imap(_fitHaplostats,
+                                    [fitArgs for fitArgs, allele_labels in fits])
+            else:
+                results = it.imap(_fitHaplostats,
+                                  [fitArgs for fitArgs, allele_labels in fits])
+            for pair, (fitArgs, allele_labels), fit in it.izip(locusPairs, fits, results):
+                self._serializeFit(pair, numInitCond, allele_labels, fit)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
         
     def _haplo_em_fitter(self,
                          n_loci,
@@ -1087,42 +1238,126 @@ class Haplostats(Haplo):
                          iseed3,
                          verbose):
 
-        _Haplostats = self._Haplostats
-
-        converge = 0
-        min_prior = 0.0
-        n_unique = 0
-        lnlike = 0.0
-        n_u_hap = 0
-        n_hap_pairs = 0
+        return _haplo_em_fitter(n_loci, n_subject, weight, geno_vec,
+                                n_alleles, max_haps, max_iter,
+                                loci_insert_order, min_posterior, tol,
+                                insert_batch_size, random_start,
+                                iseed1, iseed2, iseed3, verbose)
+
+
+def _fitHaplostats(args):
+    """Run the EM for every initial condition of a group of loci.
+
+    'args' is as returned by 'Haplostats._setupFit'.  Returns the
+    results of '_haplo_em_fitter' for the initial condition with the
+    highest likelihood (the first of these, if tied).  Called in
+    worker processes, so must be at module level.
+
+    *For internal use only.*"""
+    seeds, debug = args[-2:]
+    return _bestFit([_fitHaplostatsRestart((args, seed)) for seed in seeds],
+                    debug)
+
+def _fitHaplostatsRestart(args):
+    """Run the EM for a single initial condition of a group of loci.
+
+    'args' is a 2-tuple: the arguments from 'Haplostats._setupFit'
+    and the seed of the initial condition.  Called in worker
+    processes, so must be at module level.
+
+    *For internal use only.*"""
+    fitArgs, seed = args
+    n_loci, n_subject, weight, geno_vec, n_alleles, max_haps, \
+            control, loci_insert_order, seeds, debug = fitArgs
+    random_start, iseed1, iseed2, iseed3 = seed
+
+    return _haplo_em_fitter(n_loci,
+                            n_subject,
+                            weight,
+                            geno_vec,
+                            n_alleles,
+                            max_haps,
+                            control['max_iter'],
+                            loci_insert_order,
+                            control['min_posterior'],
+                            control['tol'],
+                            control['insert_batch_size'],
+                            random_start,
+                            iseed1,
+                            iseed2,
+                            iseed3,
+                            control['verbose'])
+
+def _bestFit(fits, debug=0):
+    """Returns the fit with the highest likelihood from a list of
+    results of '_haplo_em_fitter', in order of initial condition (the
+    first of these, if tied).
+
+    *For internal use only.*"""
+    best = fits[0]
+    for fit in fits[1:]:
+        if fit[1] > best[1]:
+            if debug:
+                print "found a better lnlikelihood!", fit[1]
+            best = fit
+    return best
+
+def _haplo_em_fitter(n_loci,
+                     n_subject,
+                     weight,
+                     geno_vec,
+                     n_alleles,
+                     max_haps,
+                     max_iter,
+                     loci_insert_order,
+                     min_posterior,
+                     tol,
+                     insert_batch_size,
+                     random_start,
+                     iseed1,
+                     iseed2,
+                     iseed3,
+                     verbose):
+    """Run a single EM fit with the haplo-stats extension.
+
+    *For internal use only.*"""
+
+    import _Haplostats
+
+    converge = 0
+    min_prior = 0.0
+    n_unique = 0
+    lnlike = 0.0
+    n_u_hap = 0
+    n_hap_pairs = 0
+
+    tmp1 = _Haplostats.haplo_em_pin_wrap(n_loci, n_subject, weight, n_alleles,
+                                         max_haps, max_iter, loci_insert_order,
+                                         min_prior, min_posterior, tol, insert_batch_size,
+                                         random_start, iseed1, iseed2, iseed3, verbose, geno_vec)
+
+    # values returned from haplo_em_pin
+    status1, converge, lnlike, n_u_hap, n_hap_pairs = tmp1
+
+    tmp2 = _Haplostats.haplo_em_ret_info_wrap(\
+        # input parameters
+        n_u_hap, n_loci, n_hap_pairs,
+        # output parameters: declaring array sizes for ret_val
+        n_u_hap,          # hap_prob
+        n_u_hap * n_loci, # u_hap
+        n_u_hap,          # u_hap_code
+        n_hap_pairs,        # subj_id
+        n_hap_pairs,        # post
+        n_hap_pairs,        # hap1_code
+        n_hap_pairs,        # hap2_code
+        )
+
+    # values returned from haplo_em_ret_info
+    status2, hap_prob, u_hap, u_hap_code, subj_id, post, hap1_code, hap2_code = tmp2
+
+    _Haplostats.haplo_free_memory()
+
+    return converge, lnlike, n_u_hap, n_hap_pairs, hap_prob, u_hap, u_hap_code, subj_id, post, hap1_code, hap2_code
 
-        tmp1 = _Haplostats.haplo_em_pin_wrap(n_loci, n_subject, weight, n_alleles,
-                                             max_haps, max_iter, loci_insert_order,
-                                             min_prior, min_posterior, tol, insert_batch_size,
-                                             random_start, iseed1, iseed2, iseed3, verbose, geno_vec)
-
-        # values returned from haplo_em_pin
-        status1, converge, lnlike, n_u_hap, n_hap_pairs = tmp1
-
-        tmp2 = _Haplostats.haplo_em_ret_info_wrap(\
-            # input parameters
-            n_u_hap, n_loci, n_hap_pairs,
-            # output parameters: declaring array sizes for ret_val
-            n_u_hap,          # hap_prob
-            n_u_hap * n_loci, # u_hap
-            n_u_hap,          # u_hap_code
-            n_hap_pairs,        # subj_id
-            n_hap_pairs,        # post
-            n_hap_pairs,        # hap1_code
-            n_hap_pairs,        # hap2_code
-            )
-
-        # values returned from haplo_em_ret_info
-        status2, hap_prob, u_hap, u_hap_code, subj_id, post, hap1_code, hap2_code = tmp2
-
-        _Haplostats.haplo_free_memory()
-
-        return converge, lnlike, n_u_hap, n_hap_pairs, hap_prob, u_hap, u_hap_code, subj_id, post, hap1_code, hap2_code
-
-        
+    
 
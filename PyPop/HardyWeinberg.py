@@ -39,50 +39,123 @@
 """
 
 import string, sys, os, popen2
+import numpy as np
+from math import sqrt
 import _Pvalue
-from math import pow, sqrt
 # FIXME: should remove the need for hardcoding a GENOTYPE_SEPARATOR
 # this can clash with a character within an allele identifier too easily
 from Utils import getStreamType, TextOutputStream, GENOTYPE_SEPARATOR
 from Arlequin import ArlequinExactHWTest
 
-def _chen_statistic (genotype, alleleFreqs, genotypes,  total_gametes):
+def _chen_statistic(genotypes, alleleFreqs, total_gametes):
+  """Chen's chi-square for every genotype of a k x k table.
 
-  total_indivs = total_gametes/2
+  - 'genotypes': k x k array of observed genotype counts.
 
-  allele1, allele2 = string.split(genotype, GENOTYPE_SEPARATOR)
-  p_i = alleleFreqs[allele1]
-  p_j = alleleFreqs[allele2]
+  - 'alleleFreqs': array of allele frequencies, in the order of the
+    rows of 'genotypes'.
 
-  # get current genotype frequency
-  p_ij = genotypes[genotype]/float(total_indivs)
+  Returns a k x k array of chi-squares, NaN where the variance is
+  zero (e.g. for a monomorphic locus)."""
 
-  # get homozygous genotype frequencies, set to 0.0 if they aren't seen
-  try:
-    p_ii = genotypes[allele1+GENOTYPE_SEPARATOR+allele1]/float(total_indivs)
-  except KeyError:
-    p_ii = 0.0
+  total_indivs = total_gametes/2
+  k = len(alleleFreqs)
+  diagonal = np.arange(k)
+
+  # genotype frequencies, and the homozygous genotype frequencies of
+  # the alleles of each genotype (0.0 if they aren't seen)
+  p_ij = genotypes/float(total_indivs)
+  p_ii = p_ij.diagonal()[:, np.newaxis]
+  p_jj = p_ij.diagonal()[np.newaxis, :]
+  p_i = alleleFreqs[:, np.newaxis]
+  p_j = alleleFreqs[np.newaxis, :]
+
+  # heterozygote case
+  d = p_i*p_j - (0.5)*p_ij
+  var = (1.0/float(total_gametes))*(p_i*p_j*((1-p_i)*(1-p_j) + p_i*p_j)
+                                    + p_i*p_i*(p_jj - p_j*p_j)
+                                    + p_j*p_j*(p_ii - p_i*p_i))
+
+  # homozygote case, on the diagonal
+  p = alleleFreqs
+  d[diagonal, diagonal] = p*p - p_ij.diagonal()
+  var[diagonal, diagonal] = (1.0/float(total_indivs))*(np.power(p, 4.0)-(2*np.power(p, 3.0))+(p*p))
+
+  old = np.seterr(divide='ignore', invalid='ignore')
   try:
-    p_jj = genotypes[allele2+GENOTYPE_SEPARATOR+allele2]/float(total_indivs)
-  except KeyError:
-    p_jj = 0.0
-    
-  if (allele1 != allele2):
-    # heterozygote case
-
-    d = p_i*p_j - (0.5)*p_ij
-    var = (1.0/float(total_gametes))*(p_i*p_j*((1-p_i)*(1-p_j) + p_i*p_j)
-                                      + p_i*p_i*(p_jj - p_j*p_j) 
-                                      + p_j*p_j*(p_ii - p_i*p_i))
-  else:
-    # homozygote case 
-    d = p_i*p_i - p_ii
-    var = (1.0/float(total_indivs))*(pow(p_i, 4.0)-(2*pow(p_i,3.0))+(p_i*p_i))
-
-  chiSquare = abs(d)*abs(d)/var
+    chiSquare = np.abs(d)*np.abs(d)/var
+  finally:
+    np.seterr(**old)
+  chiSquare[var == 0.0] = np.nan
 
   return chiSquare
 
+def _runningTotal(values):
+  """Total of an array, added in order (as a Python loop would)."""
+  if len(values) == 0:
+    return 0.0
+  return float(np.cumsum(values)[-1])
+
+def _factorizeGenotypes(locusData):
+  """Convert a list of genotype tuples to integer allele codes.
+
+  Returns a 3-tuple: the list of distinct alleles in order of first
+  appearance, the alphabetical rank of each of these alleles and an
+  (n, 2) array of the position of each allele of each genotype in
+  the list."""
+  cells = np.empty((len(locusData), 2), dtype='O')
+  if len(locusData) > 0:
+    cells[:] = locusData
+  names, firstSeen, codes = np.unique(cells.ravel(), return_index=True,
+                                      return_inverse=True)
+  alphaOrder = np.argsort(firstSeen, kind='mergesort')
+  position = np.empty(len(names), dtype=int)
+  position[alphaOrder] = np.arange(len(names))
+  return names[alphaOrder].tolist(), alphaOrder, \
+         position[codes].reshape(len(locusData), 2)
+
+def genotypeTable(locusData):
+  """Table of observed genotype counts for a locus.
+
+  Returns a 2-tuple: the list of alleles in order of first appearance
+  and a k x k array of genotype counts, where row i, column j counts
+  the genotypes given as (allele i, allele j).  This is the input
+  expected by HardyWeinbergBatch."""
+  alleles, alphaOrder, genotypes = _factorizeGenotypes(locusData)
+  k = len(alleles)
+  pairs = genotypes[:, 0] * k + genotypes[:, 1]
+  return alleles, np.bincount(pairs, minlength=k*k).reshape(k, k)
+
+def _concatenate(arrays, dtype):
+  """Concatenate a (possibly empty) list of 1-d arrays."""
+  return np.concatenate([np.zeros(0, dtype=dtype)] + arrays).astype(dtype)
+
+def _batchChisq(observed, expected, mask):
+  """Chi-square contributions, NaN where 'mask' is not set."""
+  chisq = np.full(len(observed), np.nan)
+  squareMe = observed[mask] - expected[mask]
+  chisq[mask] = (squareMe * squareMe) / expected[mask]
+  return chisq
+
+# _Pvalue.pval applied element-wise over arrays
+_pvalFunc = np.frompyfunc(_Pvalue.pval, 2, 1)
+
+def _batchPvalues(chisq, df, mask):
+  """Chi-square p-values, NaN where 'mask' is not set.
+
+  Tables without any degrees of freedom are left NaN too, rather than
+  passing them to _Pvalue.pval, which has no p-value for them.  The C
+  routine itself divides by zero to build its infinities, which numpy
+  would otherwise report as a warning for every call."""
+  pvals = np.full(len(chisq), np.nan)
+  df = np.broadcast_to(np.asarray(df, dtype=float), chisq.shape)
+  with np.errstate(invalid='ignore'):
+    mask = mask & (df > 0)
+  if mask.any():
+    with np.errstate(divide='ignore', invalid='ignore'):
+      pvals[mask] = _pvalFunc(chisq[mask], df[mask]).astype(float)
+  return pvals
+
 class HardyWeinberg:
   """Calculate Hardy-Weinberg statistics.
 
@@ -155,26 +228,40 @@ class HardyWeinberg:
     if self.flagChenTest:
       self.chenPvalByGenotype = {}
 
-    for allele in self.locusData:
-      """Run through each tuple in the given genotype data and
-      create dictionaries of observed alleles and genotypes."""
-
-      if allele[0] not in self.observedAlleles:
-        self.observedAlleles.append(allele[0])
-      if allele[1] not in self.observedAlleles:
-        self.observedAlleles.append(allele[1])
-
-      if allele[0] != allele[1]:
-        if self.hetsObservedByAllele.has_key(allele[0]):
-          self.hetsObservedByAllele[allele[0]] += 1
-        else:
-          self.hetsObservedByAllele[allele[0]] = 1
-        if self.hetsObservedByAllele.has_key(allele[1]):
-          self.hetsObservedByAllele[allele[1]] += 1
-        else:
-          self.hetsObservedByAllele[allele[1]] = 1
-
-      self.observedGenotypes.append(allele[0] + GENOTYPE_SEPARATOR + allele[1])
+    # factorize the genotypes into integer codes, the positions of
+    # the alleles in observedAlleles (in order of first appearance)
+    self.observedAlleles, alphaOrder, genotypes = \
+                          _factorizeGenotypes(self.locusData)
+    alleles = self.observedAlleles
+    k = len(alleles)
+
+    # k x k table of observed genotypes, rows are the first allele
+    # of each genotype as given, columns the second
+    pairs = genotypes[:, 0] * k + genotypes[:, 1]
+    self.observedTable = np.bincount(pairs, minlength=k*k).reshape(k, k)
+
+    self.observedGenotypes = [allele[0] + GENOTYPE_SEPARATOR + allele[1] \
+                              for allele in self.locusData]
+
+    # dictionary of genotype:count key:values, in order of appearance
+    distinctPairs, pairFirstSeen = np.unique(pairs, return_index=True)
+    for pair in distinctPairs[np.argsort(pairFirstSeen)].tolist():
+      i, j = divmod(pair, k)
+      self.observedGenotypeCounts[alleles[i] + GENOTYPE_SEPARATOR + alleles[j]] = \
+                                   int(self.observedTable[i, j])
+
+    # totals for homozygotes and heterozygotes
+    self.totalHomsObs = int(np.trace(self.observedTable))
+    self.totalHetsObs = self.n - self.totalHomsObs
+
+    # heterozygotes observed for each allele are the row sums of the
+    # symmetric table, without the homozygotes on the diagonal
+    symmetricTable = self.observedTable + self.observedTable.T
+    hetsObserved = symmetricTable.sum(axis=1) - symmetricTable.diagonal()
+    hetAlleles = genotypes[genotypes[:, 0] != genotypes[:, 1]].ravel()
+    hetAlleles, hetFirstSeen = np.unique(hetAlleles, return_index=True)
+    for i in hetAlleles[np.argsort(hetFirstSeen)].tolist():
+      self.hetsObservedByAllele[alleles[i]] = int(hetsObserved[i])
 
     for allele in self.alleleCounts.keys():
       """For each entry in the dictionary of allele counts
@@ -183,67 +270,47 @@ class HardyWeinberg:
       freq = self.alleleCounts[allele] / float(self.alleleTotal)
       self.alleleFrequencies[allele] = freq
 
-    for genotype in self.observedGenotypes:
-      """Generate a dictionary of genotype:count key:values
-
-      - and accumulate totals for homozygotes and heterozygotes"""
-
-      if self.observedGenotypeCounts.has_key(genotype):
-        self.observedGenotypeCounts[genotype] += 1
-      else:
-        self.observedGenotypeCounts[genotype] = 1
-
-      temp = string.split(genotype, GENOTYPE_SEPARATOR)
-      if temp[0] == temp[1]:
-        self.totalHomsObs += 1
-      else:
-        self.totalHetsObs += 1
-
     if self.debug:
       print "Total homozygotes observed:", self.totalHomsObs
       print "Total heterozygotes observed:", self.totalHetsObs
 
-    for i in range(len(self.observedAlleles)):
-      """Generate a list of all possible genotypes
-
-      - sorting the individual genotypes alphabetically"""
-
-      for j in range(i, len(self.observedAlleles)):
-          if self.observedAlleles[i] < self.observedAlleles[j]:
-            self.possibleGenotypes.append(self.observedAlleles[i] + GENOTYPE_SEPARATOR + self.observedAlleles[j])
-          else:
-            self.possibleGenotypes.append(self.observedAlleles[j] + GENOTYPE_SEPARATOR + self.observedAlleles[i])
-
-    for genotype in self.possibleGenotypes:
-      """Calculate expected genotype counts under HWP
-
-      - Create a dictionary of genotype:frequency key:values
-
-      - accumulate totals for homozygotes and heterozygotes
-
-      - and build table of observed genotypes for each allele"""
-
-      temp = string.split(genotype, GENOTYPE_SEPARATOR)
-      if temp[0] == temp[1]:         # homozygote, N * pi * pi
-        self.expectedGenotypeCounts[genotype] = self.n * \
-        self.alleleFrequencies[temp[0]] * self.alleleFrequencies[temp[1]]
-        self.totalHomsExp += self.expectedGenotypeCounts[genotype]
-      else:                          # heterozygote, 2N * pi * pj
-        self.expectedGenotypeCounts[genotype] = 2 * self.n * \
-        self.alleleFrequencies[temp[0]] * self.alleleFrequencies[temp[1]]
-        self.totalHetsExp += self.expectedGenotypeCounts[genotype]
-
-        for allele in self.observedAlleles:
-          if allele == temp[0]:
-            if self.hetsExpectedByAllele.has_key(allele):
-              self.hetsExpectedByAllele[allele] += self.expectedGenotypeCounts[genotype]
-            else:
-              self.hetsExpectedByAllele[allele] = self.expectedGenotypeCounts[genotype]
-          elif allele == temp[1]:
-            if self.hetsExpectedByAllele.has_key(allele):
-              self.hetsExpectedByAllele[allele] += self.expectedGenotypeCounts[genotype]
-            else:
-              self.hetsExpectedByAllele[allele] = self.expectedGenotypeCounts[genotype]
+    # k x k table of expected genotype counts under HWP: N * pi * pi
+    # for homozygotes, 2N * pi * pj for heterozygotes where allele i
+    # sorts alphabetically before j (the order of the products is
+    # kept so that the results are identical to the last bit)
+    freqs = np.array([self.alleleFrequencies[allele] for allele in alleles],
+                     dtype=float)
+    products = (2 * self.n * freqs)[:, np.newaxis] * freqs[np.newaxis, :]
+    self.expectedTable = np.where(alphaOrder[:, np.newaxis] < alphaOrder[np.newaxis, :],
+                                  products, products.T)
+    diagonal = np.arange(k)
+    self.expectedTable[diagonal, diagonal] = self.n * freqs * freqs
+
+    # list of all possible genotypes, sorting the individual
+    # genotypes alphabetically, and their expected counts
+    rows, cols = np.triu_indices(k)
+    expectedCounts = self.expectedTable[rows, cols]
+    for i, j, expected in zip(rows.tolist(), cols.tolist(), expectedCounts.tolist()):
+      if alleles[i] < alleles[j]:
+        genotype = alleles[i] + GENOTYPE_SEPARATOR + alleles[j]
+      else:
+        genotype = alleles[j] + GENOTYPE_SEPARATOR + alleles[i]
+      self.possibleGenotypes.append(genotype)
+      self.expectedGenotypeCounts[genotype] = expected
+
+    # accumulate totals for homozygotes and heterozygotes, and for
+    # heterozygotes by allele (as row sums), in the same order as
+    # the genotypes are listed: cumsum, unlike sum, adds in order
+    isHom = (rows == cols)
+    self.totalHomsExp = _runningTotal(expectedCounts[isHom])
+    self.totalHetsExp = _runningTotal(expectedCounts[~isHom])
+
+    if k > 1:
+      hetsExpected = self.expectedTable.copy()
+      hetsExpected[diagonal, diagonal] = 0.0
+      hetsExpected = np.cumsum(hetsExpected, axis=1)[:, -1].tolist()
+      for i in range(k):
+        self.hetsExpectedByAllele[alleles[i]] = hetsExpected[i]
 
     total = 0
     for value in self.expectedGenotypeCounts.values():
@@ -326,11 +393,21 @@ class HardyWeinberg:
             print '          ', allele, self.hetsObservedByAllele[allele], self.hetsExpectedByAllele[allele], self.hetsChisqByAllele[allele], self.hetsPvalByAllele[allele]
 
     # do Chen's statistic
-    if self.flagChenTest:
-      for genotype in self.observedGenotypeCounts.keys():
-        chenChiSquare = _chen_statistic(genotype, self.alleleFrequencies,
-                            self.observedGenotypeCounts, self.alleleTotal)
-        self.chenPvalByGenotype[genotype] = _Pvalue.pval(chenChiSquare,1)
+    if self.flagChenTest and self.n > 0:
+      alleles = self.observedAlleles
+      freqs = np.array([self.alleleFrequencies[allele] for allele in alleles],
+                       dtype=float)
+      chenChiSquare = _chen_statistic(self.observedTable, freqs,
+                                      self.alleleTotal)
+
+      # p-values for all observed genotypes, genotypes with no
+      # variance are reported as not calculated
+      rows, cols = np.nonzero((self.observedTable > 0) & ~np.isnan(chenChiSquare))
+      chenChiSquare = chenChiSquare[rows, cols]
+      chenPvals = _batchPvalues(chenChiSquare, 1,
+                                np.ones(len(chenChiSquare), dtype=bool))
+      for i, j, pval in zip(rows.tolist(), cols.tolist(), chenPvals.tolist()):
+        self.chenPvalByGenotype[alleles[i] + GENOTYPE_SEPARATOR + alleles[j]] = pval
 
     # the list for all genotypes by genotype
     for genotype in self.expectedGenotypeCounts.keys():
@@ -708,6 +785,243 @@ class HardyWeinberg:
     stream.closetag("genotypetable")
     stream.writeln()
 
+class HardyWeinbergBatch:
+  """Calculate Hardy-Weinberg chi-square statistics for many loci at once.
+
+  Computes the same chi-square statistics as HardyWeinberg (apart
+  from Chen's statistic) for a list of observed genotype tables,
+  e.g. every locus and every lump level of one or many data sets,
+  without building a HardyWeinberg instance for each one.
+
+  All results are numpy arrays:
+
+  - per-table values (e.g. 'totalChisqHoms', 'HWChisqPval', the
+    'flag*' values) are indexed by the position of the table in the
+    input list.
+
+  - per-allele values ('alleleCounts', 'hetsObservedByAllele',
+    'hetsExpectedByAllele', 'hetsChisqByAllele', 'hetsPvalByAllele')
+    are concatenated over all tables: 'alleleTable' gives the table
+    of each entry and 'alleleIndex' its row in that table.
+
+  - per-genotype values ('observedGenotypeCounts',
+    'expectedGenotypeCounts', 'chisqByGenotype', 'pvalByGenotype')
+    cover the upper triangle of each table, concatenated over all
+    tables: 'genotypeTable' gives the table of each entry and
+    'genotypeRows', 'genotypeCols' its alleles.
+
+  Statistics that are not calculated for a given table, allele or
+  genotype (e.g. because the expected count is less than lumpBelow)
+  are NaN.
+  """
+
+  def __init__(self, observedTables=None,
+               lumpBelow = 5,
+               debug=0):
+    """Constructor.
+
+    - observedTables: list of k x k arrays of observed genotype
+      counts, as returned by genotypeTable() (or the 'observedTable'
+      attribute of HardyWeinberg).  A heterozygote may be counted at
+      either [i, j] or [j, i].
+
+    - lumpBelow: treat genotypes with expected count less than this
+      as if they were in same class (Default: 5)
+
+    """
+    self.lumpBelow = lumpBelow
+    self.debug = debug
+    self.tableCount = len(observedTables)
+
+    self._generateTables(observedTables)
+    self._calcChisq()
+
+  def _generateTables(self, observedTables):
+    """Flatten the genotype tables and calculate expected counts.
+
+    *For internal use only.*"""
+    ks = []
+    alleleCounts = []
+    genotypeRows = []
+    genotypeCols = []
+    genotypeCounts = []
+    for table in observedTables:
+      table = np.asarray(table)
+      rows, cols = np.triu_indices(table.shape[0])
+      # fold heterozygotes counted below the diagonal into the
+      # upper triangle
+      folded = np.where(rows == cols, table[rows, cols],
+                        table[rows, cols] + table[cols, rows])
+      ks.append(table.shape[0])
+      alleleCounts.append(table.sum(axis=0) + table.sum(axis=1))
+      genotypeRows.append(rows)
+      genotypeCols.append(cols)
+      genotypeCounts.append(folded)
+
+    self.k = np.array(ks, dtype=int)
+    alleleOffsets = np.cumsum(self.k) - self.k
+
+    # per-allele arrays
+    self.alleleTable = np.repeat(np.arange(self.tableCount), self.k)
+    self.alleleIndex = np.arange(len(self.alleleTable)) - \
+                       alleleOffsets[self.alleleTable]
+    self.alleleCounts = _concatenate(alleleCounts, int)
+    self.alleleTotal = np.bincount(self.alleleTable,
+                                   weights=self.alleleCounts,
+                                   minlength=self.tableCount).astype(int)
+    self.n = self.alleleTotal // 2
+    totals = self.alleleTotal[self.alleleTable].astype(float)
+    self.alleleFrequencies = self.alleleCounts / np.where(totals > 0, totals, 1.0)
+
+    # per-genotype arrays
+    self.genotypeTable = np.repeat(np.arange(self.tableCount),
+                                   [len(rows) for rows in genotypeRows])
+    self.genotypeRows = _concatenate(genotypeRows, int)
+    self.genotypeCols = _concatenate(genotypeCols, int)
+    self.observedGenotypeCounts = _concatenate(genotypeCounts, int)
+    self.isHomozygote = (self.genotypeRows == self.genotypeCols)
+
+    # positions of the two alleles of each genotype in the per-allele arrays
+    self._firstAllele = alleleOffsets[self.genotypeTable] + self.genotypeRows
+    self._secondAllele = alleleOffsets[self.genotypeTable] + self.genotypeCols
+
+    # expected genotype counts under HWP, N * pi * pi for homozygotes
+    # and 2N * pi * pj for heterozygotes
+    n = self.n[self.genotypeTable]
+    freqs1 = self.alleleFrequencies[self._firstAllele]
+    freqs2 = self.alleleFrequencies[self._secondAllele]
+    self.expectedGenotypeCounts = np.where(self.isHomozygote,
+                                           n * freqs1 * freqs2,
+                                           2 * n * freqs1 * freqs2)
+
+    # totals for homozygotes and heterozygotes, and heterozygotes by
+    # allele (np.bincount adds the weights in order)
+    homs = self.isHomozygote
+    hets = ~homs
+    self.totalHomsObs = self._totalByTable(self.observedGenotypeCounts, homs).astype(int)
+    self.totalHetsObs = self._totalByTable(self.observedGenotypeCounts, hets).astype(int)
+    self.totalHomsExp = self._totalByTable(self.expectedGenotypeCounts, homs)
+    self.totalHetsExp = self._totalByTable(self.expectedGenotypeCounts, hets)
+
+    hetAlleles = np.concatenate((self._firstAllele[hets],
+                                 self._secondAllele[hets]))
+    self.hetsObservedByAllele = np.bincount(
+      hetAlleles, weights=np.tile(self.observedGenotypeCounts[hets], 2),
+      minlength=len(self.alleleTable)).astype(int)
+    self.hetsExpectedByAllele = np.bincount(
+      hetAlleles, weights=np.tile(self.expectedGenotypeCounts[hets], 2),
+      minlength=len(self.alleleTable))
+
+  def _totalByTable(self, values, mask):
+    """Sum the per-genotype 'values' selected by 'mask' for each table.
+
+    *For internal use only.*"""
+    return np.bincount(self.genotypeTable[mask], weights=values[mask],
+                       minlength=self.tableCount)
+
+  def _calcChisq(self):
+    """Calculate the chi-squares and p-values for all tables.
+
+    Follows HardyWeinberg._calcChisq(), with each step applied to
+    every table at once and p-values calculated by the _Pvalue
+    extension module.
+
+    *For internal use only.*"""
+    lumpBelow = self.lumpBelow
+    observed = self.observedGenotypeCounts.astype(float)
+    expected = self.expectedGenotypeCounts
+
+    # first all the the homozygotes, then all the heterozygotes
+    self.flagHoms = (self.totalHomsExp >= lumpBelow)
+    self.totalChisqHoms = _batchChisq(self.totalHomsObs, self.totalHomsExp,
+                                      self.flagHoms)
+    self.chisqHomsPval = _batchPvalues(self.totalChisqHoms, 1, self.flagHoms)
+
+    self.flagHets = (self.totalHetsExp >= lumpBelow)
+    self.totalChisqHets = _batchChisq(self.totalHetsObs, self.totalHetsExp,
+                                      self.flagHets)
+    self.chisqHetsPval = _batchPvalues(self.totalChisqHets, 1, self.flagHets)
+
+    # heterozygous genotypes by allele, only for tables with at
+    # least two alleles
+    byAllele = (self.k[self.alleleTable] > 1) & \
+               (self.hetsExpectedByAllele >= lumpBelow)
+    self.hetsChisqByAllele = _batchChisq(self.hetsObservedByAllele,
+                                         self.hetsExpectedByAllele, byAllele)
+    self.hetsPvalByAllele = _batchPvalues(self.hetsChisqByAllele, 1, byAllele)
+
+    # the common genotypes, with expected counts of at least lumpBelow
+    common = (expected >= lumpBelow)
+    rare = ~common
+    self.chisqByGenotype = _batchChisq(observed, expected, common)
+    self.pvalByGenotype = _batchPvalues(self.chisqByGenotype, 1, common)
+
+    self.commonGenotypeCounter = self._totalByTable(np.ones(len(common)), common).astype(int)
+    self.commonChisqAccumulator = self._totalByTable(self.chisqByGenotype, common)
+    self.commonObservedAccumulator = self._totalByTable(observed, common)
+    self.commonExpectedAccumulator = self._totalByTable(expected, common)
+
+    # lump together the rare genotypes
+    self.rareGenotypeCounter = self._totalByTable(np.ones(len(rare)), rare).astype(int)
+    self.lumpedObservedGenotypes = self._totalByTable(observed, rare)
+    self.lumpedExpectedGenotypes = self._totalByTable(expected, rare)
+
+    # count the alleles appearing in common genotypes, used to
+    # determine DoF for common genotypes.  If all alleles are present
+    # in common genotypes, then there are k - 1 independent allele
+    # frequency estimates.
+    inCommon = np.zeros(len(self.alleleTable), dtype=bool)
+    inCommon[self._firstAllele[common]] = True
+    inCommon[self._secondAllele[common]] = True
+    self.counterAllelesCommon = np.bincount(self.alleleTable,
+                                            weights=inCommon,
+                                            minlength=self.tableCount).astype(int)
+    allCommon = (self.counterAllelesCommon == self.k)
+    self.counterAllelesCommon[allCommon] -= 1
+    self.commonDf = self.commonGenotypeCounter - self.counterAllelesCommon
+
+    self.flagNoCommonGenotypes = (self.commonGenotypeCounter == 0)
+    self.flagNoRareGenotypes = ~self.flagNoCommonGenotypes & \
+                               (self.rareGenotypeCounter == 0)
+    someRare = ~self.flagNoCommonGenotypes & (self.rareGenotypeCounter > 0)
+    self.flagTooManyParameters = someRare & (self.commonDf < 1)
+    enoughDf = someRare & (self.commonDf >= 1)
+    self.flagLumps = enoughDf & (self.lumpedExpectedGenotypes >= lumpBelow)
+    self.flagTooFewExpected = enoughDf & ~self.flagLumps
+    self.flagCommons = self.flagNoRareGenotypes | enoughDf
+    self.flagCommonPlusLumped = self.flagLumps
+
+    # overall chi-square for the common genotypes, with k(k-1)/2
+    # degrees of freedom if there are no rare genotypes
+    self.HWChisq = np.where(self.flagCommons, self.commonChisqAccumulator, np.nan)
+    self.HWChisqDf = np.where(self.flagNoRareGenotypes,
+                              (self.k * (self.k - 1.0)) / 2.0,
+                              np.where(enoughDf, self.commonDf, np.nan))
+    self.HWChisqPval = _batchPvalues(self.HWChisq, self.HWChisqDf,
+                                     self.flagCommons)
+
+    # chi-square for the lumped rare genotypes, and common plus lumped
+    self.lumpedChisq = _batchChisq(self.lumpedObservedGenotypes,
+                                   self.lumpedExpectedGenotypes,
+                                   self.flagLumps)
+    self.lumpedChisqPval = _batchPvalues(self.lumpedChisq, 1, self.flagLumps)
+
+    lumps = self.flagLumps
+    self.commonPlusLumpedChisq = np.where(
+      lumps, self.commonChisqAccumulator + self.lumpedChisq, np.nan)
+    self.commonPlusLumpedObserved = np.where(
+      lumps, self.commonObservedAccumulator + self.lumpedObservedGenotypes, np.nan)
+    self.commonPlusLumpedExpected = np.where(
+      lumps, self.commonExpectedAccumulator + self.lumpedExpectedGenotypes, np.nan)
+    self.commonPlusLumpedChisqDf = np.where(lumps, self.commonDf, np.nan)
+    self.commonPlusLumpedChisqPval = _batchPvalues(self.commonPlusLumpedChisq,
+                                                   self.commonPlusLumpedChisqDf,
+                                                   lumps)
+
+    if self.debug:
+      print "Batch of %d tables, %d with common genotypes" % \
+            (self.tableCount, (~self.flagNoCommonGenotypes).sum())
+
 class HardyWeinbergGuoThompson(HardyWeinberg):
   """Wrapper class for 'gthwe'
 
@@ -741,8 +1055,38 @@ class HardyWeinbergGuoThompson(HardyWeinberg):
 
   - 'monteCarloSteps': number of steps for the plain Monte Carlo
      randomization test (without Markov-chain)
+
+  - 'numChains': number of independent Markov chains for the MCMC
+     test, each run in its own process on its share of the
+     'samplingNum' chunks (default 1, a single chain).
+
+  - 'stderrTolerance': if set, stop either test early, once the
+     standard error of the p-value is at most this value (default
+     0.0, disabled).
+
+  - 'alpha': if set, stop either test early, once the p-value is
+     more than 'stoppingZ' standard errors above or below this
+     significance level (default 0.0, disabled).
+
+  With either 'stderrTolerance' or 'alpha' set, the steps given by
+  'samplingNum' x 'samplingSize' and 'monteCarloSteps' become the
+  maximum budget, run in up to 'adaptiveRounds' rounds with the
+  stopping rules checked after each one.  The standard error they
+  use is bounded away from 0 for p-values of 0 or 1 (see
+  'GuoThompsonResult.getStoppingStderr').
+
+  - 'resultCache': a 'Cache.ResultCache' instance, if set results are
+     looked up there before running either test, and stored there
+     afterwards (default None).
      """
 
+  # number of rounds the step budget is split into in adaptive mode
+  adaptiveRounds = 20
+
+  # number of standard errors from 'alpha' for a p-value to be
+  # clearly significant (or not)
+  stoppingZ = 3.0
+
   def __init__(self,
                locusData=None,
                alleleCount=None,
@@ -753,6 +1097,10 @@ class HardyWeinbergGuoThompson(HardyWeinberg):
                samplingSize=1000,
                maxMatrixSize=250,
                monteCarloSteps=1000000, # samplingNum*samplingSize (consistency)
+               numChains=1,
+               stderrTolerance=0.0,
+               alpha=0.0,
+               resultCache=None,
                testing=False,
                **kw):
 
@@ -763,6 +1111,10 @@ class HardyWeinbergGuoThompson(HardyWeinberg):
     self.samplingSize=samplingSize
     self.maxMatrixSize=maxMatrixSize
     self.monteCarloSteps=monteCarloSteps
+    self.numChains=numChains
+    self.stderrTolerance=stderrTolerance
+    self.alpha=alpha
+    self.resultCache=resultCache
     if testing:
       self.testing = 1
     else:
@@ -851,46 +1203,463 @@ class HardyWeinbergGuoThompson(HardyWeinberg):
       # flush stdout before running the G&T step
       sys.stdout.flush()
 
-    # create string "file" buffer
-    import cStringIO
-
-    # import library only when necessary
-    import _Gthwe
-
     if self.runMCMCTest:
-      fp = cStringIO.StringIO()
       stream.opentag('hardyweinbergGuoThompson',
                       allelelump=("%d" % allelelump))
 
       self.serializeXMLTableTo(stream)
 
-      _Gthwe.run_data(self.flattenedMatrix, n, self.k, self.totalGametes,
-                      self.dememorizationSteps, self.samplingNum,
-                      self.samplingSize, locusName, fp, 0, self.testing)
+      self.mcmcResult = self._cachedRun('mcmc', self._runMCMC,
+                                        (self.dememorizationSteps,
+                                         self.samplingNum,
+                                         self.samplingSize,
+                                         self.numChains)
+                                        + self._adaptiveParameters())
+      self.mcmcResult.serializeTo(stream)
 
-      # copy XML output to stream
-      stream.write(fp.getvalue())
-      fp.close()
       stream.closetag('hardyweinbergGuoThompson')
       stream.writeln()
 
 
     if self.runPlainMCTest:
-      fp = cStringIO.StringIO()
       stream.opentag('hardyweinbergGuoThompson',
                       type='monte-carlo',
                       allelelump=("%d" % allelelump))
       self.serializeXMLTableTo(stream)
-      
-      _Gthwe.run_randomization(self.flattenedMatrix, n, self.k,
-                               self.totalGametes, self.monteCarloSteps, fp,
-                               0, self.testing)
-      # copy XML output to stream
-      stream.write(fp.getvalue())
-      fp.close()
+
+      self.monteCarloResult = self._cachedRun('monte-carlo',
+                                              self._runMonteCarlo,
+                                              (self.monteCarloSteps,)
+                                              + self._adaptiveParameters())
+      self.monteCarloResult.serializeTo(stream)
+
       stream.closetag('hardyweinbergGuoThompson')
       stream.writeln()
 
+  def _cachedRun(self, test, run, parameters):
+    """Returns the result of 'run()', looked up in (and otherwise
+    added to) the result cache, if there is one.
+
+    'parameters' must include everything, other than the genotype
+    table, that determines the result of 'test'.
+
+    *For internal use only.*"""
+    if not self.resultCache:
+      return run()
+
+    key = self.resultCache.makeKey(test, self.flattenedMatrix, parameters)
+    state = self.resultCache.get(key)
+    if state is None:
+      result = run()
+      self.resultCache.put(key, result.getState())
+    else:
+      result = GuoThompsonResult(self.k)
+      result.setState(state)
+      if self.debug:
+        print "using cached %s result" % test
+    return result
+
+  def _adaptiveParameters(self):
+    """Parameters of the adaptive stopping rules and the seed mode,
+    as part of a result cache key.
+
+    *For internal use only.*"""
+    return (self.stderrTolerance, self.alpha, self.adaptiveRounds,
+            self.stoppingZ, self.testing)
+
+  def _isAdaptive(self):
+    """*For internal use only.*"""
+    return self.stderrTolerance > 0.0 or self.alpha > 0.0
+
+  def _stoppingRule(self, result):
+    """Returns the adaptive stopping rule satisfied by 'result' so
+    far ('stderr' or 'alpha'), or 'None' to keep going.
+
+    *For internal use only.*"""
+    pvalue = result.getPvalue()
+    stderr = result.getStoppingStderr()
+    if self.stderrTolerance > 0.0 and stderr <= self.stderrTolerance:
+      return 'stderr'
+    if self.alpha > 0.0 and abs(pvalue - self.alpha) > self.stoppingZ * stderr:
+      return 'alpha'
+    return None
+
+  def _runMCMC(self):
+    """Run the MCMC test, returns a GuoThompsonResult.
+
+    The 'samplingNum' chunks are split as evenly as possible between
+    'numChains' independent Markov chains, each with its own
+    dememorization steps and random seed (fixed in testing mode).
+    More than one chain are run in separate processes and their
+    results merged.  In adaptive mode this is repeated in rounds, each
+    with new chains, until a stopping rule is satisfied or the chunks
+    are used up.
+
+    *For internal use only.*"""
+
+    import time
+
+    numChains = max(1, min(self.numChains, self.samplingNum))
+    if self.testing:
+      seed = 1234
+    else:
+      seed = int(time.time())
+
+    if self._isAdaptive():
+      roundChunks = max(numChains, -(-self.samplingNum / self.adaptiveRounds))
+    else:
+      roundChunks = self.samplingNum
+
+    result = GuoThompsonResult(self.k,
+                               dememorizationSteps=self.dememorizationSteps,
+                               samplingNum=self.samplingNum,
+                               samplingSize=self.samplingSize)
+
+    startTime = int(time.time())
+    pool = None
+    if numChains > 1:
+      import multiprocessing
+      pool = multiprocessing.Pool(numChains)
+    try:
+      usedChunks = 0
+      while usedChunks < self.samplingNum:
+        chunks = min(roundChunks, self.samplingNum - usedChunks)
+        chains = min(numChains, chunks)
+        tasks = []
+        for i in range(chains):
+          chainChunks = chunks / chains
+          if i < chunks % chains:
+            chainChunks += 1
+          tasks.append((self.flattenedMatrix, self.k, self.totalGametes,
+                        self.dememorizationSteps, chainChunks,
+                        self.samplingSize, seed & 0x7fffffff))
+          seed += 1
+
+        if pool and chains > 1:
+          results = pool.map(_runGthweChain, tasks)
+        else:
+          results = map(_runGthweChain, tasks)
+        for chunkPvalues, switchCounts, chenCounts, diffCounts in results:
+          result.addChain(chunkPvalues, switchCounts, chenCounts, diffCounts)
+        usedChunks += chunks
+
+        if self._isAdaptive():
+          result.stoppingRule = self._stoppingRule(result)
+          if result.stoppingRule:
+            break
+      else:
+        if self._isAdaptive():
+          result.stoppingRule = 'max-steps'
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+
+    result.elapsedTime = int(time.time()) - startTime
+    result.timestamp = time.ctime()
+    return result
+
+  def _runMonteCarlo(self):
+    """Run the plain Monte Carlo test, returns a GuoThompsonResult.
+
+    In adaptive mode, the 'monteCarloSteps' permutations are run in
+    rounds, each seeded separately, until a stopping rule is
+    satisfied or the permutations are used up.
+
+    *For internal use only.*"""
+
+    import time, _Gthwe
+
+    result = GuoThompsonResult(self.k, monteCarlo=1)
+    numGenotypes = len(self.flattenedMatrix)
+
+    if not self._isAdaptive():
+      # a single run from the default GSL seed
+      status, extremeCount, chenCounts, diffCounts = \
+              _Gthwe.run_randomization_counts(self.flattenedMatrix, [0]*self.k,
+                                              self.k, self.totalGametes,
+                                              self.monteCarloSteps, 0,
+                                              numGenotypes, numGenotypes)
+      result.addPermutations(self.monteCarloSteps, extremeCount,
+                             chenCounts, diffCounts)
+      return result
+
+    if self.testing:
+      seed = 1234
+    else:
+      seed = int(time.time())
+    roundSteps = max(1, -(-self.monteCarloSteps / self.adaptiveRounds))
+
+    while result.steps < self.monteCarloSteps:
+      iterations = min(roundSteps, self.monteCarloSteps - result.steps)
+      status, extremeCount, chenCounts, diffCounts = \
+              _Gthwe.run_randomization_counts(self.flattenedMatrix, [0]*self.k,
+                                              self.k, self.totalGametes,
+                                              iterations, seed & 0x7fffffff,
+                                              numGenotypes, numGenotypes)
+      seed += 1
+      result.addPermutations(iterations, extremeCount, chenCounts, diffCounts)
+
+      result.stoppingRule = self._stoppingRule(result)
+      if result.stoppingRule:
+        break
+    else:
+      result.stoppingRule = 'max-steps'
+
+    return result
+
+
+def _runGthweChain(args):
+  """Run a single Guo & Thompson Markov chain.
+
+  Called in a worker process by HardyWeinbergGuoThompson._runMCMC,
+  so must be at module level.
+
+  *For internal use only.*"""
+  import _Gthwe
+
+  genotypes, k, totalIndividuals, steps, chunks, size, seed = args
+  numGenotypes = (k * (k + 1)) / 2
+  status, chunkPvalues, switchCounts, chenCounts, diffCounts = \
+          _Gthwe.run_data_chain(genotypes, [0]*k, k, totalIndividuals,
+                                steps, chunks, size, seed,
+                                chunks, 3, numGenotypes, numGenotypes)
+  return chunkPvalues, switchCounts, chenCounts, diffCounts
+
+
+def _runGthwePermutations(args):
+  """Run the plain Monte Carlo test for part of the permutations.
+
+  Called in a worker process, so must be at module level.
+
+  *For internal use only.*"""
+  import _Gthwe
+
+  genotypes, k, totalIndividuals, iterations, seed = args
+  numGenotypes = (k * (k + 1)) / 2
+  status, extremeCount, chenCounts, diffCounts = \
+          _Gthwe.run_randomization_counts(genotypes, [0]*k, k,
+                                          totalIndividuals, iterations, seed,
+                                          numGenotypes, numGenotypes)
+  return iterations, extremeCount, chenCounts, diffCounts
+
+
+class GuoThompsonResult:
+  """Results of a Guo & Thompson test run by the 'gthwe' extension.
+
+  Keeps the raw counts of a run of either the MCMC test or the plain
+  Monte Carlo test, so that the results of several independent runs
+  (e.g. Markov chains run in parallel) can be merged before the
+  p-values are calculated, and serializes them to XML.
+
+  - 'k': number of alleles.
+
+  - 'monteCarlo': if set, results of the plain Monte Carlo
+    randomization test, otherwise of the MCMC test (default 0).
+
+  - 'dememorizationSteps', 'samplingNum', 'samplingSize': parameters
+    of the MCMC test.
+  """
+
+  # the per-genotype statistics calculated by the extension
+  statistics = ['chen_statistic', 'diff_statistic']
+
+  def __init__(self, k,
+               monteCarlo=0,
+               dememorizationSteps=0,
+               samplingNum=0,
+               samplingSize=0):
+    self.k = k
+    self.monteCarlo = monteCarlo
+    self.dememorizationSteps = dememorizationSteps
+    self.samplingNum = samplingNum
+    self.samplingSize = samplingSize
+
+    # number of chains (MCMC) and total sampled steps or permutations
+    self.chains = 0
+    self.steps = 0
+
+    # MCMC: p-value of each chunk, counts of steps with no, partial
+    # and full switches
+    self.chunkPvalues = []
+    self.switchCounts = [0, 0, 0]
+
+    # Monte Carlo: permutations at most as probable as the observed data
+    self.extremeCount = 0
+
+    # per-genotype counts of statistics at least as large as observed,
+    # in the order of the flattened lower-triangular matrix
+    self.statisticCounts = {}
+    for statistic in self.statistics:
+      self.statisticCounts[statistic] = [0] * ((k * (k + 1)) / 2)
+
+    self.elapsedTime = 0
+    self.timestamp = None
+
+    # in adaptive mode, the rule that stopped the test: 'stderr',
+    # 'alpha' or 'max-steps'
+    self.stoppingRule = None
+
+  def addChain(self, chunkPvalues, switchCounts, chenCounts, diffCounts):
+    """Merge the results of a Markov chain, as returned by
+    '_Gthwe.run_data_chain'."""
+    self.chains += 1
+    self.steps += len(chunkPvalues) * self.samplingSize
+    self.chunkPvalues.extend(chunkPvalues)
+    for i in range(3):
+      self.switchCounts[i] += switchCounts[i]
+    self._addStatisticCounts(chenCounts, diffCounts)
+
+  def addPermutations(self, iterations, extremeCount, chenCounts, diffCounts):
+    """Merge the results of a run of the Monte Carlo test, as
+    returned by '_Gthwe.run_randomization_counts'."""
+    self.steps += iterations
+    self.extremeCount += extremeCount
+    self._addStatisticCounts(chenCounts, diffCounts)
+
+  def _addStatisticCounts(self, chenCounts, diffCounts):
+    """*For internal use only.*"""
+    for statistic, counts in zip(self.statistics, [chenCounts, diffCounts]):
+      total = self.statisticCounts[statistic]
+      for i in range(len(total)):
+        total[i] += counts[i]
+
+  def getPvalue(self):
+    """Returns the overall p-value.
+
+    For the MCMC test, the mean of the p-values of all chunks."""
+    if self.monteCarlo:
+      if self.steps == 0:
+        return float('nan')
+      return float(self.extremeCount) / self.steps
+
+    if len(self.chunkPvalues) == 0:
+      return float('nan')
+    pMean = 0.0
+    for pvalue in self.chunkPvalues:
+      pMean += pvalue
+    return pMean / len(self.chunkPvalues)
+
+  def getStderr(self):
+    """Returns the standard error of the overall p-value.
+
+    For the MCMC test, from the variance between chunks, for the
+    Monte Carlo test, the binomial standard error."""
+    if self.monteCarlo:
+      if self.steps == 0:
+        return float('nan')
+      pvalue = self.getPvalue()
+      return sqrt(pvalue * (1.0 - pvalue) / self.steps)
+
+    group = len(self.chunkPvalues)
+    if group == 0:
+      return float('nan')
+    pMean = 0.0
+    pSquare = 0.0
+    for pvalue in self.chunkPvalues:
+      pMean += pvalue
+      pSquare += pvalue * pvalue
+    pMean /= group
+    if group < 2:
+      return float('nan')
+    variance = pSquare / float(group) / (group - 1.0) \
+               - pMean / (group - 1.0) * pMean
+    if variance < 0.0:
+      return float('nan')
+    return sqrt(variance)
+
+  def getStoppingStderr(self):
+    """Returns the standard error used by the adaptive stopping rules.
+
+    A p-value estimated as 0 or 1 has a standard error of 0, which
+    would stop the test after its first round.  So this is at least
+    the binomial standard error of the estimate (x + 1) / (n + 2),
+    with x extreme samples out of n, the permutations of the Monte
+    Carlo test or the chunks of the MCMC test."""
+    stderr = self.getStderr()
+    if np.isnan(stderr):
+      # too few samples to tell
+      return stderr
+    if self.monteCarlo:
+      n = self.steps
+    else:
+      n = len(self.chunkPvalues)
+    pvalue = (self.getPvalue() * n + 1.0) / (n + 2.0)
+    return max(stderr, sqrt(pvalue * (1.0 - pvalue) / (n + 2.0)))
+
+  def getState(self):
+    """Returns the parameters and counts of the run as a dictionary
+    of plain lists, strings and numbers, e.g. to store in a
+    'Cache.ResultCache'."""
+    state = {}
+    for name in ['k', 'monteCarlo', 'dememorizationSteps', 'samplingNum',
+                 'samplingSize', 'chains', 'steps', 'chunkPvalues',
+                 'switchCounts', 'extremeCount', 'statisticCounts',
+                 'stoppingRule']:
+      state[name] = getattr(self, name)
+    return state
+
+  def setState(self, state):
+    """Restore the parameters and counts returned by 'getState'.
+
+    The time of the original run is not part of the state: the
+    elapsed time is set to 0 and the timestamp to now."""
+    import time
+    for name, value in state.items():
+      setattr(self, name, value)
+    self.elapsedTime = 0
+    self.timestamp = time.ctime()
+
+  def getGenotypePvalues(self, statistic='chen_statistic'):
+    """Returns the list of per-genotype p-values for 'statistic', in
+    the order of the flattened lower-triangular genotype matrix."""
+    steps = float(self.steps)
+    return [count / steps for count in self.statisticCounts[statistic]]
+
+  def serializeTo(self, stream):
+    """Serialize the results, in the format originally printed by
+    the extension itself."""
+    if self.monteCarlo:
+      stream.write("<steps>%d</steps>\n" % self.steps)
+      if self.stoppingRule:
+        stream.write("<stoppingRule>%s</stoppingRule>\n" % self.stoppingRule)
+        stream.write("<pvalue type=\"overall\">%g</pvalue><stderr>%g</stderr>\n" % \
+                     (self.getPvalue(), self.getStderr()))
+      else:
+        stream.write("<pvalue type=\"overall\">%g</pvalue>\n" % self.getPvalue())
+    else:
+      # percentages of switches include the dememorization steps
+      totalSteps = float(self.chains * self.dememorizationSteps + self.steps)
+      if totalSteps == 0.0:
+        totalSteps = float('nan')
+      stream.write("<dememorizationSteps>%d</dememorizationSteps>\n" % \
+                   self.dememorizationSteps)
+      stream.write("<samplingNum>%d</samplingNum>\n" % self.samplingNum)
+      stream.write("<samplingSize>%d</samplingSize>\n" % self.samplingSize)
+      if self.chains > 1:
+        stream.write("<chains>%d</chains>\n" % self.chains)
+      if self.stoppingRule:
+        stream.write("<steps>%d</steps>\n" % self.steps)
+        stream.write("<stoppingRule>%s</stoppingRule>\n" % self.stoppingRule)
+      stream.write("<pvalue type=\"overall\">%7.4g</pvalue><stderr>%7.4g</stderr>\n" % \
+                   (self.getPvalue(), self.getStderr()))
+      stream.write("<switches>\n")
+      stream.write("<percent-partial>%6.2f</percent-partial>\n" % \
+                   (self.switchCounts[1] / totalSteps * 100))
+      stream.write("<percent-full>%6.2f</percent-full>\n" % \
+                   (self.switchCounts[2] / totalSteps * 100))
+      stream.write("<percent-all>%6.2f</percent-all>\n" % \
+                   ((self.switchCounts[1] + self.switchCounts[2]) / totalSteps * 100))
+      stream.write("</switches>\n")
+      stream.write("<elapsed-time>%d</elapsed-time>\n" % self.elapsedTime)
+      stream.write("<timestamp>%s\n</timestamp>\n" % self.timestamp)
+
+    for statistic in self.statistics:
+      pvalues = self.getGenotypePvalues(statistic)
+      for row in range(self.k):
+        for col in range(row + 1):
+          stream.write("<pvalue type=\"genotype\" statistic=\"%s\" row=\"%d\" col=\"%d\">%g</pvalue>\n" % \
+                       (statistic, row, col, pvalues[(row * (row + 1)) / 2 + col]))
 
 
 class HardyWeinbergEnumeration(HardyWeinbergGuoThompson):
@@ -898,56 +1667,217 @@ class HardyWeinbergEnumeration(HardyWeinbergGuoThompson):
 
   - 'doOverall': if set to true ('1'), then do overall p-value test
                  default is false ('0')
+
+  - 'timeLimit': if set, the maximum wall-clock time in seconds for
+    the enumeration (default 0, unlimited).  The enumeration is then
+    run in a separate process, and if it has not finished in time it
+    is stopped and the p-values are estimated instead with the plain
+    Monte Carlo test, using 'monteCarloSteps' permutations.
+
+  - 'numProcesses': number of processes the permutations of the
+    Monte Carlo fallback are split between (default 1).
+
+  With 'stderrTolerance' or 'alpha' set, the Monte Carlo fallback
+  stops early as the plain Monte Carlo test of
+  HardyWeinbergGuoThompson does, with each round split between the
+  processes.
+
+  The 'role' attribute of the output records which of the two
+  produced the p-values: 'enumeration' or 'monte-carlo'.
+
+  With a 'resultCache', exact results are reused whatever the
+  'timeLimit', Monte Carlo estimates only with the same fallback
+  parameters.
   """
   def __init__(self,
                locusData=None,
                alleleCount=None,
                doOverall=0,
+               timeLimit=0,
+               numProcesses=1,
                **kw):
     import _HweEnum
 
-    self.HweEnumProcess = _HweEnum
-    
     HardyWeinbergGuoThompson.__init__(self,
                                       locusData=locusData,
                                       alleleCount=alleleCount,
                                       **kw)
     self.doOverall = doOverall
+    self.timeLimit = timeLimit
+    self.numProcesses = numProcesses
     self.generateFlattenedMatrix()
 
-    self.HweEnumProcess.run_external(self.flattenedMatrix,
-                                     self.k,
-                                     self.doOverall)
+    enumeration = None
+    self.monteCarloResult = None
+    if self.resultCache:
+      exactKey = self.resultCache.makeKey('enumeration', self.flattenedMatrix,
+                                          (self.doOverall,))
+      fallbackKey = self.resultCache.makeKey('enumeration-monte-carlo',
+                                             self.flattenedMatrix,
+                                             (self.doOverall,
+                                              self.timeLimit,
+                                              self.monteCarloSteps,
+                                              self.numProcesses)
+                                             + self._adaptiveParameters())
+      enumeration = self.resultCache.get(exactKey)
+      if enumeration is None and self.timeLimit > 0:
+        state = self.resultCache.get(fallbackKey)
+        if state is not None:
+          self.monteCarloResult = GuoThompsonResult(self.k)
+          self.monteCarloResult.setState(state)
+
+    if enumeration is None and self.monteCarloResult is None:
+      if self.timeLimit > 0:
+        enumeration = self._runBoundedEnumeration()
+      else:
+        enumeration = _runEnumeration(self.flattenedMatrix,
+                                      self.k,
+                                      self.doOverall)
 
-    if self.doOverall:
-      self.exactPValue = self.HweEnumProcess.get_p_value()
-      self.observedPValue = self.HweEnumProcess.get_pr_observed()
-      self.diffPvals =  self.HweEnumProcess.get_diff_statistic_pvalue()
-      self.chenPvals =  self.HweEnumProcess.get_chen_statistic_pvalue()
+      if enumeration:
+        if self.resultCache:
+          self.resultCache.put(exactKey, enumeration)
+      else:
+        self.monteCarloResult = self._runMonteCarloFallback()
+        if self.resultCache:
+          self.resultCache.put(fallbackKey, self.monteCarloResult.getState())
+
+    if enumeration:
+      self.role = 'enumeration'
+      self.exactPValue, self.observedPValue, self.diffPvals, self.chenPvals = \
+                        enumeration
     else:
-      self.diffPvals =  self.HweEnumProcess.get_diff_statistic_pvalue_ext()
-      self.chenPvals =  self.HweEnumProcess.get_chen_statistic_pvalue_ext()
-      
+      self.role = 'monte-carlo'
+      self.exactPValue = self.monteCarloResult.getPvalue()
+      self.observedPValue = None
+      self.diffPvals = self.monteCarloResult.getGenotypePvalues('diff_statistic')
+      self.chenPvals = self.monteCarloResult.getGenotypePvalues('chen_statistic')
+
+  def _runBoundedEnumeration(self):
+    """Run the enumeration in a separate process for at most
+    'timeLimit' seconds.
+
+    Returns the results as for '_runEnumeration', or 'None' if the
+    time ran out (or the process died).
+
+    *For internal use only.*"""
+    import multiprocessing
+
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_sendEnumeration,
+                                      args=(sender, self.flattenedMatrix,
+                                            self.k, self.doOverall))
+    process.start()
+    sender.close()
+
+    enumeration = None
+    try:
+      if receiver.poll(self.timeLimit):
+        enumeration = receiver.recv()
+    except EOFError:
+      pass
+    if enumeration is None:
+      process.terminate()
+      if self.debug:
+        print "enumeration not finished within %g seconds, " \
+              "falling back to Monte Carlo" % self.timeLimit
+    process.join()
+    receiver.close()
+
+    return enumeration
+
+  def _runMonteCarloFallback(self):
+    """Estimate the p-values with the plain Monte Carlo test,
+    returns a GuoThompsonResult.
+
+    The 'monteCarloSteps' permutations are split as evenly as
+    possible between 'numProcesses' processes, each with its own
+    random seed (fixed in testing mode), and their results merged.
+    In adaptive mode this is repeated in rounds, as in
+    '_runMonteCarlo', until a stopping rule is satisfied or the
+    permutations are used up.
+
+    *For internal use only.*"""
+    import time
+
+    numProcesses = max(1, min(self.numProcesses, self.monteCarloSteps))
+    if numProcesses == 1:
+      return self._runMonteCarlo()
+
+    if self.testing:
+      seed = 1234
+    else:
+      seed = int(time.time())
+
+    if self._isAdaptive():
+      roundSteps = max(numProcesses,
+                       -(-self.monteCarloSteps / self.adaptiveRounds))
+    else:
+      roundSteps = self.monteCarloSteps
+
+    result = GuoThompsonResult(self.k, monteCarlo=1)
+
+    import multiprocessing
+    pool = multiprocessing.Pool(numProcesses)
+    try:
+      while result.steps < self.monteCarloSteps:
+        steps = min(roundSteps, self.monteCarloSteps - result.steps)
+        processes = min(numProcesses, steps)
+        tasks = []
+        for i in range(processes):
+          iterations = steps / processes
+          if i < steps % processes:
+            iterations += 1
+          tasks.append((self.flattenedMatrix, self.k, self.totalGametes,
+                        iterations, seed & 0x7fffffff))
+          seed += 1
+
+        results = pool.map(_runGthwePermutations, tasks)
+        for iterations, extremeCount, chenCounts, diffCounts in results:
+          result.addPermutations(iterations, extremeCount,
+                                 chenCounts, diffCounts)
+
+        if self._isAdaptive():
+          result.stoppingRule = self._stoppingRule(result)
+          if result.stoppingRule:
+            break
+      else:
+        if self._isAdaptive():
+          result.stoppingRule = 'max-steps'
+    finally:
+      pool.close()
+      pool.join()
+
+    return result
     
   def serializeTo(self, stream, allelelump=0):
     stream.opentag('hardyweinbergEnumeration',
-                   allelelump=("%d" % allelelump))
+                   allelelump=("%d" % allelelump),
+                   role=self.role)
 
     self.serializeXMLTableTo(stream)
     
     stream.writeln()
+    if self.role == 'monte-carlo':
+      stream.tagContents("steps", "%d" % self.monteCarloResult.steps)
+      stream.writeln()
+      if self.monteCarloResult.stoppingRule:
+        stream.tagContents("stoppingRule", self.monteCarloResult.stoppingRule)
+        stream.writeln()
     if self.doOverall:
       stream.tagContents("pvalue", "%f" % self.exactPValue, type="overall")
     else:
       stream.emptytag("pvalue", type="overall", role="not-calculated")
     stream.writeln()
-    if self.doOverall:
+    if self.doOverall and self.observedPValue is not None:
       stream.tagContents("pvalue", "%f" % self.observedPValue, type="observed")
     else:
       stream.emptytag("pvalue", type="observed", role="not-calculated")
     stream.writeln()
 
-    if self.doOverall:
+    if self.role == 'monte-carlo':
+      method="monte-carlo"
+    elif self.doOverall:
       method="full"
     else:
       method="three-by-three"
@@ -970,8 +1900,42 @@ class HardyWeinbergEnumeration(HardyWeinbergGuoThompson):
 
         stream.writeln()
     stream.closetag('hardyweinbergEnumeration')
-    self.HweEnumProcess.cleanup()
-    
+
+
+def _runEnumeration(genotypes, k, doOverall):
+  """Run the exact enumeration on the flattened genotype matrix.
+
+  Returns a tuple of the overall and observed p-values ('None' unless
+  'doOverall' is set) and the lists of per-genotype p-values for the
+  difference and Chen statistics.
+
+  *For internal use only.*"""
+  import _HweEnum
+
+  _HweEnum.run_external(genotypes, k, doOverall)
+
+  if doOverall:
+    exactPValue = _HweEnum.get_p_value()
+    observedPValue = _HweEnum.get_pr_observed()
+    diffPvals = list(_HweEnum.get_diff_statistic_pvalue())
+    chenPvals = list(_HweEnum.get_chen_statistic_pvalue())
+  else:
+    exactPValue = None
+    observedPValue = None
+    diffPvals = list(_HweEnum.get_diff_statistic_pvalue_ext())
+    chenPvals = list(_HweEnum.get_chen_statistic_pvalue_ext())
+
+  _HweEnum.cleanup()
+  return exactPValue, observedPValue, diffPvals, chenPvals
+
+def _sendEnumeration(connection, genotypes, k, doOverall):
+  """Run the enumeration in a worker process, and send the results
+  back through 'connection'.
+
+  *For internal use only.*"""
+  connection.send(_runEnumeration(genotypes, k, doOverall))
+  connection.close()
+
 class HardyWeinbergGuoThompsonArlequin:
   """Wrapper class for 'Arlequin'.
 
@@ -999,6 +1963,10 @@ class HardyWeinbergGuoThompsonArlequin:
   - 'markovChainDememorisationStepsHW': "Burn-in" time for Markov
   chain (default: 1000).
 
+  - 'resultCache': a 'Cache.ResultCache' instance, if set the
+  results are looked up there (by genotype counts) before running
+  Arlequin, and stored there afterwards (default: None).
+
   """
   def __init__(self,
                matrix=None,
@@ -1007,6 +1975,7 @@ class HardyWeinbergGuoThompsonArlequin:
                markovChainStepsHW = 100000,
                markovChainDememorisationStepsHW = 1000,
                untypedAllele='****',
+               resultCache=None,
                debug=None):
 
     self.matrix = matrix
@@ -1017,10 +1986,34 @@ class HardyWeinbergGuoThompsonArlequin:
     self.markovChainDememorisationStepsHW = markovChainDememorisationStepsHW
 
     self.untypedAllele = untypedAllele
+    self.resultCache = resultCache
     self.noDataFlag = 0
-    
+
+    typedRows = self.matrix.getTypedRows(self.locusName, self.untypedAllele)
+
+    if self.resultCache and len(typedRows) > 0:
+      # Arlequin only sees the genotype counts, key on these
+      genotypeCounts = {}
+      pairs = self.matrix[self.locusName]
+      for row in typedRows:
+        genotype = list(pairs[row])
+        genotype.sort()
+        genotype = tuple(genotype)
+        genotypeCounts[genotype] = genotypeCounts.get(genotype, 0) + 1
+      genotypes = genotypeCounts.keys()
+      genotypes.sort()
+      cacheKey = self.resultCache.makeKey('arlequin',
+                                          [genotypeCounts[genotype] \
+                                           for genotype in genotypes],
+                                          (tuple(genotypes),
+                                           self.markovChainStepsHW,
+                                           self.markovChainDememorisationStepsHW))
+      self.output = self.resultCache.get(cacheKey)
+      if self.output is not None:
+        return
+
     # if no data, don't run analysis
-    if len(self.matrix.filterOut(self.locusName, self.untypedAllele)) > 0:
+    if len(typedRows) > 0:
 
       arlequin = ArlequinExactHWTest(matrix = self.matrix,
                                      lociList = [self.locusName],
@@ -1034,6 +2027,8 @@ class HardyWeinbergGuoThompsonArlequin:
       
       self.output = arlequin.getHWExactTest()
       arlequin.cleanup()
+      if self.resultCache:
+        self.resultCache.put(cacheKey, self.output)
       
     else:
       self.noDataFlag = 1
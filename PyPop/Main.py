@@ -36,7 +36,7 @@
 """Python population genetics statistics.
 """
 
-import sys, os, string, time
+import sys, os, string, time, re, shutil, tempfile
 
 from ParseFile import ParseGenotypeFile, ParseAlleleCountFile
 from DataTypes import Genotypes, AlleleCounts, getLumpedDataLevels
@@ -45,9 +45,10 @@ from Haplo import Emhaplofreq, HaploArlequin, Haplostats
 from HardyWeinberg import HardyWeinberg, HardyWeinbergGuoThompson, HardyWeinbergGuoThompsonArlequin, HardyWeinbergEnumeration
 from Homozygosity import Homozygosity, HomozygosityEWSlatkinExact, HomozygosityEWSlatkinExactPairwise
 from ConfigParser import ConfigParser, NoOptionError, NoSectionError
-from Utils import XMLOutputStream, TextOutputStream, convertLineEndings, StringMatrix, checkXSLFile, getUserFilenameInput, unique_elements
+from Utils import XMLOutputStream, TextOutputStream, convertLineEndings, StringMatrix, MatrixHistory, checkXSLFile, getUserFilenameInput, unique_elements
 from Filter import PassThroughFilter, AnthonyNolanFilter, AlleleCountAnthonyNolanFilter, BinningFilter
 from RandomBinning import RandomBinsForHomozygosity
+from Cache import DataCache, ResultCache
 
 
 def getConfigInstance(configFilename = None,
@@ -276,8 +277,34 @@ class Main:
         ## add an empty unsequencedSite variable
         self.unsequencedSite = None
 
-        # BEGIN PARSE for a genotype file (ParseGenotypeFile)
+        # check whether loci should be analysed a few at a time
+        self.locusChunkSize = 0
+        residentLoci = None
         if self.fileType == "ParseGenotypeFile":
+            try:
+              self.locusChunkSize = self.config.getint(self.fileType, "locusChunkSize")
+            except NoOptionError:
+              self.locusChunkSize = 0
+            except ValueError:
+              sys.exit("require integer value")
+
+            if self.locusChunkSize:
+                residentLoci = self._getResidentLoci()
+
+        # check for a cache of previously parsed and filtered data
+        self.dataCache = None
+        cached = None
+        self._setupDataCache()
+        if self.dataCache:
+            cached = self.dataCache.load()
+
+        if cached:
+            # restore parsed and filtered data, skip parsing entirely
+            self.parsed, self.unsequencedSite, cachedFilterLog = cached
+            allowSemiTyped = 0
+
+        # BEGIN PARSE for a genotype file (ParseGenotypeFile)
+        elif self.fileType == "ParseGenotypeFile":
 
             try:
               popNameDesignator = self.config.get(self.fileType, "popNameDesignator")
@@ -290,6 +317,24 @@ class Main:
             except NoOptionError:
               fieldPairDesignator = '_1:_2'
 
+            try:
+              codedMatrix = self.config.getint(self.fileType, "codedMatrix")
+            except NoOptionError:
+              codedMatrix = 0
+            except ValueError:
+              sys.exit("require a 0 or 1 as a Boolean flag")
+
+            try:
+              readChunkSize = self.config.getint(self.fileType, "readChunkSize")
+            except NoOptionError:
+              readChunkSize = 0
+            except ValueError:
+              sys.exit("require integer value")
+
+            # each chunk of loci is read again from the file, so
+            # never hold the whole file in memory in this mode
+            if self.locusChunkSize and not readChunkSize:
+              readChunkSize = 10000
 
             # Generate the parse file object, which simply creates
             # a matrix (no allele count stuff done!)
@@ -300,6 +345,9 @@ class Main:
                                 untypedAllele=self.untypedAllele,
                                 popNameDesignator=popNameDesignator,
                                 fieldPairDesignator=fieldPairDesignator,
+                                codedMatrix=codedMatrix,
+                                readChunkSize=readChunkSize,
+                                residentLoci=residentLoci,
                                 debug=self.debug)
 
             # if we are dealing with data that is originally genotyped
@@ -330,8 +378,11 @@ class Main:
             sys.exit("Unrecognised file type")
 
         # we copy the parsed data to self.filtered, to be ready for
-        # the gamut of filters coming
-        self.matrixHistory = []
+        # the gamut of filters coming, each filter stage only keeps
+        # the columns it changes.  With cached data the only stage is
+        # the already filtered matrix: the data cache is disabled
+        # whenever an earlier stage is needed (see _setupDataCache)
+        self.matrixHistory = MatrixHistory()
         self.matrixHistory.append(self.parsed.getMatrix().copy())
 
         # figure out what filters we will be using, if any
@@ -361,11 +412,28 @@ class Main:
                 # filter in append mode
                 self.filterLogFile = XMLOutputStream(open(self.defaultFilterLogPath, 'w'))
                 self.filterLogFile.opentag('filterlog', filename=self.fileName)
-                self.filterLogFile.writeln()
                 self.filteringFlag = 1
 
-                # run the filtering gamut
-                self._runFilters()
+                if cached:
+                    # replay the log of the cached filtering run
+                    self.filterLogFile.write(cachedFilterLog)
+                else:
+                    self.filterLogFile.writeln()
+
+                    # run the filtering gamut
+                    self._runFilters()
+
+        # save parsed and filtered data for the next run
+        if self.dataCache and not cached:
+            if self.filteringFlag:
+                self.filterLogFile.flush()
+                logData = open(self.defaultFilterLogPath, 'r').read()
+                # strip the opening tag, which is regenerated
+                filterLog = logData[string.index(logData, '>') + 1:]
+            else:
+                filterLog = None
+            self.dataCache.save(self.parsed, self.matrixHistory[-1],
+                                self.unsequencedSite, filterLog)
 
         # now convert into DataType: and then we pass the filtered
         # matrix to be put in format for rest of processing
@@ -376,6 +444,9 @@ class Main:
                                allowSemiTyped=allowSemiTyped,
                                debug=self.debug)
 
+        # results of the exact HW tests may be shared between runs
+        self._setupResultCache()
+
         # BEGIN common XML output section
         
         # create XML stream
@@ -411,15 +482,20 @@ class Main:
         # serialize summary info for population in XML (common)
         self.parsed.serializeMetadataTo(self.xmlStream)
 
-        # serialize the specific information for kind of file
-        self.input.serializeSubclassMetadataTo(self.xmlStream)
-
-        # process the file depending on type
-        if self.fileType == "ParseAlleleCountFile" or \
-           self.fileType == "ParseGenotypeFile":
-            self._doGenotypeFile()
+        if self.locusChunkSize:
+            # the summary info covers all loci, so this also has to
+            # do the single-locus analyses first
+            self._doGenotypeFileByLocusChunks()
         else:
-            pass
+            # serialize the specific information for kind of file
+            self.input.serializeSubclassMetadataTo(self.xmlStream)
+
+            # process the file depending on type
+            if self.fileType == "ParseAlleleCountFile" or \
+               self.fileType == "ParseGenotypeFile":
+                self._doGenotypeFile()
+            else:
+                pass
 
         # now close the filter log file, if and only if we have done
         # some kind of filtering, moving it here, means that the open
@@ -431,6 +507,9 @@ class Main:
 
         # END common XML output section
 
+        if self.resultCache:
+            self.resultCache.save()
+
         # closing tag
         self.xmlStream.closetag('dataanalysis')
         # close XML stream
@@ -440,6 +519,136 @@ class Main:
         self._genTextOutput()
 
 
+    def _setupDataCache(self):
+        """Create a DataCache if [General] useDataCache is set.
+
+        The cache is only used for genotype files, and is disabled if
+        any of the intermediate matrices in the filtering gamut are
+        needed: i.e. random binning or the 'makeNewPopFile' dump."""
+        try:
+            useDataCache = self.config.getboolean("General", "useDataCache")
+        except NoOptionError:
+            useDataCache = 0
+        except ValueError:
+            sys.exit("require a 0 or 1 as a Boolean flag")
+
+        if not useDataCache:
+            return
+
+        if self.locusChunkSize:
+            print "LOG: data cache disabled: loci are analysed in chunks"
+            return
+        if self.fileType != "ParseGenotypeFile":
+            print "LOG: data cache is only supported for genotype files"
+            return
+        if self.config.has_section("RandomAlleleBinning") or \
+           (self.config.has_section("Filters") and \
+            self.config.has_option("Filters", "makeNewPopFile")):
+            print "LOG: data cache disabled: intermediate filter output required"
+            return
+
+        try:
+            cacheFileName = self.config.get("General", "dataCacheFilename")
+        except NoOptionError:
+            cacheFileName = None
+
+        # the sections that determine the parsed and filtered data
+        sections = [self.fileType, "Filters"]
+        if self.config.has_option("Filters", "filtersToApply"):
+            sections.extend(string.split(self.config.get("Filters", "filtersToApply"), ':'))
+
+        self.dataCache = DataCache(fileName=self.fileName,
+                                   cacheFileName=cacheFileName,
+                                   config=self.config,
+                                   sections=sections,
+                                   version=self.version,
+                                   debug=self.debug)
+
+    def _setupResultCache(self):
+        """Create a ResultCache if [General] resultCacheFilename is set."""
+        self.resultCache = None
+        try:
+            cacheFileName = self.config.get("General", "resultCacheFilename")
+        except NoOptionError:
+            cacheFileName = None
+
+        if not cacheFileName:
+            return
+
+        try:
+            maxEntries = self.config.getint("General", "resultCacheSize")
+        except NoOptionError:
+            maxEntries = 10000
+        except ValueError:
+            sys.exit("resultCacheSize: require integer value")
+
+        self.resultCache = ResultCache(cacheFileName=cacheFileName,
+                                       maxEntries=maxEntries,
+                                       version=self.version,
+                                       debug=self.debug)
+
+    def _getResidentLoci(self):
+        """Return the loci that locus-chunked mode keeps in memory.
+
+        These are the loci named in the multi-locus (haplotype and
+        LD) sections, all other loci are only read when their chunk
+        is analysed.  If all loci are needed, or the options are not
+        compatible with locus-chunked mode, 'locusChunkSize' is reset
+        to 0, and 'None' (all loci) is returned."""
+
+        if self.config.has_section("RandomAlleleBinning") or \
+           (self.config.has_section("Filters") and \
+            (self.config.has_option("Filters", "makeNewPopFile") or \
+             (self.config.has_option("Filters", "filtersToApply") and \
+              self.config.get("Filters", "filtersToApply")))):
+            print "LOG: locus-chunked mode disabled: filters need all loci"
+            self.locusChunkSize = 0
+            return None
+
+        allLoci = 0
+        groups = []
+
+        if self.config.has_section("HomozygosityEWSlatkinExactPairwise"):
+            allLoci = 1
+
+        if self.config.has_section("Haplostats"):
+            try:
+                if self.config.getboolean("Haplostats", "allPairwise"):
+                    allLoci = 1
+            except (NoOptionError, ValueError):
+                pass
+            try:
+                groups.append(self.config.get("Haplostats", "lociToEstHaplo"))
+            except NoOptionError:
+                # default is to use all loci
+                allLoci = 1
+
+        if self.config.has_section("Emhaplofreq"):
+            try:
+                if self.config.getboolean("Emhaplofreq", "allPairwiseLD"):
+                    allLoci = 1
+            except (NoOptionError, ValueError):
+                pass
+            for option in ["lociToEstHaplo", "lociToEstLD"]:
+                if self.config.has_option("Emhaplofreq", option):
+                    groups.append(self.config.get("Emhaplofreq", option))
+
+        residentLoci = []
+        for group in groups:
+            if string.strip(group) == '*':
+                allLoci = 1
+            for locus in re.split('[,:]', string.upper(group)):
+                locus = string.strip(locus)
+                if locus and locus not in residentLoci:
+                    residentLoci.append(locus)
+
+        if allLoci:
+            print "LOG: locus-chunked mode disabled: all loci needed for multi-locus analyses"
+            self.locusChunkSize = 0
+            return None
+
+        return residentLoci
+
     def _runFilters(self):
 
         if self.config.has_section("RandomAlleleBinning"):
@@ -606,7 +815,53 @@ class Main:
 
     def _doGenotypeFile(self):
 
-        loci = self.input.getLocusList()
+        self._doSingleLocusAnalyses(self.input.getLocusList())
+        self._doMultiLocusAnalyses()
+
+    def _doGenotypeFileByLocusChunks(self):
+        """Analyse the loci of a genotype file a chunk at a time.
+
+        Each chunk of 'locusChunkSize' loci is read from the file in
+        turn, and the single-locus analyses are run on just those
+        loci.  Only the loci needed by the multi-locus analyses are
+        kept in memory throughout (in 'self.input').  As the summary
+        info comes before the output for the loci, but depends on all
+        loci, the locus output is buffered in a temporary file."""
+
+        residentInput = self.input
+        xmlStream = self.xmlStream
+        self.xmlStream = XMLOutputStream(tempfile.TemporaryFile(mode='w+'))
+
+        loci = self.parsed.getLocusList()
+        lociWithData = 0
+        for start in range(0, len(loci), self.locusChunkSize):
+            chunkLoci = loci[start:start+self.locusChunkSize]
+            if self.debug:
+                print "LOG: analysing loci:", chunkLoci
+            self.input = Genotypes(matrix=self.parsed.getLocusMatrix(chunkLoci),
+                                   untypedAllele=self.untypedAllele,
+                                   unsequencedSite=self.unsequencedSite,
+                                   allowSemiTyped=0,
+                                   debug=self.debug)
+            lociWithData += self.input.totalLociWithData
+            self._doSingleLocusAnalyses(chunkLoci)
+
+        bufferFile = self.xmlStream.f
+        self.xmlStream = xmlStream
+        self.input = residentInput
+
+        # summary info is for all loci, not just the resident ones
+        self.input.totalLocusCount = len(loci)
+        self.input.totalLociWithData = lociWithData
+        self.input.serializeSubclassMetadataTo(self.xmlStream)
+
+        bufferFile.seek(0)
+        shutil.copyfileobj(bufferFile, self.xmlStream.f)
+        bufferFile.close()
+
+        self._doMultiLocusAnalyses()
+
+    def _doSingleLocusAnalyses(self, loci):
 
         for locus in loci:
 
@@ -745,6 +1000,32 @@ class Main:
             except ValueError:
               sys.exit("require integer value")
 
+            try:
+              numChains = self.config.getint("HardyWeinbergGuoThompson", "numChains")
+            except (NoOptionError, NoSectionError):
+              numChains=1
+            except ValueError:
+              sys.exit("require integer value")
+
+            # adaptive stopping applies to both tests, so can be set
+            # in either section
+            stderrTolerance=0.0
+            alpha=0.0
+            for section in ["HardyWeinbergGuoThompson",
+                            "HardyWeinbergGuoThompsonMonteCarlo"]:
+              try:
+                stderrTolerance = self.config.getfloat(section, "stderrTolerance")
+              except (NoOptionError, NoSectionError):
+                pass
+              except ValueError:
+                sys.exit("require float value")
+              try:
+                alpha = self.config.getfloat(section, "alpha")
+              except (NoOptionError, NoSectionError):
+                pass
+              except ValueError:
+                sys.exit("require float value")
+
             # Guo & Thompson implementation
             hwObject= HardyWeinbergGuoThompson(\
                 locusData=self.input.getLocusDataAt(locus), 
@@ -756,6 +1037,10 @@ class Main:
                 samplingSize=samplingSize,
                 maxMatrixSize=maxMatrixSize,
                 monteCarloSteps=monteCarloSteps,
+                numChains=numChains,
+                stderrTolerance=stderrTolerance,
+                alpha=alpha,
+                resultCache=self.resultCache,
                 debug=self.debug,
                 testing=self.testMode)
             
@@ -802,6 +1087,10 @@ class Main:
                                samplingSize=samplingSize,
                                maxMatrixSize=maxMatrixSize,
                                monteCarloSteps=monteCarloSteps,
+                               numChains=numChains,
+                               stderrTolerance=stderrTolerance,
+                               alpha=alpha,
+                               resultCache=self.resultCache,
                                debug=self.debug,
                                testing=self.testMode)
                         
@@ -829,12 +1118,42 @@ class Main:
                   doOverall=0
               except ValueError:
                   sys.exit("doOverall: requires 0 or 1 as a boolean flag")
+
+              # bound the enumeration, falling back to Monte Carlo
+              try:
+                  timeLimit = self.config.getfloat("HardyWeinbergEnumeration",
+                                                   "timeLimit")
+              except NoOptionError:
+                  timeLimit=0
+              except ValueError:
+                  sys.exit("timeLimit: require float value")
+
+              try:
+                  monteCarloSteps = self.config.getint("HardyWeinbergEnumeration",
+                                                       "monteCarloSteps")
+              except NoOptionError:
+                  monteCarloSteps=1000000
+              except ValueError:
+                  sys.exit("monteCarloSteps: require integer value")
+
+              try:
+                  numProcesses = self.config.getint("HardyWeinbergEnumeration",
+                                                    "numProcesses")
+              except NoOptionError:
+                  numProcesses=1
+              except ValueError:
+                  sys.exit("numProcesses: require integer value")
               
               hwEnum = HardyWeinbergEnumeration(\
                      locusData=self.input.getLocusDataAt(locus), 
                      alleleCount=self.input.getAlleleCountAt(locus),
                      doOverall=doOverall,
-                     debug=self.debug)
+                     timeLimit=timeLimit,
+                     monteCarloSteps=monteCarloSteps,
+                     numProcesses=numProcesses,
+                     resultCache=self.resultCache,
+                     debug=self.debug,
+                     testing=self.testMode)
 
               hwEnum.serializeTo(self.xmlStream)
 
@@ -853,7 +1172,12 @@ class Main:
                                     locusData=locusData,
                                     alleleCount=alleleData,
                                     doOverall=doOverall,
-                                    debug=self.debug)
+                                    timeLimit=timeLimit,
+                                    monteCarloSteps=monteCarloSteps,
+                                    numProcesses=numProcesses,
+                                    resultCache=self.resultCache,
+                                    debug=self.debug,
+                                    testing=self.testMode)
                       
                       # serialize HardyWeinberg
                       hwEnumLump.serializeTo(self.xmlStream, allelelump=level)
@@ -898,6 +1222,7 @@ class Main:
                                                         markovChainStepsHW,
                                                         markovChainDememorisationStepsHW=markovChainDememorisationStepsHW,
                                                         untypedAllele=self.untypedAllele,
+                                                        resultCache=self.resultCache,
                                                         debug=self.debug)
             hwArlequin.serializeTo(self.xmlStream)
 
@@ -1006,9 +1331,17 @@ class Main:
           self.xmlStream.writeln()
           
 
+    def _doMultiLocusAnalyses(self):
+
         # Do pairwise Ewens-Watterson test
         
         if self.config.has_section("HomozygosityEWSlatkinExactPairwise"):
+            try:
+              numReplicates=self.config.getint("HomozygosityEWSlatkinExact", \
+                                          "numReplicates")
+            except (NoOptionError, NoSectionError):
+              numReplicates=10000
+
             hz = HomozygosityEWSlatkinExactPairwise(\
                 matrix=self.input.getIndividualsData(),
                 numReplicates=numReplicates,
@@ -1057,8 +1390,16 @@ class Main:
                 # or if no option given, use wildcard, which assumes all loci
                 locusKeys='*'
 
+            try:
+                numProcesses = self.config.getint("Haplostats", "numProcesses")
+            except NoOptionError:
+                numProcesses=1
+            except ValueError:
+                sys.exit("numProcesses: require integer value")
+
             # do haplotype (and LD if two locus) estimation
-            haplostats.estHaplotypes(locusKeys=locusKeys, weight=None, control=control, numInitCond=numInitCond)
+            haplostats.estHaplotypes(locusKeys=locusKeys, weight=None, control=control, numInitCond=numInitCond,
+                                     numProcesses=numProcesses)
 
             try:
                 allPairwise = self.config.getboolean("Haplostats", "allPairwise")
@@ -1069,7 +1410,8 @@ class Main:
                 
             if allPairwise:
                 # do all pairwise statistics, which always includes LD
-                haplostats.allPairwise(weight=None, control=control, numInitCond=numInitCond)
+                haplostats.allPairwise(weight=None, control=control, numInitCond=numInitCond,
+                                       numProcesses=numProcesses)
 
             # serialize end to XML
             haplostats.serializeEnd()
@@ -1151,6 +1493,12 @@ at least 1000 is recommended.  A value of '1' is not permitted.""")
           except ValueError:
             sys.exit("permutationPrintFlag: option requires a 0 or 1 flag")
 
+          try:
+            numProcesses = self.config.getint("Emhaplofreq", "numProcesses")
+          except NoOptionError:
+            numProcesses=1
+          except ValueError:
+            sys.exit("numProcesses: option requires an integer")
 
           if allPairwiseLD:
             print "LOG: estimating all pairwise LD:",
@@ -1215,7 +1563,8 @@ at least 1000 is recommended.  A value of '1' is not permitted.""")
             haplo.estLinkageDisequilibrium(locusKeys=locusKeysLD,
                                            numInitCond=numInitCond,
                                            numPermutations=1001,
-                                           numPermuInitCond=numPermuInitCond)
+                                           numPermuInitCond=numPermuInitCond,
+                                           numProcesses=numProcesses)
             print "LOG: estimating LD for specific loci: [%s]" % locusKeysLD
 
           except NoOptionError:
@@ -1228,7 +1577,8 @@ at least 1000 is recommended.  A value of '1' is not permitted.""")
                               numPermutations=allPairwiseLDWithPermu,
                               numPermuInitCond=numPermuInitCond,
                               haploSuppressFlag=0,
-                              haplosToShow=twoLocusHaplosToShow)
+                              haplosToShow=twoLocusHaplosToShow,
+                              numProcesses=numProcesses)
 
           # serialize end to XML
           haplo.serializeEnd()
@@ -41,7 +41,7 @@
 
 import sys, os, string, types, re, operator
 
-from Utils import getStreamType, StringMatrix, OrderedDict, TextOutputStream
+from Utils import getStreamType, StringMatrix, CodedStringMatrix, OrderedDict, TextOutputStream
 
 class ParseFile:
     """*Abstract* class for parsing a datafile.
@@ -100,11 +100,6 @@ class ParseFile:
         self.popData = None
         self.sampleMap = None
     
-        # Reads and parses a given filename.
-
-        self._sampleFileRead(self.filename)
-
-
         if self.validPopFields == None:
             # skip parsing of metadata header
             self.sampleFirstLine = 1
@@ -112,6 +107,11 @@ class ParseFile:
             # parse metadata header
             self.sampleFirstLine = 3
 
+        # Reads and parses a given filename.
+
+        self._sampleFileRead(self.filename)
+
+        if self.validPopFields != None:
             # gets the .ini file information for metadata
             self.popFields = ParseFile._dbFieldsRead(self,self.validPopFields)
             if self.debug:
@@ -291,8 +291,21 @@ class ParseFile:
             print "sample header line: ", sampleHeaderLine
             print self.sampleMap
 
+        # save the number of fields expected on each sample line
+        self.sampleFieldCount = fieldCount
+
         # check file data to see that correct number of fields are
         # present for each sample
+        self._checkSampleLines()
+
+    def _checkSampleLines(self):
+        """Strips and validates each line of sample data.
+
+        Subclasses that tokenize the sample lines themselves may
+        override this and call '_checkFieldCount' as they go, so that
+        each line is only split once.
+
+        *For internal use only*."""
 
         for lineCount in range(self.sampleFirstLine, len(self.fileData)):
 
@@ -303,10 +316,16 @@ class ParseFile:
             self.fileData[lineCount] = line
             
             fields = string.split(line, self.separator)
-            if fieldCount != len(fields):
-                print "error: incorrect number of fields:", len(fields), \
-                      "found, should have:", fieldCount, \
-                      "\noffending line is:\n", line
+            self._checkFieldCount(fields, line)
+
+    def _checkFieldCount(self, fields, line):
+        """Complains if a tokenized line has the wrong number of fields.
+
+        *For internal use only*."""
+        if self.sampleFieldCount != len(fields):
+            print "error: incorrect number of fields:", len(fields), \
+                  "found, should have:", self.sampleFieldCount, \
+                  "\noffending line is:\n", line
 
 
     def getPopData(self):
@@ -378,6 +397,9 @@ class ParseGenotypeFile(ParseFile):
     def __init__(self,
                  filename,
                  untypedAllele='****',
+                 codedMatrix=0,
+                 readChunkSize=0,
+                 residentLoci=None,
                  **kw):
         """Constructor for ParseGenotypeFile.
 
@@ -388,8 +410,25 @@ class ParseGenotypeFile(ParseFile):
 
         - 'untypedAllele': The designator for an untyped locus.  Defaults
         to '****'.
+
+        - 'codedMatrix': If set to '1', store the alleles in an
+        integer-coded 'CodedStringMatrix' rather than a
+        'StringMatrix'.  Defaults to '0'.
+
+        - 'readChunkSize': If non-zero, don't hold the whole file in
+        memory, but stream the sample lines from disk and fill the
+        matrix this many lines at a time.  Defaults to '0' (read the
+        whole file at once).
+
+        - 'residentLoci': If set, a list of loci: only these loci
+        (plus the non-allele columns) are stored in the matrix, the
+        remaining loci can be read later with 'getLocusMatrix()'.
+        Defaults to 'None' (store all loci).
         """
         self.untypedAllele=untypedAllele
+        self.codedMatrix=codedMatrix
+        self.readChunkSize=readChunkSize
+        self.residentLoci=residentLoci
         
         ParseFile.__init__(self, filename, **kw)
 
@@ -434,11 +473,90 @@ class ParseGenotypeFile(ParseFile):
             self.popName = None
         else:
             # save population name
-            self.popName = string.split(self.fileData[self.sampleFirstLine], self.separator)[popNameCol]
+            firstLine = string.rstrip(self.fileData[self.sampleFirstLine])
+            self.popName = string.split(firstLine, self.separator)[popNameCol]
 
+    def _sampleFileRead(self, filename):
+        """Reads filename into object.
+
+        Overrides base class: if 'readChunkSize' is set, only the
+        header lines and the first line of sample data are kept in
+        'fileData', the remaining sample lines are only counted here
+        and are read later, chunk by chunk, in '_genDataStructures'.
+
+        *For internal use only*.
+        """
+        if not self.readChunkSize:
+            ParseFile._sampleFileRead(self, filename)
+            return
+
+        f = open(filename, 'r')
+        self.fileData = []
+        for lineCount in range(self.sampleFirstLine + 1):
+            line = f.readline()
+            if line == '':
+                break
+            self.fileData.append(line)
+        f.close()
+
+        # count lines in fixed-size blocks, without splitting them
+        lineCount = 0
+        lastChar = ''
+        f = open(filename, 'r')
+        while 1:
+            block = f.read(1048576)
+            if block == '':
+                break
+            lineCount += block.count('\n')
+            lastChar = block[-1]
+        f.close()
+        # final line may not have a newline
+        if lastChar not in ['', '\n']:
+            lineCount += 1
+
+        self.sampleLineCount = max(lineCount - self.sampleFirstLine, 0)
+
+    def _sampleLineChunks(self):
+        """Generates the sample lines as a sequence of lists.
+
+        If 'readChunkSize' is not set this is a single list of all
+        lines held in memory, otherwise the lines are read from the
+        file, at most 'readChunkSize' at a time.
+
+        *For internal use only*."""
+        if not self.readChunkSize:
+            sampleDataLines, separator = self.getFileData()
+            yield sampleDataLines
+            return
+
+        f = open(self.filename, 'r')
+        for lineCount in range(self.sampleFirstLine):
+            f.readline()
+        chunk = []
+        for line in f:
+            chunk.append(line)
+            if len(chunk) == self.readChunkSize:
+                yield chunk
+                chunk = []
+        f.close()
+        if len(chunk) > 0:
+            yield chunk
+
+    def _checkSampleLines(self):
+        """Overrides base class: defer validation of sample lines.
+
+        The number of fields on each line is checked in
+        '_genDataStructures', while each line is being tokenized.
+
+        *For internal use only.*"""
+        pass
 
     def _genDataStructures(self):
         """Generates matrix only
+
+        Each line of sample data is split exactly once, checked for
+        the correct number of fields, and then all allele and
+        non-allele columns are stored in the matrix in bulk.
         
         *For internal use only.*"""        
 
@@ -454,7 +572,10 @@ class ParseGenotypeFile(ParseFile):
 
 
         # then total number of individuals in data file
-        self.totalIndivCount = len(sampleDataLines)
+        if self.readChunkSize:
+            self.totalIndivCount = self.sampleLineCount
+        else:
+            self.totalIndivCount = len(sampleDataLines)
 
         # total number of loci contained in original file
         self.totalLocusCount = len(self.alleleMap)
@@ -465,58 +586,101 @@ class ParseGenotypeFile(ParseFile):
         # freeze list of non-allel data
         self.extraKeys = self.nonAlleleMap.keys()
 
-        # create an empty-list of lists to store all the row data
-        #self.individualsList = [[] for line in range(0, self.totalIndivCount)]
-        self.matrix = StringMatrix(self.totalIndivCount,
-                                   self.locusKeys,
-                                   self.extraKeys,
-                                   self.separator,
-                                   self.fileData[:self.sampleFirstLine-1])
+        if self.residentLoci is None:
+            loci = self.locusKeys
+        else:
+            loci = [locus for locus in self.locusKeys \
+                    if locus in self.residentLoci]
 
-        rowCount = 0
-        # store all the non-allele meta-data
-        for line in sampleDataLines:
-            fields = string.split(line, self.separator)
-            for key in self.nonAlleleMap.keys():
-                self.matrix[rowCount, key] = fields[self.nonAlleleMap[key]]
+        self.matrix = self._readMatrix(loci, checkFields=1)
 
-            rowCount += 1
+    def _readMatrix(self, loci, checkFields=0):
+        """Read the non-allele columns and the given loci into a matrix.
 
-        if self.debug:
-            print "before filling matrix with allele data"
-            print self.matrix
+        If 'checkFields' is set, the number of fields on each line is
+        validated as it is read.
 
-        for locus in self.locusKeys:
+        *For internal use only.*"""
+
+        # create an empty-list of lists to store all the row data
+        #self.individualsList = [[] for line in range(0, self.totalIndivCount)]
+        if self.codedMatrix:
+            matrixClass = CodedStringMatrix
+        else:
+            matrixClass = StringMatrix
+        matrix = matrixClass(self.totalIndivCount,
+                             loci,
+                             self.extraKeys,
+                             self.separator,
+                             self.fileData[:self.sampleFirstLine-1])
+
+        # the columns we want from each line: non-allele meta-data
+        # first, followed by both columns of each locus
+        wantedCols = [self.nonAlleleMap[key] for key in self.extraKeys]
+        for locus in loci:
             if self.debug:
                print "locus name:", locus
                print "column tuple:", self.alleleMap[locus]
-
             col1, col2 = self.alleleMap[locus]
+            wantedCols.extend([col1, col2])
+
+        if len(wantedCols) == 0:
+            return matrix
+        getFields = operator.itemgetter(*wantedCols)
+
+        if self.debug:
+            print "before filling matrix with allele data"
+            print matrix
 
-            # re-initialise the row count on each iteration of the locus
-            rowCount = 0
-            for line in sampleDataLines:
-                fields = string.split(line, self.separator)
+        startRow = 0
+        for chunk in self._sampleLineChunks():
+            self._storeSampleLines(matrix, loci, chunk, startRow,
+                                   getFields, len(wantedCols), checkFields)
+            startRow += len(chunk)
 
-                # create data structures
+        return matrix
 
-                allele1 = string.strip(fields[col1])
-                allele2 = string.strip(fields[col2])
+    def _storeSampleLines(self, matrix, loci, lines, startRow,
+                          getFields, wantedCount, checkFields):
+        """Tokenize lines and store them in the matrix from 'startRow'.
 
-                # underlying NumPy array data type won't allow storage
-                # of any sequence-type object (e.g. list or tuple) but
-                # we can workaround this by overriding the __setitem__
-                # method of the UserArray wrapper class used for
-                # subtyping and storing tuple internally as two
-                # separate columns in the underlying array.
+        *For internal use only.*"""
 
-                self.matrix[rowCount,locus] = (allele1, allele2)
-                
-                if self.debug:
-                    print rowCount, self.matrix[rowCount,locus]
+        # tokenize each line exactly once
+        rows = []
+        for line in lines:
+            line = string.rstrip(line)
+            fields = string.split(line, self.separator)
+            if checkFields:
+                self._checkFieldCount(fields, line)
+            rows.append(getFields(fields))
+
+        # transpose into one list per wanted column
+        if wantedCount == 1:
+            columns = [rows]
+        elif len(rows) > 0:
+            columns = zip(*rows)
+        else:
+            columns = [()] * wantedCount
+        del rows
 
-                # increment row count
-                rowCount += 1
+        pos = 0
+        # store all the non-allele meta-data
+        for key in self.extraKeys:
+            matrix.setColumn(key, columns[pos], startRow=startRow)
+            pos += 1
+
+        # underlying NumPy array data type won't allow storage of any
+        # sequence-type object (e.g. list or tuple) so each allele of
+        # the pair is stored as a separate column of the array
+        for locus in loci:
+            matrix.setColumn(locus,
+                             map(string.strip, columns[pos]),
+                             map(string.strip, columns[pos+1]),
+                             startRow=startRow)
+            if self.debug:
+                print locus, matrix[locus]
+            pos += 2
 
     def genValidKey(self, field, fieldList):
         """Check and validate key.
@@ -582,6 +746,24 @@ class ParseGenotypeFile(ParseFile):
         """
         return self.matrix
 
+    def getLocusList(self):
+        """Returns the list of all loci in the file, in file order.
+
+        Unlike the 'colList' of the matrix, this includes loci that
+        are not resident (see 'residentLoci')."""
+        return self.locusKeys[:]
+
+    def getLocusMatrix(self, loci):
+        """Returns a new matrix with just the given loci.
+
+        The sample lines are read again from the file, so that loci
+        that are not resident in memory can be processed a few at a
+        time.  The matrix also contains the non-allele columns."""
+        for locus in loci:
+            if not self.alleleMap.has_key(locus):
+                raise KeyError("can't find %s column" % locus)
+        return self._readMatrix(loci)
+
     def serializeSubclassMetadataTo(self, stream):
         """Serialize subclass-specific metadata."""
 
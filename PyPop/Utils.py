@@ -406,12 +406,51 @@ class StringMatrix(user_array.container):
       self.colSep = colSep
       self.headerLines = headerLines
 
+      # precomputed name -> array position lookups
+      self._genColumnIndex()
+
+      # cache of "typed" masks, see _getTypedMask()
+      self._typedMasks = {}
+
       # initialising the internal NumPy array
       self.array = zeros((self.rowCount, self.colCount*2+self.extraCount), dtype='O')
       self.shape = self.array.shape
       self._dtype = self.array.dtype
       self.name = string.split(str(self.__class__))[0]
 
+  def _genColumnIndex(self):
+      """Generate maps from column name to position in the array.
+
+      'colIndex' maps a locus name to the position of its first
+      allele column (the second is always the next column), and
+      'extraIndex' maps a non-allele column name to its position.
+      This avoids a linear search of 'colList' and 'extraList' on
+      every access."""
+      self.colIndex = {}
+      for i in range(self.colCount):
+          if not self.colIndex.has_key(self.colList[i]):
+              self.colIndex[self.colList[i]] = self.extraCount + i*2
+      self.extraIndex = {}
+      for i in range(self.extraCount):
+          if not self.extraIndex.has_key(self.extraList[i]):
+              self.extraIndex[self.extraList[i]] = i
+
+  def _getPositions(self, key):
+      """Translate a colon-separated key into array positions."""
+      li = []
+      for col in string.split(key, ":"):
+          # check first in list of alleles
+          if self.colIndex.has_key(col):
+              col1 = self.colIndex[col]
+              li.append(col1)
+              li.append(col1 + 1)
+          # now check in non-allele metadata
+          elif self.extraIndex.has_key(col):
+              li.append(self.extraIndex[col])
+          else:
+              raise KeyError("can't find %s column" % col)
+      return li
+
   def __repr__(self):
       """Override default representation.
 
@@ -490,8 +529,8 @@ class StringMatrix(user_array.container):
       several positions specified) of tuples for that position"""
       if type(key) == types.TupleType:
           row,colName= key
-          if colName in self.colList:
-              col = self.extraCount+self.colList.index(colName)
+          if self.colIndex.has_key(colName):
+              col = self.colIndex[colName]
           else:
               raise KeyError("can't find %s column" % colName)
           return self.array[(row,col)]
@@ -500,17 +539,15 @@ class StringMatrix(user_array.container):
           li = []
           for col in colNames:
               # check first in list of alleles
-              if col in self.colList:
-                  # get relative location in list
-                  relativeLoc = self.colList.index(col)
-                  # calculate real locations in array
-                  col1 = relativeLoc * 2 + self.extraCount
+              if self.colIndex.has_key(col):
+                  # real locations in array
+                  col1 = self.colIndex[col]
                   col2 = col1 + 1
                   li.append(col1)
                   li.append(col2)
               # now check in non-allele metadata
-              elif col in self.extraList:
-                  li.append(self.extraList.index(col))
+              elif self.extraIndex.has_key(col):
+                  li.append(self.extraIndex[col])
               else:
                   raise KeyError("can't find %s column" % col)
 
@@ -525,6 +562,31 @@ class StringMatrix(user_array.container):
       else:
           raise KeyError("keys must be a string or tuple")
 
+  def getColumnView(self, colName):
+      """Return a read-only NumPy view of a single column.
+
+      For a locus this is a (rowCount, 2) array with both alleles of
+      each individual, for a non-allele column a (rowCount,) array.
+      Unlike __getitem__, no copy of the data and no lists are made,
+      so this is the preferred way of reading a column that is only
+      going to be iterated over or examined with NumPy operations,
+      e.g.:
+
+      view = matrix.getColumnView('A')
+      for allele1, allele2 in zip(view[:,0], view[:,1]):
+          ...
+
+      """
+      if self.colIndex.has_key(colName):
+          col1 = self.colIndex[colName]
+          view = self.array[:, col1:col1+2]
+      elif self.extraIndex.has_key(colName):
+          view = self.array[:, self.extraIndex[colName]]
+      else:
+          raise KeyError("can't find %s column" % colName)
+      view.flags.writeable = False
+      return view
+
   def getNewStringMatrix(self, key):
       """Create an entirely new StringMatrix using only the columns supplied
       in the keys.
@@ -542,18 +604,16 @@ class StringMatrix(user_array.container):
           newExtraPos = []; newExtraList = []
           for col in colNames:
               # check first in list of alleles
-              if col in self.colList:
-                  # get relative location in list
-                  relativeLoc = self.colList.index(col)
-                  # calculate real locations in array
-                  col1 = relativeLoc * 2 + self.extraCount
+              if self.colIndex.has_key(col):
+                  # real locations in array
+                  col1 = self.colIndex[col]
                   col2 = col1 + 1
                   newColPos.append(col1)
                   newColPos.append(col2)
                   newColList.append(col)
               # now check in non-allele metadata
-              elif col in self.extraList:
-                  newExtraPos.append(self.extraList.index(col))
+              elif self.extraIndex.has_key(col):
+                  newExtraPos.append(self.extraIndex[col])
                   newExtraList.append(col)
               else:
                   raise KeyError("can't find %s column" % col)
@@ -588,26 +648,55 @@ class StringMatrix(user_array.container):
       else:
           raise ValueError("value being assigned is not a tuple")
 
-      if colName in self.colList:
-          # find the location in order in the array
-          col = self.colList.index(colName)
-          # calculate the offsets to the actual array location
-          col1 = col * 2
+      self._clearTypedMasks()
+
+      if self.colIndex.has_key(colName):
+          # find the location of the pair in the array
+          col1 = self.colIndex[colName]
           col2 = col1 + 1
           # store each element in turn
-          self.array[(row,col1+self.extraCount)] = asarray(value1,self._dtype)
-          self.array[(row,col2+self.extraCount)] = asarray(value2,self._dtype)
+          self.array[(row,col1)] = value1
+          self.array[(row,col2)] = value2
+
+      elif self.extraIndex.has_key(colName):
+          col = self.extraIndex[colName]
+          self.array[(row,col)] = value
+      else:
+          raise KeyError("can't find %s column" % colName)
+
+  def setColumn(self, colName, values1, values2=None, startRow=0):
+      """Assign a whole column in a single operation.
 
-      elif colName in self.extraList:
-          col = self.extraList.index(colName)
-          self.array[(row,col)] = asarray(value,self._dtype)
+      For a locus, 'values1' and 'values2' are sequences (one entry
+      per row) of the first and second allele, e.g.:
+
+      matrix.setColumn('A', ['01', '02'], ['03', '01'])
+
+      for a non-allele column only 'values1' is used.  If 'startRow'
+      is given, only the rows from 'startRow' onwards are assigned,
+      which allows a matrix to be filled in chunks."""
+      self._clearTypedMasks()
+
+      endRow = startRow + len(values1)
+      if self.colIndex.has_key(colName):
+          col1 = self.colIndex[colName]
+          self.array[startRow:endRow, col1] = _objectColumn(values1)
+          self.array[startRow:endRow, col1+1] = _objectColumn(values2)
+      elif self.extraIndex.has_key(colName):
+          col = self.extraIndex[colName]
+          self.array[startRow:endRow, col] = _objectColumn(values1)
       else:
-          raise KeyError("can't find %s column" % col)
+          raise KeyError("can't find %s column" % colName)
 
   def getUniqueAlleles(self, key):
       """
       Return a list of unique integers for given key sorted by allele name using natural sort
       """
+      if self.colIndex.has_key(key):
+          # a single locus can be done in one vectorized step
+          codes, uniqueAlleles = self._factorizeLocus(key)
+          return uniqueAlleles
+
       uniqueAlleles = []
       for genotype in self.__getitem__(key):
           for allele in genotype:
@@ -617,6 +706,34 @@ class StringMatrix(user_array.container):
       uniqueAlleles.sort(key=natural_sort_key) # natural sort
       return uniqueAlleles
 
+  def _factorizeLocus(self, locus):
+      """Factorize the alleles of a locus into integer codes.
+
+      Returns a 2-tuple consisting of a (rowCount, 2) array of codes,
+      starting at 1, and the list of allele names (as strings) in
+      natural sort order, so that code 'i' is allele 'labels[i-1]'.
+
+      *For internal use only.*"""
+      return _factorize(self.getColumnView(locus).astype(str))
+
+  def factorize(self):
+      """Factorize all loci into integer codes in a single pass.
+
+      Returns a 2-tuple: the genotype vector, flattened column by
+      column as in flattenCols(), and a list (one per locus) of the
+      allele names for each code.  This is equivalent to, but much
+      faster than, calling convertToInts().flattenCols() and
+      getUniqueAlleles() for each locus, and is the input needed by
+      haplo-stats."""
+      genoVec = []
+      alleleLabels = []
+      for locus in self.colList:
+          codes, labels = self._factorizeLocus(locus)
+          genoVec.extend(codes[:, 0].tolist())
+          genoVec.extend(codes[:, 1].tolist())
+          alleleLabels.append(labels)
+      return genoVec, alleleLabels
+
   def convertToInts(self):
       """
       Convert matrix to integers: needed for haplo-stats
@@ -627,15 +744,8 @@ class StringMatrix(user_array.container):
       # create a new copy
       newMatrix = self.copy()
       for colName in self.colList:
-          uniqueAlleles = self.getUniqueAlleles(colName)
-          row = 0
-          for genotype in self.__getitem__(colName):
-              factor_genotype = []
-              for allele in genotype:
-                  pos = uniqueAlleles.index(str(allele)) + 1
-                  factor_genotype.append(pos)
-              newMatrix[row, colName] = tuple(factor_genotype)
-              row += 1
+          codes, uniqueAlleles = self._factorizeLocus(colName)
+          newMatrix.setColumn(colName, codes[:, 0].tolist(), codes[:, 1].tolist())
 
       return newMatrix
 
@@ -650,11 +760,6 @@ class StringMatrix(user_array.container):
       FIXME: should these methods eventually be moved to Genotype class?
       """
 
-      # count number of unique alleles at each loci
-      n_alleles = {}
-      for colName in self.colList:
-          n_alleles[colName] = len(self.getUniqueAlleles(colName))
-
       # count pairs of haplotypes for subjects without any missing alleles
       # FIXME: maybe convert to it's own method as per getUniqueAlleles 
       h1 = self.array[:, 0::2]  # get "_1" allele (odd cols)
@@ -672,9 +777,7 @@ class StringMatrix(user_array.container):
       flattened_matrix = []
 
       for col in self.colList:  # FIXME: currently assume we want whole matrix
-          # FIXME: possibly refactor extracting column logic with __getitem__
-          relativeLoc = self.colList.index(col)
-          col1 = relativeLoc * 2 + self.extraCount
+          col1 = self.colIndex[col]
           col2 = col1 + 1
           first_col = [int(x) for x in self.array[:,col1]]
           flattened_matrix.extend(first_col)
@@ -688,13 +791,90 @@ class StringMatrix(user_array.container):
 
       When passed a designator, this method will return the rows of
       the matrix that *do not* contain that designator at any rows"""
-      def f(x, designator=blankDesignator):
-          for value in x:
-              if value == designator:
-                  return 0
-          return 1
+      positions = self._getPositions(key)
+      if len(string.split(key, ":")) == 1:
+          positions = positions[0:2]
+      rows = self.getTypedRows(key, blankDesignator)
+      return self.array[np.ix_(rows, positions)].tolist()
+
+  def getTypedCodes(self, key, blankDesignator):
+      """Returns the rows filterOut() would, as integer codes.
+
+      Returns a 2-tuple: a contiguous array of C ints with the same
+      rows and columns as filterOut(key, blankDesignator), holding
+      the position of each allele in the list of allele names of its
+      locus, and these lists (as strings), one per locus of the
+      colon-separated 'key'.  The names are in no particular order.
+
+      Only loci (not metadata columns) may be in 'key'."""
+      rows = self.getTypedRows(key, blankDesignator)
+      loci = string.split(key, ":")
+      codes = np.empty((len(rows), 2*len(loci)), dtype=np.intc)
+      alleleLabels = []
+      for i in range(len(loci)):
+          codes[:, 2*i:2*i + 2], labels = self._codeTypedLocus(loci[i], rows)
+          alleleLabels.append(labels)
+      return codes, alleleLabels
+
+  def _codeTypedLocus(self, locus, rows):
+      """Code the alleles of a locus in the given rows, for getTypedCodes.
+
+      *For internal use only.*"""
+      values = self.getColumnView(locus)[rows].astype(str)
+      labels, inverse = np.unique(values, return_inverse=True)
+      return inverse.reshape(values.shape), labels.tolist()
+
+  def getTypedRows(self, key, blankDesignator):
+      """Return the indices of the rows that are typed for a key.
+
+      A row is typed if it *does not* contain 'blankDesignator' in
+      any of the columns of the colon-separated 'key', i.e. these
+      are the rows that filterOut(key, blankDesignator) keeps.  The
+      result is a NumPy array of row indices.
+
+      This is computed from per-column masks that are cached on the
+      matrix until it is next modified, so that filtering many
+      different groups of the same loci (e.g. all pairs of loci)
+      does not rescan the matrix for every group."""
+      keep = np.ones(self.rowCount, dtype=bool)
+      for colName in string.split(key, ":"):
+          keep &= self._getTypedMask(colName, blankDesignator)
+      return np.nonzero(keep)[0]
+
+  def _getTypedMask(self, colName, blankDesignator):
+      """Return boolean mask of the rows typed for a single column.
+
+      Masks are computed on first use and cached until the next
+      __setitem__ or setColumn.  Writing to the matrix in any other
+      way, e.g. directly to 'StringMatrix.array', is unsupported: it
+      leaves stale masks behind.
+
+      *For internal use only.*"""
+      cacheKey = (colName, blankDesignator)
+      mask = self._typedMasks.get(cacheKey)
+      if mask is None:
+          mask = self._genTypedMask(colName, blankDesignator)
+          mask.flags.writeable = False
+          self._typedMasks[cacheKey] = mask
+      return mask
+
+  def _genTypedMask(self, colName, blankDesignator):
+      """Compute the mask returned by _getTypedMask.
+
+      *For internal use only.*"""
+      view = self.getColumnView(colName)
+      if view.ndim == 2:
+          return (view[:, 0] != blankDesignator) & \
+                 (view[:, 1] != blankDesignator)
+      else:
+          return view != blankDesignator
 
-      return (filter(f, self.__getitem__(key)))[:]
+  def _clearTypedMasks(self):
+      """Invalidate cached masks, must be called on any modification.
+
+      *For internal use only.*"""
+      if self._typedMasks:
+          self._typedMasks.clear()
 
   def getSuperType(self, key):
       """Returns a matrix grouped by columns.
@@ -722,8 +902,497 @@ class StringMatrix(user_array.container):
           pos += 1
 
       return newMatrix
-      
-      
+
+
+class CodedStringMatrix(StringMatrix):
+
+  """
+  CodedStringMatrix is a drop-in replacement for StringMatrix that
+  stores each allele column as compact integer codes rather than as
+  Python objects.
+
+  Each locus has its own allele-name dictionary: 'labelLists[locus]'
+  maps a code to the original allele name and 'labelMaps[locus]' maps
+  the name back to its code.  Code 0 is always reserved for the
+  integer 0, so that an unassigned cell behaves exactly as in the
+  zero-initialised StringMatrix.  Non-allele (metadata) columns are
+  kept as Python objects in 'extras'.
+
+  The __getitem__/__setitem__/getNewStringMatrix/dump API is
+  identical to StringMatrix, so downstream code sees the same lists
+  of allele names, while code that knows about the backend can use
+  getCodes() and getLabels() to read the integer codes directly.
+  """
+
+  def __init__(self,
+               rowCount=None,
+               colList=None,
+               extraList=None,
+               colSep='\t',
+               headerLines=None):
+      """Constructor for CodedStringMatrix.
+
+      Takes the same arguments as StringMatrix."""
+
+      self.colList = colList[:]
+
+      self.colCount = len(self.colList)
+      self.rowCount = rowCount
+
+      if extraList:
+          self.extraList = extraList[:]
+          self.extraCount = len(self.extraList)
+      else:
+          self.extraList = None
+          self.extraCount = 0
+
+      self.colSep = colSep
+      self.headerLines = headerLines
+
+      # precomputed name -> array position lookups
+      self._genColumnIndex()
+
+      # cache of "typed" masks, see _getTypedMask()
+      self._typedMasks = {}
+
+      # allele codes (two adjacent columns per locus) and metadata
+      self.codes = zeros((self.rowCount, self.colCount*2), dtype=np.int32)
+      self.extras = zeros((self.rowCount, self.extraCount), dtype='O')
+
+      # one allele-name dictionary per locus, code 0 is the "empty" 0
+      self.labelLists = {}
+      self.labelMaps = {}
+      for locus in self.colList:
+          self.labelLists[locus] = [0]
+          self.labelMaps[locus] = {0: 0}
+
+      self.shape = (self.rowCount, self.colCount*2+self.extraCount)
+      self._dtype = np.dtype('O')
+      self.name = string.split(str(self.__class__))[0]
+
+  def __setattr__(self, attr, value):
+      # bypass the user_array container, which would otherwise
+      # materialise the full object array on every attribute set
+      object.__setattr__(self, attr, value)
+
+  def _getArray(self):
+      """Decode the whole matrix into an object array.
+
+      Provided so that code written against StringMatrix.array keeps
+      working, but note that this builds a new array on each access."""
+      return self._decodeColumns(range(self.shape[1]))
+
+  array = property(_getArray)
+
+  def __len__(self):
+      return self.rowCount
+
+  def _locusOffset(self, colName):
+      """Return offset of first allele column of locus in 'codes'."""
+      return self.colIndex[colName] - self.extraCount
+
+  def _encode(self, locus, value):
+      """Return code for allele name at locus, adding it if new."""
+      labelMap = self.labelMaps[locus]
+      code = labelMap.get(value)
+      if code is None:
+          labels = self.labelLists[locus]
+          code = len(labels)
+          labels.append(value)
+          labelMap[value] = code
+      return code
+
+  def _decodeColumns(self, positions, rows=None):
+      """Decode the given array positions into an object array.
+
+      Positions are expressed in the same layout as StringMatrix, so
+      that metadata columns come first, followed by pairs of allele
+      columns."""
+      if rows is None:
+          rowCount = self.rowCount
+      else:
+          rowCount = len(rows)
+      decoded = np.empty((rowCount, len(positions)), dtype='O')
+      labelArrays = {}
+      for i in range(len(positions)):
+          pos = positions[i]
+          if pos < self.extraCount:
+              column = self.extras[:, pos]
+          else:
+              offset = pos - self.extraCount
+              locus = self.colList[offset / 2]
+              if not labelArrays.has_key(locus):
+                  labels = np.empty(len(self.labelLists[locus]), dtype='O')
+                  labels[:] = self.labelLists[locus]
+                  labelArrays[locus] = labels
+              column = labelArrays[locus][self.codes[:, offset]]
+          if rows is None:
+              decoded[:, i] = column
+          else:
+              decoded[:, i] = column[rows]
+      return decoded
+
+  def copy(self):
+      """Make a (deep) copy of the CodedStringMatrix"""
+      thecopy = CodedStringMatrix(self.rowCount,
+                                  self.colList,
+                                  self.extraList,
+                                  self.colSep,
+                                  self.headerLines)
+      thecopy.codes = self.codes.copy()
+      thecopy.extras = self.extras.copy()
+      for locus in self.colList:
+          thecopy.labelLists[locus] = self.labelLists[locus][:]
+          thecopy.labelMaps[locus] = self.labelMaps[locus].copy()
+      return thecopy
+
+  def __getitem__(self, key):
+      """Override built in.
+
+      Same semantics as StringMatrix.__getitem__, allele codes are
+      translated back into allele names."""
+      if type(key) == types.TupleType:
+          row, colName = key
+          if self.colIndex.has_key(colName):
+              code = self.codes[row, self._locusOffset(colName)]
+              return self.labelLists[colName][code]
+          else:
+              raise KeyError("can't find %s column" % colName)
+      elif type(key) == types.StringType:
+          li = self._getPositions(key)
+          if len(string.split(key, ":")) == 1:
+              li = li[0:2]
+          return self._decodeColumns(li).tolist()
+      else:
+          raise KeyError("keys must be a string or tuple")
+
+  def getNewStringMatrix(self, key):
+      """Create an entirely new CodedStringMatrix using only the
+      columns supplied in the keys.
+
+      The allele dictionaries of the selected loci are carried over,
+      so the codes are copied as-is without any re-encoding."""
+      newColList = []; newColPos = []
+      newExtraList = []; newExtraPos = []
+      for col in string.split(key, ":"):
+          if self.colIndex.has_key(col):
+              col1 = self._locusOffset(col)
+              newColPos.extend([col1, col1 + 1])
+              newColList.append(col)
+          elif self.extraIndex.has_key(col):
+              newExtraPos.append(self.extraIndex[col])
+              newExtraList.append(col)
+          else:
+              raise KeyError("can't find %s column" % col)
+
+      newMatrix = CodedStringMatrix(rowCount=self.rowCount,
+                                    colList=newColList,
+                                    extraList=newExtraList,
+                                    colSep=self.colSep,
+                                    headerLines=self.headerLines)
+      newMatrix.codes = self.codes[:, newColPos]
+      newMatrix.extras = self.extras[:, newExtraPos]
+      for locus in newColList:
+          newMatrix.labelLists[locus] = self.labelLists[locus][:]
+          newMatrix.labelMaps[locus] = self.labelMaps[locus].copy()
+      return newMatrix
+
+  def __setitem__(self, index, value):
+      """Override built in.
+
+      matrix[3, 'A'] = (entry1, entry2) stores the codes for the two
+      allele names, adding them to the locus dictionary if needed."""
+      if type(index) == types.TupleType:
+          row, colName = index
+      else:
+          raise IndexError("index is not a tuple")
+      if type(value) == types.TupleType:
+          value1, value2 = value
+      elif type(value) == types.StringType:
+          value = value
+      else:
+          raise ValueError("value being assigned is not a tuple")
+
+      self._clearTypedMasks()
+
+      if self.colIndex.has_key(colName):
+          col1 = self._locusOffset(colName)
+          self.codes[row, col1] = self._encode(colName, value1)
+          self.codes[row, col1 + 1] = self._encode(colName, value2)
+      elif self.extraIndex.has_key(colName):
+          self.extras[row, self.extraIndex[colName]] = value
+      else:
+          raise KeyError("can't find %s column" % colName)
+
+  def _encodeColumn(self, locus, values):
+      """Return array of codes for a sequence of allele names.
+
+      New allele names are added to the locus dictionary in order
+      of first appearance, as if assigned one cell at a time."""
+      values = _objectColumn(values)
+      if len(values) == 0:
+          return zeros(0, dtype=np.int32)
+      uniqueValues, firstSeen, inverse = np.unique(values,
+                                                   return_index=True,
+                                                   return_inverse=True)
+      lookup = zeros(len(uniqueValues), dtype=np.int32)
+      for i in np.argsort(firstSeen, kind='mergesort'):
+          lookup[i] = self._encode(locus, uniqueValues[i])
+      return lookup[inverse]
+
+  def setColumn(self, colName, values1, values2=None, startRow=0):
+      """Assign a whole column in a single operation.
+
+      Same semantics as StringMatrix.setColumn, the allele names of
+      the whole locus are encoded at once."""
+      self._clearTypedMasks()
+
+      endRow = startRow + len(values1)
+      if self.colIndex.has_key(colName):
+          col1 = self._locusOffset(colName)
+          # interleave so that codes are allocated in row order
+          pairs = np.empty((endRow - startRow, 2), dtype='O')
+          pairs[:, 0] = _objectColumn(values1)
+          pairs[:, 1] = _objectColumn(values2)
+          self.codes[startRow:endRow, col1:col1 + 2] = \
+                        self._encodeColumn(colName, pairs.ravel()).reshape(-1, 2)
+      elif self.extraIndex.has_key(colName):
+          self.extras[startRow:endRow, self.extraIndex[colName]] = \
+                                       _objectColumn(values1)
+      else:
+          raise KeyError("can't find %s column" % colName)
+
+  def getColumnView(self, colName):
+      """Return a read-only array of a single column.
+
+      Same shape and contents as StringMatrix.getColumnView, but as
+      the alleles have to be decoded from their codes, the result is
+      a new array rather than a view.  Use getCodes() to read the
+      underlying integer codes without any copy."""
+      if self.colIndex.has_key(colName):
+          col1 = self.colIndex[colName]
+          column = self._decodeColumns([col1, col1 + 1])
+      elif self.extraIndex.has_key(colName):
+          column = self.extras[:, self.extraIndex[colName]]
+      else:
+          raise KeyError("can't find %s column" % colName)
+      column.flags.writeable = False
+      return column
+
+  def getCodes(self, locus):
+      """Return the (rowCount, 2) array of allele codes for locus.
+
+      The array is a read-only view of the internal storage, *not* a
+      copy.  Use __setitem__ or setColumn to change alleles, so that
+      the cache of typed masks (see getTypedRows) stays valid."""
+      codes = self._getWritableCodes(locus)
+      codes.flags.writeable = False
+      return codes
+
+  def _getWritableCodes(self, locus):
+      """Return a writable view of the allele codes for locus.
+
+      For code that replaces the codes of a locus together with its
+      allele dictionary.  Any cached typed masks are discarded first.
+
+      *For internal use only.*"""
+      self._clearTypedMasks()
+      col1 = self._locusOffset(locus)
+      return self.codes[:, col1:col1 + 2]
+
+  def getLabels(self, locus):
+      """Return list of allele names for locus, indexed by code."""
+      return self.labelLists[locus]
+
+  def _factorizeLocus(self, locus):
+      """Factorize the alleles of a locus, see StringMatrix._factorizeLocus.
+
+      Only the distinct codes actually present are converted to
+      strings, rather than every cell.
+
+      *For internal use only.*"""
+      labels = self.labelLists[locus]
+      usedCodes, inverse = np.unique(self.getCodes(locus), return_inverse=True)
+      usedLabels = np.array([str(labels[code]) for code in usedCodes], dtype=str)
+      return _factorize(usedLabels[inverse].reshape(self.rowCount, 2))
+
+  def convertToInts(self):
+      """
+      Convert matrix to integers: needed for haplo-stats
+
+      Same numbering as StringMatrix.convertToInts, but done by
+      remapping the codes of each locus in a single step.
+      """
+      newMatrix = self.copy()
+      for colName in self.colList:
+          codes, uniqueAlleles = self._factorizeLocus(colName)
+          newMatrix._getWritableCodes(colName)[:] = codes
+          # the new codes *are* the integers
+          newMatrix.labelLists[colName] = range(len(uniqueAlleles) + 1)
+          newMatrix.labelMaps[colName] = dict([(i, i) for i in \
+                                               range(len(uniqueAlleles) + 1)])
+      return newMatrix
+
+  def countPairs(self):
+      """Given a matrix of genotypes compute number of possible pairs
+      of haplotypes for each subject, see StringMatrix.countPairs.
+
+      Codes are unique per locus, so comparing them is equivalent to
+      comparing the allele names."""
+      h1 = self.codes[:, 0::2]
+      h2 = self.codes[:, 1::2]
+      n_het = np.sum(np.not_equal(h1, h2), 1)
+      n_het = np.where(n_het == 0, 1, n_het)
+      n_pairs = 2 ** (n_het - 1)
+
+      return n_pairs.tolist()
+
+  def flattenCols(self):
+      """Flatten columns into a single list
+      FIXME: assumes entries are integers
+      """
+      flattened_matrix = []
+
+      for col in self.colList:
+          labels = self.labelLists[col]
+          block = self.getCodes(col)
+          lookup = np.zeros(len(labels), dtype=int)
+          for code in np.unique(block):
+              lookup[code] = int(labels[code])
+          flattened_matrix.extend(lookup[block[:, 0]].tolist())
+          flattened_matrix.extend(lookup[block[:, 1]].tolist())
+
+      return flattened_matrix
+
+  def filterOut(self, key, blankDesignator):
+      """Returns a filtered matrix.
+
+      When passed a designator, this method will return the rows of
+      the matrix that *do not* contain that designator at any rows"""
+      positions = self._getPositions(key)
+      if len(string.split(key, ":")) == 1:
+          positions = positions[0:2]
+      rows = self.getTypedRows(key, blankDesignator)
+      return self._decodeColumns(positions, rows).tolist()
+
+  def _codeTypedLocus(self, locus, rows):
+      """Code the alleles of a locus in the given rows, for getTypedCodes.
+
+      The stored codes are renumbered, so only the names of the
+      alleles actually present are converted to strings.
+
+      *For internal use only.*"""
+      labels = self.labelLists[locus]
+      usedCodes, inverse = np.unique(self.getCodes(locus)[rows],
+                                     return_inverse=True)
+      return inverse.reshape(len(rows), 2), \
+             [str(labels[code]) for code in usedCodes]
+
+  def _genTypedMask(self, colName, blankDesignator):
+      """Compute the typed mask from the codes, without decoding.
+
+      *For internal use only.*"""
+      if self.colIndex.has_key(colName):
+          code = self.labelMaps[colName].get(blankDesignator)
+          if code is None:
+              return np.ones(self.rowCount, dtype=bool)
+          codes = self.getCodes(colName)
+          return (codes[:, 0] != code) & (codes[:, 1] != code)
+      elif self.extraIndex.has_key(colName):
+          return self.extras[:, self.extraIndex[colName]] != blankDesignator
+      else:
+          raise KeyError("can't find %s column" % colName)
+
+
+class MatrixHistory:
+
+  """
+  MatrixHistory keeps every stage of a matrix as it passes through
+  the filters, e.g.:
+
+  history = MatrixHistory()
+  history.append(parsedMatrix)
+  history.append(filter.doDigitBinning(history[-1].copy()))
+  originalMatrix = history[0]
+
+  Only the most recent stage is held in full.  For each earlier
+  stage just the columns that the following stage changed are kept
+  (a reverse diff), all other columns are shared with the later
+  stages.  Earlier stages are rebuilt on demand.  If a stage has a
+  different layout from the next one (e.g. after the Sequence
+  filter) it is kept in full instead.
+  """
+
+  def __init__(self):
+      # for each earlier stage, either a dictionary of the old
+      # values of the columns changed by the next stage, or a full
+      # matrix
+      self._reverse = []
+      self._latest = None
+      # most recently rebuilt earlier stage, as (stage, matrix)
+      self._rebuilt = None
+
+  def __len__(self):
+      if self._latest is None:
+          return 0
+      return len(self._reverse) + 1
+
+  def __repr__(self):
+      return repr([self[i] for i in range(len(self))])
+
+  def append(self, matrix):
+      """Add a new stage, which becomes history[-1]."""
+      prev = self._latest
+      if prev is not None:
+          if _sameLayout(prev, matrix):
+              changed = {}
+              for colName in prev.colIndex.keys() + prev.extraIndex.keys():
+                  oldColumn = prev.getColumnView(colName)
+                  if not np.array_equal(oldColumn, matrix.getColumnView(colName)):
+                      changed[colName] = np.array(oldColumn)
+              self._reverse.append(changed)
+          else:
+              self._reverse.append(prev)
+      self._latest = matrix
+
+  def __getitem__(self, stage):
+      """Return the matrix at 'stage', negative indices are allowed.
+
+      The most recent stage (and any stage kept in full) is the very
+      matrix that was appended, earlier stages are rebuilt from it."""
+      count = len(self)
+      if stage < 0:
+          stage += count
+      if stage < 0 or stage >= count:
+          raise IndexError("matrix history index out of range")
+
+      if stage == count - 1:
+          return self._latest
+      if self._rebuilt and self._rebuilt[0] == stage:
+          return self._rebuilt[1]
+
+      matrix = self._latest
+      owned = 0
+      for i in range(count - 2, stage - 1, -1):
+          changed = self._reverse[i]
+          if isinstance(changed, StringMatrix):
+              matrix = changed
+              owned = 0
+          elif changed:
+              # don't modify a matrix that belongs to another stage
+              if not owned:
+                  matrix = matrix.copy()
+                  owned = 1
+              for colName, column in changed.items():
+                  if column.ndim == 2:
+                      matrix.setColumn(colName, column[:, 0], column[:, 1])
+                  else:
+                      matrix.setColumn(colName, column)
+
+      if owned:
+          self._rebuilt = (stage, matrix)
+      return matrix
+
 class Group:
   # group a list or sequence by a given size
   # example usage:
@@ -742,6 +1411,38 @@ class Group:
 
 ### global FUNCTIONS start here
 
+def _sameLayout(matrix1, matrix2):
+    """Whether two matrices have the same class, rows and columns."""
+    return matrix1.__class__ is matrix2.__class__ and \
+           matrix1.rowCount == matrix2.rowCount and \
+           matrix1.colList == matrix2.colList and \
+           matrix1.extraList == matrix2.extraList
+
+def _factorize(values):
+    """Factorize an array of allele names (strings) into integer codes.
+
+    Codes start at 1 and follow the natural sort order of the names;
+    names that sort equal are ordered by their first appearance in
+    'values' (row by row), exactly as StringMatrix.getUniqueAlleles
+    has always done.  Returns the array of codes (same shape as
+    'values') and the list of names."""
+    uniqueValues, firstSeen, inverse = np.unique(values.ravel(),
+                                                 return_index=True,
+                                                 return_inverse=True)
+    order = sorted(range(len(uniqueValues)),
+                   key=lambda i: (natural_sort_key(uniqueValues[i]), firstSeen[i]))
+    labels = [str(uniqueValues[i]) for i in order]
+    lookup = zeros(len(uniqueValues), dtype=int)
+    lookup[order] = np.arange(1, len(uniqueValues) + 1)
+    return lookup[inverse].reshape(values.shape), labels
+
+def _objectColumn(values):
+    """Convert a sequence into a 1-d object array, without letting
+    NumPy split up any string or sequence elements."""
+    column = np.empty(len(values), dtype='O')
+    column[:] = list(values)
+    return column
+
 def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
     return [int(text) if text.isdigit() else text.lower()
             for text in re.split(_nsre, s)]
@@ -106,6 +106,78 @@ MODIFICATIONS. */
   free(($ltype) $1);
 }
 
+/* Convert a Python list of lists of strings into a C array of
+   strings, one row after another, without copying the strings */
+%typemap(in) char **InMatrix {
+  if (PyList_Check($input)) {
+    int size0 = PyList_Size($input);
+    int size1 = 0;
+    int n = 0;
+    int i = 0;
+    int j = 0;
+
+    for (i = 0; i < size0; i++) {
+      PyObject *o = PyList_GetItem($input, i);
+      if (!PyList_Check(o)) {
+	PyErr_SetString(PyExc_TypeError, 
+			"inner array must be a list");
+	return NULL;
+      }
+      size1 += PyList_Size(o);
+    }
+    $1 = (char **)malloc((size1+1)*sizeof(char *));
+    if ($1 != NULL) {
+      for (i = 0; i < size0; i++) {
+	PyObject *o = PyList_GetItem($input, i);
+	for (j = 0; j < PyList_Size(o); j++) {
+	  PyObject *p = PyList_GetItem(o, j);
+	  if (PyString_Check(p)) {
+	    $1[n++] = PyString_AsString(p);
+	  }
+	  else {
+	    PyErr_SetString(PyExc_TypeError, 
+			    "list must contain strings");
+	    free($1);
+	    return NULL;
+	  }
+	}
+      }
+      $1[n] = NULL;
+    } else {
+      fprintf(stderr,"Malloc of memory failed\n");
+      exit(-1);
+    }
+  } else {
+    PyErr_SetString(PyExc_TypeError, 
+		    "outer array must be a list");
+    return NULL;
+  }
+}
+
+/* This cleans up the array of strings we malloc'd before the function
+   call, the strings themselves belong to Python */
+%typemap(freearg) char **InMatrix {
+  free($1);
+}
+
+/* Pass the contents of any object with a buffer of C ints (such as a
+   NumPy array of dtype intc) directly to C, without copying */
+%typemap(in) int *InBuffer {
+  const void *buffer;
+  Py_ssize_t buffer_len;
+  if (PyObject_AsReadBuffer($input, &buffer, &buffer_len) < 0) {
+    PyErr_SetString(PyExc_TypeError, 
+		    "array must support the buffer interface");
+    return NULL;
+  }
+  if (buffer_len % sizeof(int) != 0) {
+    PyErr_SetString(PyExc_TypeError, 
+		    "array must contain C ints");
+    return NULL;
+  }
+  $1 = (int *)buffer;
+}
+
 /* Typemap to convert python file type(s) to C file pointer */
 %typemap(in) FILE * {
   PycString_IMPORT;
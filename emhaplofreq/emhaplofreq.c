@@ -40,6 +40,27 @@ MODIFICATIONS. */
 
 #include "emhaplofreq.h"
 
+/* 
+ * table of the distinct phenotypes, genotypes or haplotypes, each a
+ * fixed number ('key_len') of integers, numbered in the order they
+ * are first added.  the keys are stored one after the other, so the
+ * ith key starts at 'keys + i * key_len', and are found by hashing
+ */
+typedef struct {
+  int key_len;
+  int n_keys;
+  int keys_size;  /* number of keys there is room for */
+  int *keys;
+  int n_slots;    /* a power of two, more than twice n_keys */
+  int *slots;     /* key number + 1 for each slot, 0 if empty */
+} key_table;
+
+/* a haplotype frequency and its position before sorting */
+typedef struct {
+  double freq;
+  int index;
+} freq_index;
+
 /***************** begin: function prototypes ***************************/
 
 void print_usage(void);
@@ -48,28 +69,87 @@ FILE *parse_args(int, char **, int *);
 /* argc, argv */
 /* returns open filehandle of input file */
 
-int read_infile(FILE *, char [MAX_ROWS][NAME_LEN], char [MAX_ROWS][MAX_COLS][NAME_LEN], int *, char [1], char [1]);
+int read_infile(FILE *, char ***, char ***, int *);
 /* open filehandle for data, ref array, data array, number of records */
-/* returns number of loci */
+/* returns number of loci, the arrays are allocated as they are read */
 
-int main_proc(FILE *, char (*)[MAX_COLS][NAME_LEN], int, int, int, int, int, int, int, int, int, char [1], char [1]);
+int main_proc(FILE *, char **, int, int, int, int, int, int, int, int, int);
 /* data array, number of loci, number of records */
+
 /* main procedure that handles memory allocation and creation of arrays, 
   * spawns the rest of the data preparation and processing functions, 
   * performs the EM calculation, and prints out the results. 
   * we only return from it to exit. 
 */
 
-int count_unique_haplos(char (*)[2][LINE_LEN / 2], char (*)[LINE_LEN / 2], int (*)[MAX_LOCI], char (*)[MAX_ALLELES][NAME_LEN], int *, int, int, int (*)[2], int *, char [1], char [1]);
-/* geno, haplo, haplocus, unique_allele, n_unique_allele, n_unique_geno, n_loci, xgeno, xhaplo */
-/* returns number of haplotypes */
+int main_proc_batch(FILE *, char **, int, int, int, int, int, int, int, int, int, int *, int *, int, double *, int, int *);
+/* as main_proc, with the permutation test, but running a single
+ * batch of permutations from the given seed: the likelihood ratios
+ * and error flags of the observed data and each permutation are
+ * returned instead of the permutation summary, so that batches run
+ * in separate processes can be merged by the caller (see
+ * permu_summary).  if 'skip_observed' is set, the observed data is
+ * not fitted: only its likelihood under no LD is computed, as the
+ * permutations need it */
+
+int permu_summary(FILE *, int, int, int, int, double *, int *);
+/* no. of likelihood ratios, number of records, df of LR test, print flag, 
+   likelihood ratios, error flags */
+/* 
+  * prints the permutation summary that main_proc prints, from the
+  * likelihood ratios and error flags of the observed data followed by
+  * each permutation, as merged from the batches of main_proc_batch
+*/
+
+int main_proc_coded(FILE *, int *, char **, int *, int, int, int, int, int, int, int, int, int);
+/* allele codes, allele names, no. of names for each locus, then as main_proc */
+/* 
+  * as main_proc, but with the alleles of each record given as codes:
+  * the position of the allele's name among the names of its locus
+*/
+
+int main_proc_batch_coded(FILE *, int *, char **, int *, int, int, int, int, int, int, int, int, int, int *, int *, int, double *, int, int *);
+/* allele codes, allele names, no. of names for each locus, then as main_proc_batch */
+/* 
+  * as main_proc_batch, with the alleles given as for main_proc_coded
+*/
+
+static int run_main_proc(FILE *, int *, char **, int *, int, int, int, int, int, int, int, int, int, int, int, int, int *, int *, int, double *, int, int *);
+/* the work of main_proc and main_proc_batch, on integer-coded alleles */
+
+static void print_permu_summary(FILE *, FILE *, int, int, int, int, double *, int *);
+/* as permu_summary, with separate output for the summary and the
+   likelihood ratios */
+
+int compare_names(const void *, const void *);
+/* qsort() comparison of pointers to allele names */
+
+int compare_name_refs(const void *, const void *);
+/* qsort() comparison of pointers to pointers to allele names */
+
+void code_alleles(char **, int, int, int *, char **, int *);
+/* data array, no. of loci, no. of records, allele codes, allele names, no. of alleles */
+/* 
+  * numbers the distinct alleles at each locus, in the order of their
+  * names, as required by run_main_proc
+*/
+
+void recode_alleles(int *, char **, int *, int, int, int *, char **, int *);
+/* allele codes, allele names, no. of names for each locus, no. of loci, no. of records, new allele codes, new allele names, no. of alleles */
+/* 
+  * renumbers the alleles given to main_proc_coded in the order of
+  * their names, as required by run_main_proc
+*/
+
+int build_genotypes(int *, int, int *);
+/* phenotype, no. of loci, genotypes */
+/* returns number of genotypes */
 /* 
-  * creates array of possible haplotypes from array of possibly observed genotypes 
-  * create haplocus[i][j]: a 2-dim array of allele# at jth locus of ith haplotype
+  * creates the possible genotypes of a phenotype, as pairs of haplotypes
 */
 
-void id_unique_alleles(char (*)[MAX_COLS][NAME_LEN], char (*)[MAX_ALLELES][NAME_LEN], int *, double (*)[MAX_ALLELES], int, int);
-/* data array, unique_allele array, no. of unique alleles array, allele_freq, no. of loci, no. of records */
+void id_unique_alleles(int *, int *, char **, int *, char **, int *, double *, int, int);
+/* data array, allele offsets, allele names, allele_index, unique_allele array, no. of unique alleles array, allele_freq, no. of loci, no. of records */
 /* 
   * creates array of alleles unique to each locus 
   * Creates allele_freq[i][j]:  freq for jth allele at the ith locus 
@@ -80,41 +160,38 @@ double min(double, double);
   * return minimum argument
 */
 
-void linkage_diseq(FILE *, double *, int (*)[MAX_LOCI], double (*)[MAX_ALLELES],
-		   char (*)[MAX_ALLELES][NAME_LEN], int *, int, int, int); 
-/* mle, haplocus, allele_freq, unique_allele, n_unique_allele, n_loci, n_haplo, n_recs */
+void linkage_diseq(FILE *, double *, int *, double *,
+		   char **, int *, int *, int, int, int); 
+/* mle, haplocus, allele_freq, unique_allele, n_unique_allele, allele offsets, n_loci, n_haplo, n_recs */
 /*
   * compute LD coefficients
 */
 
-void sort2bychar(char (*)[], double *, int);
-/* haplo array, mle array, no. of haplotypes */
-/*
-  * insertion sort in ascending order for 1st array also applied to 2nd array
-*/
+int compare_freqs(const void *, const void *);
+/* qsort() comparison of freq_index structs */
 
-void sort2byfloat(char (*)[], double *, int);
+void sort2byfloat(int *, double *, int);
 /* haplo array, mle array, no. of haplotypes */
 /*
-  * insertion sort in ascending order for 2nd array also applied to 1st array
+  * stable sort in descending order for 2nd array also applied to 1st array
 */
 
 void emcalc(int *, int *, double *, double *, int, int, int, int, 
-       int *, int (*)[], int *, int *, double *, double *, int, int (*)[]);
+       int *, int (*)[2], int *, int *, double *, double *, int, int *, int *);
 /* numgeno, obspheno, freq_zero, mle, n_haplo, n_unique_geno, 
-   n_unique_pheno, n_recs, xhaplo, xgeno, error_flag, iter_count, loglike, permu, gp */
+   n_unique_pheno, n_recs, xhaplo, xgeno, error_flag, iter_count, loglike, permu, gp_start, gp */
 /*
   * perform EM iterations with results in the mle array
 */
 
-void haplo_freqs_no_ld(double *, double (*)[], int (*)[], int *, int, int);
-/* freqs, allele_freq, haplocus, n_unique_allele, n_loci, n_haplo */
+void haplo_freqs_no_ld(double *, double *, int *, int *, int, int);
+/* freqs, allele_freq, haplocus, allele offsets, n_loci, n_haplo */
 /*
   * compute haplotype frequencies under no LD as products of allele frequencies 
 */
 
-double loglikelihood(int *, double *, int *, int, int, int, int *, int (*)[], int, int (*)[]);
-/* numgeno, hap_freq, n_haplo, n_unique_geno, n_unique_pheno, xhaplo, xgeno, permu, gp */
+double loglikelihood(int *, double *, int *, int, int, int, int *, int (*)[2], int, int *, int *);
+/* numgeno, hap_freq, n_haplo, n_unique_geno, n_unique_pheno, xhaplo, xgeno, permu, gp_start, gp */
 /*
   * compute log likelihood for a given set of haplotype frequencies
 */
@@ -123,19 +200,46 @@ void srand48(long int seedval);
 
 double drand48(void);
 
-void permute_alleles(char (*)[MAX_COLS][NAME_LEN], int, int);
+void permute_alleles(int *, int, int);
 /* data array, number of loci, number of records */
 /* 
   * permutes the alleles at all but the last locus
 */
 
+int compare_ints(const void *, const void *);
+/* qsort() comparison of ints */
+
+void *xrealloc(void *, size_t);
+/* pointer, new size in bytes */
+/*
+  * realloc that exits if no memory is left
+*/
+
+unsigned int table_hash(int *, int);
+/* key, no. of integers per key */
+
+void table_init(key_table *, int);
+/* table, no. of integers per key */
+
+void table_clear(key_table *);
+/* table */
+/*
+  * removes all keys, but keeps the memory for reuse
+*/
+
+int table_add(key_table *, int *, int *);
+/* table, key, set to TRUE if the key is new */
+/* returns number of the key */
+
+void table_free(key_table *);
+/* table */
+
 /******************* end: function prototypes ****************************/
 
 int main(int argc, char **argv)
 {
   FILE *if_handle, *fp_out;
-  char ref[MAX_ROWS][NAME_LEN];
-  char data[MAX_ROWS][MAX_COLS][NAME_LEN];
+  char **ref, **data;
   int num_loci, num_recs;
   int ret_val;
 
@@ -208,7 +312,7 @@ int main(int argc, char **argv)
   /* set output to stdout by default */
   fp_out = stdout;
 
-  num_loci = read_infile(if_handle, ref, data, &num_recs, "~", "|");
+  num_loci = read_infile(if_handle, &ref, &data, &num_recs);
   fprintf(fp_out, "num_loci: %d\n", num_loci);
   fprintf(fp_out, "Sample Size (n): %d\n", num_recs);
   if (num_loci > MAX_LOCI) 
@@ -223,7 +327,7 @@ int main(int argc, char **argv)
      add getopt-parsed options for them */
   ret_val = main_proc(fp_out, data, num_loci, num_recs, permu_flag, 
 		      suppress_haplo_print_flag, MAX_INIT, MAX_PERMU, 
-		      MAX_INIT_FOR_PERMU, 1, 0, "~", "|");
+		      MAX_INIT_FOR_PERMU, 1, 0);
 
   return (ret_val);
 }
@@ -249,8 +353,8 @@ void print_usage(void)
 
 /************************************************************************/
 
-int read_infile(FILE * in_file, char (*reference_ar)[NAME_LEN],
-		char (*data_ar)[MAX_COLS][NAME_LEN], int *records, char GENOTYPE_SEPARATOR[1], char GENOTYPE_TERMINATOR[1])
+int read_infile(FILE * in_file, char ***reference_ar, char ***data_ar,
+		int *records)
 {
   /* first line is ignored--should be labels or comments */
   /* subsequent lines contain an identifying label of up to 10 characters */
@@ -258,25 +362,33 @@ int read_infile(FILE * in_file, char (*reference_ar)[NAME_LEN],
 
   /* we'd like to return the number of loci and the number of lines */
 
-  int i, j, num_cols;
+  int i, j, num_cols, max_rows;
   char buff[LINE_LEN];
   char *buff_ptr;
+  char **ref, **data;
 
   fgets(buff, LINE_LEN, in_file);  /* eat the first line */
 
   /* read the second line and store it, ascertaining the number of loci */
   num_cols = i = 0;
+  max_rows = 64;
 
   fgets(buff, LINE_LEN, in_file);
 
+  ref = (char **)xrealloc(NULL, max_rows * sizeof(char *));
+  data = (char **)xrealloc(NULL, (LINE_LEN / 2) * sizeof(char *));
+
   buff_ptr = strtok(buff, "\t \n");
-  strcpy(reference_ar[i], buff_ptr);
+  ref[i] = strdup(buff_ptr);
 
+  /* each allele is followed by the separator '~' (see main_proc) */
   while ((buff_ptr = strtok(NULL, "\t \n")) != NULL)
   {
-    strcpy(data_ar[i][num_cols], buff_ptr);
-    strcat(data_ar[i][num_cols++], GENOTYPE_SEPARATOR);
+    data[num_cols] = (char *)xrealloc(NULL, strlen(buff_ptr) + 2);
+    strcpy(data[num_cols], buff_ptr);
+    strcat(data[num_cols++], "~");
   }
+  data = (char **)xrealloc(data, max_rows * num_cols * sizeof(char *));
 
   /* now read the rest */
   while ((fgets(buff, LINE_LEN, in_file)) != NULL)
@@ -284,24 +396,28 @@ int read_infile(FILE * in_file, char (*reference_ar)[NAME_LEN],
     if (strlen(buff) < 2)
       continue;      /* quietly bypass empty lines */
 
+    /* make room for more lines of data */
+    if (++i == max_rows)
+    {
+      max_rows *= 2;
+      ref = (char **)xrealloc(ref, max_rows * sizeof(char *));
+      data = (char **)xrealloc(data, max_rows * num_cols * sizeof(char *));
+    }
+
     buff_ptr = strtok(buff, "\t \n");
-    strcpy(reference_ar[++i], buff_ptr);
+    ref[i] = strdup(buff_ptr);
 
     for (j = 0; j < num_cols; j++)
     {
       buff_ptr = strtok(NULL, "\t \n");
-      strcpy(data_ar[i][j], buff_ptr);
-      strcat(data_ar[i][j], GENOTYPE_SEPARATOR);
-    }
-    /* check value of i is not greater than MAX_ROWS */
-    if(!(i < MAX_ROWS))
-    {
-      fprintf(stderr, "The number of lines of data exceeds %d\n", MAX_ROWS);
-      fprintf(stderr, "Unable to continue\n\n");
-      exit(EXIT_FAILURE);
+      data[i * num_cols + j] = (char *)xrealloc(NULL, strlen(buff_ptr) + 2);
+      strcpy(data[i * num_cols + j], buff_ptr);
+      strcat(data[i * num_cols + j], "~");
     }
   }
   *records = i + 1;
+  *reference_ar = ref;
+  *data_ar = data;
 
   fclose(in_file);
   return (num_cols / 2);  /* this being the number of loci */
@@ -309,66 +425,212 @@ int read_infile(FILE * in_file, char (*reference_ar)[NAME_LEN],
 
 /************************************************************************/
 
-int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci, 
+int main_proc(FILE * fp_out, char **data_ar, int n_loci, 
 	      int n_recs, int permu_flag, int suppress_haplo_print_flag, 
 	      int max_init_cond, int max_permu, int max_init_for_permu, 
-	      int permu_print, int testing, char GENOTYPE_SEPARATOR[1], char GENOTYPE_TERMINATOR[1])
+	      int permu_print, int testing)
+{
+  int ret_val;
+
+  CALLOC_ARRAY_DIM1(int, codes, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(char *, allele_label, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(int, n_allele, n_loci);
+
+  code_alleles(data_ar, n_loci, n_recs, codes, allele_label, n_allele);
+
+  ret_val = run_main_proc(fp_out, codes, allele_label, n_allele, n_loci,
+			  n_recs, permu_flag, suppress_haplo_print_flag,
+			  max_init_cond, max_permu, max_init_for_permu,
+			  permu_print, testing, 0, 1, 0, NULL, NULL, 0, NULL, 0, NULL);
+
+  free(codes);
+  free(allele_label);
+  free(n_allele);
+
+  return (ret_val);
+}
+
+/************************************************************************/
+
+int main_proc_batch(FILE * fp_out, char **data_ar, int n_loci, 
+		    int n_recs, int suppress_haplo_print_flag, 
+		    int max_init_cond, int max_permu, int max_init_for_permu, 
+		    int testing, int seed, int skip_observed, 
+		    int *ok_perm0, int *df_LRtest,
+		    int like_ratio_len, double *like_ratio,
+		    int error_flag_len, int *error_flag)
+{
+  int ret_val;
+
+  CALLOC_ARRAY_DIM1(int, codes, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(char *, allele_label, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(int, n_allele, n_loci);
+
+  code_alleles(data_ar, n_loci, n_recs, codes, allele_label, n_allele);
+
+  ret_val = run_main_proc(fp_out, codes, allele_label, n_allele, n_loci,
+			  n_recs, 1, suppress_haplo_print_flag,
+			  max_init_cond, max_permu, max_init_for_permu,
+			  0, testing, seed, 0, skip_observed, ok_perm0, df_LRtest,
+			  like_ratio_len, like_ratio, error_flag_len, error_flag);
+
+  free(codes);
+  free(allele_label);
+  free(n_allele);
+
+  return (ret_val);
+}
+
+/************************************************************************/
+
+int main_proc_coded(FILE * fp_out, int *data_ar, char **labels, 
+		    int *n_labels, int n_loci, int n_recs, int permu_flag, 
+		    int suppress_haplo_print_flag, int max_init_cond, 
+		    int max_permu, int max_init_for_permu, int permu_print, 
+		    int testing)
+{
+  int ret_val;
+
+  CALLOC_ARRAY_DIM1(int, codes, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(char *, allele_label, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(int, n_allele, n_loci);
+
+  recode_alleles(data_ar, labels, n_labels, n_loci, n_recs, codes, 
+		 allele_label, n_allele);
+
+  ret_val = run_main_proc(fp_out, codes, allele_label, n_allele, n_loci,
+			  n_recs, permu_flag, suppress_haplo_print_flag,
+			  max_init_cond, max_permu, max_init_for_permu,
+			  permu_print, testing, 0, 1, 0, NULL, NULL, 0, NULL, 0, NULL);
+
+  free(codes);
+  free(allele_label);
+  free(n_allele);
+
+  return (ret_val);
+}
+
+/************************************************************************/
+
+int main_proc_batch_coded(FILE * fp_out, int *data_ar, char **labels, 
+			  int *n_labels, int n_loci, int n_recs, 
+			  int suppress_haplo_print_flag, int max_init_cond, 
+			  int max_permu, int max_init_for_permu, int testing, 
+			  int seed, int skip_observed, int *ok_perm0, int *df_LRtest,
+			  int like_ratio_len, double *like_ratio,
+			  int error_flag_len, int *error_flag)
+{
+  int ret_val;
+
+  CALLOC_ARRAY_DIM1(int, codes, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(char *, allele_label, n_recs * 2 * n_loci);
+  CALLOC_ARRAY_DIM1(int, n_allele, n_loci);
+
+  recode_alleles(data_ar, labels, n_labels, n_loci, n_recs, codes, 
+		 allele_label, n_allele);
+
+  ret_val = run_main_proc(fp_out, codes, allele_label, n_allele, n_loci,
+			  n_recs, 1, suppress_haplo_print_flag,
+			  max_init_cond, max_permu, max_init_for_permu,
+			  0, testing, seed, 0, skip_observed, ok_perm0, df_LRtest,
+			  like_ratio_len, like_ratio, error_flag_len, error_flag);
+
+  free(codes);
+  free(allele_label);
+  free(n_allele);
+
+  return (ret_val);
+}
+
+/************************************************************************/
+
+int permu_summary(FILE * fp_out, int n_permu, int n_recs, int df_LRtest, 
+		  int permu_print, double *like_ratio, int *error_flag)
+{
+  print_permu_summary(fp_out, fp_out, n_permu, n_recs, df_LRtest, 
+		      permu_print, like_ratio, error_flag);
+
+  return (EXIT_SUCCESS);
+}
+
+/************************************************************************/
+
+/* 
+ * 'data_ar' holds the 2 * 'n_loci' alleles of each of the 'n_recs'
+ * records, the alleles of each locus numbered from 0 in the order
+ * strcmp() sorts their names.  the names of the 'n_allele[0]' alleles
+ * of the first locus are 'allele_label[0]' onwards, followed by those
+ * of the second locus, and so on.  each name ends with a separator
+ * character, which is dropped from the end of haplotype names.
+ * 'data_ar' is modified.
+ *
+ * if 'seed' is nonzero, it seeds drand48 instead of the usual fixed
+ * (testing) or time-based seed.  the permutation summary is only
+ * output if 'summary_flag' is set.  if 'skip_observed' is set, the
+ * observed data is not fitted, nor 'ok_perm0' set, for a batch of
+ * permutations that is only after their likelihood ratios.  if any of
+ * the remaining pointers
+ * are non-NULL, the results for the observed data and permutations
+ * are copied there: the arrays must have room for 'max_permu'
+ * entries.
+ */
+static int run_main_proc(FILE * fp_out, int *data_ar, char **allele_label,
+			 int *n_allele, int n_loci, int n_recs, int permu_flag,
+			 int suppress_haplo_print_flag, int max_init_cond,
+			 int max_permu, int max_init_for_permu, int permu_print,
+			 int testing, int seed, int summary_flag,
+			 int skip_observed, int *ok_perm0_out, int *df_LRtest_out,
+			 int like_ratio_len, double *like_ratio_out,
+			 int error_flag_len, int *error_flag_out)
 {
 
   
   /******************* begin: declarations ****************************/
   int i, j, obs, locus, col_0, col_1 = 0;
-  int unique_pheno_flag, unique_geno_flag = 0;
-
-  CALLOC_ARRAY_DIM1(char, buff, NAME_LEN);
+  int n_cols = 2 * n_loci;
+  int *row, buff, new_flag = 0;
 
-  /* heterozygous sites through current and previous locus loop */
-  int n_hetero, n_hetero_prev = 0;  
+  int n_geno, n_gp, max_gp = 0, max_xgeno = 0;  
+  int n_unique_pheno, n_unique_geno = 0;
 
-  /* distinct genotypes through current and previous locus loop */
-  int n_geno, n_geno_prev = 0;  
-  int unique_pheno_count, n_unique_pheno, unique_geno_count, n_unique_geno = 0;
+  /* distinct phenotypes (the ordered alleles of a record), genotypes
+     (pairs of haplotype numbers, lower first) and haplotypes */
+  key_table pheno_table, geno_table, haplo_table;
+  int geno_key[2];
 
-  /* needed for checking, but not currently used*/
-  /* int count = 0;      
-     double temp = 0.0; */
+  /* genotypes of the current phenotype, as pairs of haplotypes */
+  int max_temp_geno = 1;
+  int *temp_geno = (int *)xrealloc(NULL, 2 * n_loci * sizeof(int));
 
-  /* these should be calloc'ed, but the stack will experience
-     meltdown: we initialize them with macro call after declarations
-     for re-entrancy */ 
-  static char geno[MAX_GENOS][2][LINE_LEN / 2];
-  static int gp[MAX_GENOS_PER_PHENO][MAX_ROWS];
-  /* gp[] stores the genotype-phenotype relationships, removed unused genopheno[] */
-  /* the 1st dimension was changed from MAX_GENOS to MAX_GENOS_PER_PHENO          */
-
-  CALLOC_ARRAY_DIM2(char, pheno, MAX_ROWS, LINE_LEN);
-  CALLOC_ARRAY_DIM3(char, temp_geno, MAX_GENOS_PER_PHENO, 2, LINE_LEN / 2);
-  CALLOC_ARRAY_DIM1(int, numgeno, MAX_ROWS);
-  CALLOC_ARRAY_DIM1(int, obspheno, MAX_ROWS);
-  CALLOC_ARRAY_DIM1(char, temp_pheno, LINE_LEN);
+  /* gp[] stores the genotype-phenotype relationships: the genotypes
+     of the ith phenotype are gp[gp_start[i]] onwards */
+  int *gp = NULL;
+  CALLOC_ARRAY_DIM1(int, gp_start, n_recs);
+  CALLOC_ARRAY_DIM1(int, numgeno, n_recs);
+  CALLOC_ARRAY_DIM1(int, obspheno, n_recs);
 
   /* needed for the count_unique_haplotypes function */
   int n_haplo = 0;
   
-  /* RS changed to MAX_HAPLOS from 2*MAX_ROWS */
-  CALLOC_ARRAY_DIM2(char, haplo, MAX_HAPLOS, LINE_LEN / 2);
-
-  /* needed for the count_unique_haplotypes and allele_frequencies functions */
-  CALLOC_ARRAY_DIM2(int, haplocus, MAX_HAPLOS, MAX_LOCI);
-  CALLOC_ARRAY_DIM1(int, xhaplo, MAX_HAPLOS);
-  CALLOC_ARRAY_DIM2(int, xgeno, MAX_GENOS, 2);
+  /* the haplotypes as allele numbers of id_unique_alleles, order of
+     haplotypes when printed and the space for the longest name */
+  int *haplocus = NULL, *xhaplo = NULL, *haplo_order = NULL;
+  int (*xgeno)[2] = NULL;
+  int name_len = 1;
+  char *haplo_name;
 
   /* needed for the id_unique_alleles function */
 
-  CALLOC_ARRAY_DIM3(char, unique_allele, MAX_LOCI, MAX_ALLELES, NAME_LEN);
-  CALLOC_ARRAY_DIM1(int, n_unique_allele, MAX_LOCI);
-  CALLOC_ARRAY_DIM2(double, allele_freq, MAX_LOCI, MAX_ALLELES);
+  CALLOC_ARRAY_DIM1(int, allele_offset, n_loci);
+  CALLOC_ARRAY_DIM1(int, allele_index, n_recs * n_cols);
+  CALLOC_ARRAY_DIM1(char *, unique_allele, n_recs * n_cols);
+  CALLOC_ARRAY_DIM1(int, n_unique_allele, n_loci);
+  CALLOC_ARRAY_DIM1(double, allele_freq, n_recs * n_cols);
 
-  /* nothing needed for sort2bychar or sort2byfloat functions */
+  /* nothing needed for sort2byfloat function */
 
   /* needed for the emcalc function */
-  CALLOC_ARRAY_DIM1(double, mle, MAX_HAPLOS);
-  CALLOC_ARRAY_DIM1(double, freq_zero, MAX_HAPLOS);
+  double *mle = NULL, *freq_zero = NULL;
 
   /* needed to store loglikelihood under no LD */
   double loglike0 = 0.0;
@@ -378,20 +640,20 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
   double haplo_freq_sum = 0.0;
 
   /* needed for multiple starting conditions */
-  int error_flag, error_flag_best, init_cond, iter_count, iter_count_best = 0;
+  int error_flag, error_flag_best, init_cond, iter_count = 0, iter_count_best = 0;
   double freq_sum, loglike, loglike_best = 0.0;
 
-  CALLOC_ARRAY_DIM1(double, mle_best, MAX_HAPLOS);
+  double *mle_best = NULL;
 
   /* needed for permutations */
   int permu, max_permutations, ok_perm0 = 0;
-  int permu_count; // RS 20031125
-  double lr_mean, lr_sd, lr_z;
 
   CALLOC_ARRAY_DIM1(double, like_ratio, max_permu);
   CALLOC_ARRAY_DIM1(int, error_flag_permu, max_permu); // RS 20031125
 
-  double pvalue = 0.0;
+  /* permutations that are never run count as failed */
+  for (i = 1; i < max_permu; i++)
+    error_flag_permu[i] = -1;
 
   double error_flag0_pct = 0.0;
   double error_flag2_pct = 0.0;
@@ -404,14 +666,28 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
   /* default file pointers */
   FILE *fp_permu = FP_PERMU, *fp_iter = FP_ITER;
 
-  /* initialize elements of geno static arrays to make
-     function reentrant when used in a shared library */
-  
-  INIT_STATIC_DIM3(char, geno, MAX_GENOS, 2, (LINE_LEN/2));
+  table_init(&pheno_table, n_cols);
+  table_init(&geno_table, 2);
+  table_init(&haplo_table, n_loci);
+
+  /* find where each locus' alleles start, and the longest haplotype name */
+  for (locus = 0, j = 0; locus < n_loci; locus++)
+    {
+      allele_offset[locus] = j;
+      buff = 0;
+      for (i = j; i < j + n_allele[locus]; i++)
+	if ((int)strlen(allele_label[i]) > buff)
+	  buff = (int)strlen(allele_label[i]);
+      name_len += buff;
+      j += n_allele[locus];
+    }
+  haplo_name = (char *)xrealloc(NULL, name_len);
 
   /******************* end: declarations ****************************/
 
-  if (testing) {
+  if (seed) {
+    srand48(seed);  /* seed for this batch of permutations */
+  } else if (testing) {
     srand48(1234567);  /* fix seed if in testing mode to ensure deterministic output */
   } else {
     srand48(time (NULL));
@@ -451,235 +727,130 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 
       permute_alleles(data_ar, n_loci, n_recs); 
     
-      /* initialize values for first obs from last permu */
-      /* values for subsequent obs do not need inititialization */
-      strcpy(pheno[0], "\0"); 
-      for (i = 0; i < (int)pow(2, n_loci - 1); i++) 
-	{
-	  strcpy(geno[i][0], "\0");
-	  strcpy(geno[i][1], "\0");
-	}
+      /* forget the phenotypes, genotypes and haplotypes of the last permu */
+      table_clear(&pheno_table);
+      table_clear(&geno_table);
+      table_clear(&haplo_table);
       /* allele freqs do not need to be initialized from last permu 08/01/02 since now only computed for permu=0 */
     }
     /*** end: pre-processing for permutations ***/
 
     /********* begin: arranging unique phenotypes and genotypes ************/
-    n_hetero = n_hetero_prev = 0;
-    n_geno = n_geno_prev = 1;
+    n_gp = 0;
 
-    /* begin by counting the unique phenotypes and genotypes */
-
-    for (locus = 0; locus < n_loci; locus++)
+    for (obs = 0; obs < n_recs; obs++)
       {
-	col_0 = locus * 2;
-	col_1 = col_0 + 1;
+	row = data_ar + obs * n_cols;
 
-	if (strcmp(data_ar[0][col_0], data_ar[0][col_1]))
+	/* put the alleles at each locus in order */
+	for (locus = 0; locus < n_loci; locus++)
 	  {
-	    n_hetero++;
-	    if (strcmp(data_ar[0][col_0], data_ar[0][col_1]) > 0)
-	      {
-		strcpy(buff, data_ar[0][col_0]);
-		strcpy(data_ar[0][col_0], data_ar[0][col_1]);
-		strcpy(data_ar[0][col_1], buff);
-	      }
-	  }
-	strcat(pheno[0], data_ar[0][col_0]);
-	strcat(pheno[0], data_ar[0][col_1]);
-
-	/* update num distinct genotypes current locus loop */
-	n_geno_prev = n_geno;
-	if (n_hetero > 0)
-	  n_geno = (int)pow(2, n_hetero - 1);
-	else
-	  n_geno = 1;
+	    col_0 = locus * 2;
+	    col_1 = col_0 + 1;
 
-	if ((n_geno > 1) && (n_hetero - n_hetero_prev == 1))
-	  {
-	    /* copy current geno sequence to create multiple genos for this pheno */
-	    for (i = n_geno_prev; i < 2 * n_geno_prev; i++)
-	      {
-		strcat(geno[i][0], geno[i - n_geno_prev][0]);
-		strcat(geno[i][1], geno[i - n_geno_prev][1]);
-	      }
-	    /* fill in next portion of genotype */
-	    for (i = 0; i < n_geno; i++)
+	    if (row[col_0] > row[col_1])
 	      {
-		if (i < n_geno / 2)  /* fill in in normal order */
-		  {
-		    strcat(geno[i][0], data_ar[0][col_0]);
-		    strcat(geno[i][1], data_ar[0][col_1]);
-		  }
-		else      /* fill in in reverse order */
-		  {
-		    strcat(geno[i][0], data_ar[0][col_1]);
-		    strcat(geno[i][1], data_ar[0][col_0]);
-		  }
+		buff = row[col_0];
+		row[col_0] = row[col_1];
+		row[col_1] = buff;
 	      }
 	  }
-	else      /* n_geno is 1 or curr site is homozygous */
+
+	/* check whether this is a new distinct phenotype */
+	i = table_add(&pheno_table, row, &new_flag);
+	if (new_flag == FALSE)
 	  {
-	    for (i = 0; i < n_geno; i++)
-	      {
-		strcat(geno[i][0], data_ar[0][col_0]);
-		strcat(geno[i][1], data_ar[0][col_1]);
-	      }
+	    obspheno[i] += 1;
+	    continue;
 	  }
-	n_hetero_prev = n_hetero;
-      }        /* end of loop for a locus */
 
-    unique_pheno_count = 0;
-    unique_geno_count = n_geno - 1;
-    numgeno[0] = n_geno;
-    obspheno[0] = 1;
-
-    /* assign genotype-phenotype relationships */
-    for (i = 0; i < numgeno[0]; i++)
-      {
-	gp[i][0] = i;
-      }
-
-    /* process remaining data records */
-    /* loop starts at one because we've already done one line */
-    for (obs = 1; obs < n_recs; obs++)
-      {
-	temp_pheno[0] = '\0';
+	/* determine genotypes for the new phenotype */
+	n_geno = 1;
 	for (locus = 0; locus < n_loci; locus++)
+	  if (row[locus * 2] != row[locus * 2 + 1])
+	    n_geno *= 2;
+	if (n_geno > 1)
+	  n_geno /= 2;
+	if (n_geno > max_temp_geno)
 	  {
-	    col_0 = locus * 2;
-	    col_1 = col_0 + 1;
+	    max_temp_geno = n_geno;
+	    temp_geno = (int *)xrealloc(temp_geno, 
+					n_geno * 2 * n_loci * sizeof(int));
+	  }
+	n_geno = build_genotypes(row, n_loci, temp_geno);
 
-	    if ((strcmp(data_ar[obs][col_0], data_ar[obs][col_1])) > 0)
-	      {
-		strcpy(buff, data_ar[obs][col_0]);
-		strcpy(data_ar[obs][col_0], data_ar[obs][col_1]);
-		strcpy(data_ar[obs][col_1], buff);
-	      }
+	numgeno[i] = n_geno;
+	obspheno[i] = 1;
+	gp_start[i] = n_gp;
 
-	    strcat(temp_pheno, data_ar[obs][col_0]);
-	    strcat(temp_pheno, data_ar[obs][col_1]);
-	  }
-	/* check whether this is a new distinct phenotype */
-	unique_pheno_flag = TRUE;
-	for (i = 0; i <= unique_pheno_count; i++)  /* RS changed from < to <= */
+	if (n_gp + n_geno > max_gp)
 	  {
-	    if (!strcmp(temp_pheno, pheno[i]))
-	      {
-		unique_pheno_flag = FALSE;
-		obspheno[i] += 1;
-	      }
+	    max_gp = 2 * (n_gp + n_geno);
+	    gp = (int *)xrealloc(gp, max_gp * sizeof(int));
 	  }
 
-	if (unique_pheno_flag == TRUE)
+	/* check for new distinct genotypes, numbering any new
+	   haplotypes as they are found */
+	for (j = 0; j < n_geno; j++)
 	  {
-	    /* determine genotypes for the new phenotype */
-
-	    n_hetero_prev = n_hetero = 0;
-	    n_geno_prev = n_geno = 1;
-
-	    for (i = 0; i < (int)pow(2, n_loci - 1); i++) 
+	    geno_key[0] = table_add(&haplo_table, temp_geno + 2 * j * n_loci, 
+				    NULL);
+	    geno_key[1] = table_add(&haplo_table, temp_geno + (2 * j + 1) * n_loci, 
+				    NULL);
+	    col_0 = geno_key[0];
+	    col_1 = geno_key[1];
+	    if (col_0 > col_1)
 	      {
-		strcpy(temp_geno[i][0], "\0");
-		strcpy(temp_geno[i][1], "\0");
+		geno_key[0] = col_1;
+		geno_key[1] = col_0;
 	      }
 
-	    for (locus = 0; locus < n_loci; locus++)
-	      {
-		col_0 = locus * 2;
-		col_1 = col_0 + 1;
-
-		if (strcmp(data_ar[obs][col_0], data_ar[obs][col_1]))
-		  n_hetero++;
-		n_geno_prev = n_geno;
-
-		if (n_hetero > 0)
-		  n_geno = (int)pow(2, n_hetero - 1);
-		else
-		  n_geno = 1;
-
-		if ((n_geno > 1) && (n_hetero - n_hetero_prev == 1))
-		  {
-		    /* copy current sequence to create multiple genos for this pheno */
-		    for (i = n_geno_prev; i < 2 * n_geno_prev; i++)
-		      {
-			strcat(temp_geno[i][0], temp_geno[i - n_geno_prev][0]);
-			strcat(temp_geno[i][1], temp_geno[i - n_geno_prev][1]);
-		      }
-
-		    /* fill in next portion */
-		    for (i = 0; i < n_geno; i++)
-		      {
-			if (i < n_geno / 2)
-			  {
-			    strcat(temp_geno[i][0], data_ar[obs][col_0]);
-			    strcat(temp_geno[i][1], data_ar[obs][col_1]);
-			  }
-			else    /* fill in reverse order */
-			  {
-			    strcat(temp_geno[i][0], data_ar[obs][col_1]);
-			    strcat(temp_geno[i][1], data_ar[obs][col_0]);
-			  }
-		      }
-		  }
-		else      /* n_geno == 1 or current site not heterozygous */
-		  {
-		    for (i = 0; i < n_geno; i++)
-		      {
-			strcat(temp_geno[i][0], data_ar[obs][col_0]);
-			strcat(temp_geno[i][1], data_ar[obs][col_1]);
-		      }
-		  }
-
-		n_hetero_prev = n_hetero;
-
-	      }        /* END for each locus */
-
-	    unique_pheno_count += 1;
-	    strcpy(pheno[unique_pheno_count], temp_pheno);
-	    numgeno[unique_pheno_count] = n_geno;
-	    obspheno[unique_pheno_count] = 1;
-
-	    /* check for new distinct genotypes */
-	    for (i = 0; i < n_geno; i++)
+	    gp[n_gp] = table_add(&geno_table, geno_key, &new_flag);
+	    if (new_flag == TRUE)
 	      {
-		unique_geno_flag = TRUE;
-
-		for (j = 0; j <= unique_geno_count; j++)  /* RS changed from < to <= */
+		/* keep the haplotypes in the order they were found */
+		if (gp[n_gp] == max_xgeno)
 		  {
-		    if (((!strcmp(temp_geno[i][0], geno[j][0])) &&
-			 (!strcmp(temp_geno[i][1], geno[j][1]))) ||
-			((!strcmp(temp_geno[i][0], geno[j][1])) &&
-			 (!strcmp(temp_geno[i][1], geno[j][0]))))
-		      {
-			unique_geno_flag = FALSE;
-		        gp[i][unique_pheno_count] = j;
-		      }
-		  }
-
-		if (unique_geno_flag == TRUE)
-		  {
-		    unique_geno_count++;
-		    strcpy(geno[unique_geno_count][0], temp_geno[i][0]);
-		    strcpy(geno[unique_geno_count][1], temp_geno[i][1]);
-		    gp[i][unique_pheno_count] = unique_geno_count;
+		    max_xgeno = 2 * (max_xgeno + 1);
+		    xgeno = (int (*)[2])xrealloc(xgeno, max_xgeno * sizeof(*xgeno));
 		  }
+		xgeno[gp[n_gp]][0] = col_0;
+		xgeno[gp[n_gp]][1] = col_1;
 	      }
-	  }        /* END of if unique_pheno_flag == TRUE */
+	    n_gp++;
+	  }
       }          /* END of loop for each observation */
 
-    n_unique_pheno = unique_pheno_count + 1;
-    n_unique_geno = unique_geno_count + 1;
+    n_unique_pheno = pheno_table.n_keys;
+    n_unique_geno = geno_table.n_keys;
+    n_haplo = haplo_table.n_keys;
 
     /********* end: arranging unique phenotypes and genotypes ************/
 
     if (permu == 0)
     {
-      id_unique_alleles(data_ar, unique_allele, n_unique_allele, allele_freq, 
+      id_unique_alleles(data_ar, allele_offset, allele_label, allele_index, 
+			unique_allele, n_unique_allele, allele_freq, 
   		        n_loci, n_recs);
     }
 
-    n_haplo = count_unique_haplos(geno, haplo, haplocus, unique_allele, 
-				  n_unique_allele, n_unique_geno, n_loci, xgeno, xhaplo, GENOTYPE_SEPARATOR, GENOTYPE_TERMINATOR);
+    /* space for the haplotypes of this permu */
+    haplocus = (int *)xrealloc(haplocus, n_haplo * n_loci * sizeof(int));
+    xhaplo = (int *)xrealloc(xhaplo, n_haplo * sizeof(int));
+    haplo_order = (int *)xrealloc(haplo_order, n_haplo * sizeof(int));
+    mle = (double *)xrealloc(mle, n_haplo * sizeof(double));
+    freq_zero = (double *)xrealloc(freq_zero, n_haplo * sizeof(double));
+    mle_best = (double *)xrealloc(mle_best, n_haplo * sizeof(double));
+
+    /* identify allele# at lth locus for each haplotype */
+    for (i = 0; i < n_haplo; i++)
+      {
+	xhaplo[i] = i;
+	for (locus = 0; locus < n_loci; locus++)
+	  haplocus[i * n_loci + locus] = 
+	    allele_index[allele_offset[locus] + 
+			 haplo_table.keys[i * n_loci + locus]];
+      }
 
     if (permu == 0)
       {
@@ -707,23 +878,27 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
      //--- List all genos observed and haplos
 	 for(i = 0; i < n_unique_geno; i++)
 	 {
-	 fprintf(fp_out, "geno[%d][0]:%s geno[%d][1]:%s xgeno: %d %d\n", i, geno[i][0], i, geno[i][1], xgeno[i][0],  xgeno[i][1]);
+	 fprintf(fp_out, "xgeno[%d]: %d %d\n", i, xgeno[i][0],  xgeno[i][1]);
 	 }
 	 for(i = 0; i < n_haplo; i++)
 	 {
-	 fprintf(fp_out, "haplo[%d]: %s xhaplo: %d\n", i, haplo[i], xhaplo[i]);
+	 fprintf(fp_out, "haplo[%d]:", i);
+	 for (locus = 0; locus < n_loci; locus++)
+	   fprintf(fp_out, " %s", unique_allele[allele_offset[locus] + haplocus[i * n_loci + locus]]);
+	 fprintf(fp_out, " xhaplo: %d\n", xhaplo[i]);
 	 }
 #endif
 
     if (permu == 0)
       {
 	/* Compute haplotype freqs under no LD and store them temporarily in freq_zero */
-	haplo_freqs_no_ld(freq_zero, allele_freq, haplocus, n_unique_allele, 
+	haplo_freqs_no_ld(freq_zero, allele_freq, haplocus, allele_offset, 
 			  n_loci, n_haplo);
 
 	/* Compute log likelihood under no LD */
 	loglike0 = loglikelihood(numgeno, freq_zero, obspheno, n_haplo, 
-				 n_unique_geno, n_unique_pheno, xhaplo, xgeno, permu, gp);
+				 n_unique_geno, n_unique_pheno, xhaplo, xgeno, permu, 
+				 gp_start, gp);
 
 #ifdef XML_OUTPUT
 	xmlfprintf(fp_out, 
@@ -733,6 +908,14 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 #endif
       }
 
+    /* the permutations of a batch only need 'loglike0' */
+    if ((permu == 0) && skip_observed)
+      {
+	like_ratio[0] = 0.0;
+	error_flag_permu[0] = 0;
+	continue;
+      }
+
     /* Set initial haplotype frequencies  before EM calc */
     for (i = 0; i < n_haplo; i++)
       {
@@ -741,7 +924,8 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 
     emcalc(numgeno, obspheno, freq_zero, mle, n_haplo,
 	   n_unique_geno, n_unique_pheno, n_recs, xhaplo, xgeno, 
-	   &error_flag, &iter_count, &loglike, &haplo_freq_sum, permu, gp);
+	   &error_flag, &iter_count, &loglike, &haplo_freq_sum, permu, 
+	   gp_start, gp);
 
     if (permu == 0)
       {
@@ -783,7 +967,8 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
   
 	emcalc(numgeno, obspheno, freq_zero, mle, n_haplo,
 	       n_unique_geno, n_unique_pheno, n_recs, xhaplo, xgeno, 
-	       &error_flag, &iter_count, &loglike, &haplo_freq_sum, permu, gp);
+	       &error_flag, &iter_count, &loglike, &haplo_freq_sum, permu, 
+	       gp_start, gp);
 
 	if (permu == 0)
 	  {
@@ -837,6 +1022,26 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 	   other code in this sections  */
       }
   
+    /* the permutation test needs to know whether the observed data
+       could be fitted, and the df of the LR test, whether or not the
+       haplotypes are printed */
+    if (permu == 0)
+      {
+	ok_perm0 = (error_flag_best > 1) ? 0 : 1;
+
+	/* compute df_LRtest */
+	if (ok_perm0 == 1)
+	  {
+	    j = 0;
+	    for (i = 0; i < n_loci; i++)
+	      {
+		df_LRtest *= n_unique_allele[i];
+		j += n_unique_allele[i];
+	      }
+	    df_LRtest = df_LRtest - j + (n_loci - 1);
+	  }
+      }
+
     /* suppress printing of haplotypes if '-s' flag set */
     if ((permu == 0) && (suppress_haplo_print_flag != 1))
       {
@@ -917,23 +1122,20 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 
     if (error_flag_best > 1) 
     {
-      ok_perm0 = 0;
-      permu = max_permutations-1; // bail out of permutations
 #ifdef XML_OUTPUT
     xmlfprintf(fp_out, "</haplotypefreq>\n"); // close this open tag
 #endif
     }
     else
     {
-    ok_perm0 = 1; 
-        
 	/* copy mle_best to freq_zero so that sort does not interfere with info needed in LD calcs */
-	/* Note: haplo[] is no longer linked to mle_best after the sort, but is not used subsequently */
+	/* haplo_order[] gives the haplotype of each of the sorted freqs */
 	for (i = 0; i < n_haplo; i++) 
 	  {
 	    freq_zero[i] = mle_best[i];
+	    haplo_order[i] = i;
 	  }
-	sort2byfloat(haplo, freq_zero, n_haplo);
+	sort2byfloat(haplo_order, freq_zero, n_haplo);
 
 	j = 0;
 #ifndef XML_OUTPUT
@@ -946,12 +1148,18 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 	    if (freq_zero[i] > .00001)
 	      {
 		j += 1;
+		/* the haplotype name is the names of its alleles, each
+		   followed by a separator */
+		haplo_name[0] = '\0';
+		for (locus = 0; locus < n_loci; locus++)
+		  strcat(haplo_name, 
+			 allele_label[allele_offset[locus] + 
+				      haplo_table.keys[haplo_order[i] * n_loci + locus]]);
 		/* remove the trailing haplotype separator character in haplotype */
-		/* FIXME: the need for a trailing character should be removed when creating haplotype */
 #ifdef XML_OUTPUT
-		xmlfprintf(fp_out, "<haplotype name=\"%.*s\"><frequency>%.5f</frequency><numCopies>%.1f</numCopies></haplotype>\n", (strlen(haplo[i]) - 1), haplo[i], freq_zero[i], freq_zero[i]*2.0*n_recs);
+		xmlfprintf(fp_out, "<haplotype name=\"%.*s\"><frequency>%.5f</frequency><numCopies>%.1f</numCopies></haplotype>\n", (int)(strlen(haplo_name) - 1), haplo_name, freq_zero[i], freq_zero[i]*2.0*n_recs);
 #else
-		xmlfprintf(fp_out, "%3d  %12.5f %8.1f    %.*s\n", j, freq_zero[i], freq_zero[i]*2.0*n_recs, (strlen(haplo[i]) - 1), haplo[i]);
+		xmlfprintf(fp_out, "%3d  %12.5f %8.1f    %.*s\n", j, freq_zero[i], freq_zero[i]*2.0*n_recs, (int)(strlen(haplo_name) - 1), haplo_name);
 #endif
 	      }
 	  }
@@ -968,8 +1176,9 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 	  {
 	    for (j = 0; j < n_unique_allele[i]; j++)
 	      {
-		fprintf(fp_out, "%3d %12.5f %5d  %s \n", j+1, allele_freq[i][j], i, 
-			unique_allele[i][j]);
+		fprintf(fp_out, "%3d %12.5f %5d  %s \n", j+1, 
+			allele_freq[allele_offset[i] + j], i, 
+			unique_allele[allele_offset[i] + j]);
 	      }
 	  }
 	fprintf(fp_out, "\n");
@@ -983,16 +1192,7 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 #endif
 
 	linkage_diseq(fp_out, mle_best, haplocus, allele_freq, unique_allele, n_unique_allele, 
-		      n_loci, n_haplo, n_recs);
-
-	/* compute df_LRtest */
-	j = 0;
-	for (i = 0; i < n_loci; i++)
-	  {
-	    df_LRtest *= n_unique_allele[i];
-	    j += n_unique_allele[i];
-	  }
-	df_LRtest = df_LRtest - j + (n_loci - 1);
+		      allele_offset, n_loci, n_haplo, n_recs);
 
 #ifndef XML_OUTPUT
 	fprintf(fp_out, "Asymptotic LR Test for Overall LD [-2*(LL_0 - LL_1)]: %f, df = %d\n",  
@@ -1006,6 +1206,9 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
     } /* end: else [i.e., error_flag_best <=1] */
     } /* end: if ((permu==0 && ...)) */
 
+    if ((permu == 0) && (ok_perm0 == 0))
+      permu = max_permutations-1; // bail out of permutations
+
 #if 0
     if (permu_flag == 1) {
       if (error_flag_best == 0)
@@ -1031,77 +1234,23 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
 
   } /* end for (permu) */
   
+  /* results for the caller to merge */
+  if (ok_perm0_out != NULL)
+    *ok_perm0_out = ok_perm0;
+  if (df_LRtest_out != NULL)
+    *df_LRtest_out = df_LRtest;
+  if (like_ratio_out != NULL)
+    for (i = 0; i < max_permutations; i++)
+      like_ratio_out[i] = like_ratio[i];
+  if (error_flag_out != NULL)
+    for (i = 0; i < max_permutations; i++)
+      error_flag_out[i] = error_flag_permu[i];
+
   /*** begin: post-processing for permutations ***/
-  if (permu_flag == 1 && ok_perm0 == 1)
+  if (summary_flag && permu_flag == 1 && ok_perm0 == 1)
   {
-
-#ifdef XML_OUTPUT
-    xmlfprintf(fp_permu, "<permutationSummary>");
-#else
-    fprintf(fp_permu, "permu   LR = -2*(LL_0 - LL_1)\n");
-#endif
-    
-    pvalue = 0.0;
-    lr_mean = 0.0;
-    permu_count = 0; // RS 20031125
-
-    if (permu_print == 1) {
-#ifdef XML_OUTPUT
-      xmlfprintf(fp_permu, "<permutation iter=\"%d\">%f</permutation>", 0, like_ratio[0]);
-#else
-      fprintf(fp_permu, "%3d  %f \n", 0, like_ratio[0]); 
-#endif
-    }
-    for (i = 1; i < max_permutations; i++)
-    {
-      if (permu_print == 1) {
-#ifdef XML_OUTPUT
-	xmlfprintf(fp_permu, "<permutation iter=\"%d\">%f</permutation>", i, like_ratio[i]);
-#else
-	fprintf(fp_permu, "%3d  %f %d\n", i, like_ratio[i], error_flag_permu[i]); // RS 20031125
-#endif
-      }
-      if (error_flag_permu[i]==0) // RS 20031125
-      { 
-        permu_count += 1;
-        if (like_ratio[i] > like_ratio[0]) pvalue += 1;
-        lr_mean += like_ratio[i];
-      } 
-    }
-    pvalue = pvalue/permu_count;   // RS 20031125
-    lr_mean = lr_mean/permu_count; // RS 20031125
-
-#ifdef XML_OUTPUT
-    xmlfprintf(fp_out, "\n<pvalue totalperm=\"%d\">%f</pvalue>\n", permu_count, pvalue); 
-#else
-    fprintf(fp_out, "Permutation LR Test for Overall LD based on %d permutations: pvalue = %f\n", permu_count, pvalue); 
-    fprintf(fp_permu, "pvalue = %f \n", pvalue); 
-#endif
-
-    lr_sd = 0.0;
-    for (i = 1; i < max_permutations; i++)
-    {
-      if (error_flag_permu[i]==0) // RS 20031125 
-      { 
-        lr_sd += pow((like_ratio[i] - lr_mean),2);
-      } 
-    }
-    lr_sd = sqrt( lr_sd / ((permu_count) - 1) ); // RS 20031125
-    lr_z = ( sqrt(2.0*df_LRtest)/n_recs ) * ( (like_ratio[0] - lr_mean) / lr_sd ); 
-
-#ifdef XML_OUTPUT
-    xmlfprintf(fp_out, "<lr>%f</lr>\n", lr_z); 
-    xmlfprintf(fp_out, "<lr-mean>%f</lr-mean>\n", lr_mean); 
-    xmlfprintf(fp_out, "<lr-sd>%f</lr-sd>\n", lr_sd); 
-#else
-    fprintf(fp_out, "Standardized LR statistic = %f\n", lr_z); 
-    fprintf(fp_out, "LR mean = %f\n", lr_mean); 
-    fprintf(fp_out, "LR SD = %f\n", lr_sd); 
-#endif
-
-#ifdef XML_OUTPUT
-    xmlfprintf(fp_permu, "</permutationSummary>\n");
-#endif
+    print_permu_summary(fp_out, fp_permu, max_permutations, n_recs, 
+			df_LRtest, permu_print, like_ratio, error_flag_permu);
 
 #ifndef EXTERNAL_MODE
     fclose(fp_permu);
@@ -1111,16 +1260,21 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
   /*** end: post-processing for permutations ***/
 
   /* free calloc'ed space */
-  free(buff);
-  free(pheno);
+  table_free(&pheno_table);
+  table_free(&geno_table);
+  table_free(&haplo_table);
   free(temp_geno);
+  free(gp);
+  free(gp_start);
   free(numgeno);
   free(obspheno);
-  free(temp_pheno);
-  free(haplo);
   free(haplocus);
   free(xhaplo);
+  free(haplo_order);
   free(xgeno);
+  free(haplo_name);
+  free(allele_offset);
+  free(allele_index);
   free(unique_allele);
   free(n_unique_allele);
   free(allele_freq);
@@ -1128,216 +1282,327 @@ int main_proc(FILE * fp_out, char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci,
   free(freq_zero);
   free(mle_best);
   free(like_ratio);
+  free(error_flag_permu);
 
   return (EXIT_SUCCESS);
 }
 
+
 /************************************************************************/
-int count_unique_haplos(char (*geno_ar)[2][LINE_LEN / 2],
-      char (*haplo_ar)[LINE_LEN / 2], int (*haplocus)[MAX_LOCI], 
-      char (*unique_allele)[MAX_ALLELES][NAME_LEN],
-      int *n_unique_allele, int num_genos, int num_loci,
-			int (*xgeno)[2], int *xhaplo, char GENOTYPE_SEPARATOR[1], char GENOTYPE_TERMINATOR[1])
+
 /* 
-  * run through the array of possible genotypes 
-  * create an array of possible haplotypes 
-  * create haplocus[i][j]: a 2-dim array of allele# at jth locus of ith haplotype
-*/
+ * the likelihood ratios and error flags of the observed data and the
+ * 'n_permu' - 1 permutations are summarized as a p-value and
+ * standardized LR statistic, written to 'fp_out'.  the enclosing
+ * tags, and the likelihood ratios themselves if 'permu_print' is set,
+ * are written to 'fp_permu'.  only permutations with an error flag of
+ * 0 are counted.
+ */
+static void print_permu_summary(FILE * fp_out, FILE * fp_permu, int n_permu,
+				int n_recs, int df_LRtest, int permu_print,
+				double *like_ratio, int *error_flag)
 {
-  int i, j, k = 0;
-  int unique_haplo_flag, unique_haplo_count = 0;
-  char *temp_ptr = 0;
-  int l, m = 0;
-
-  CALLOC_ARRAY_DIM2(char, temp_array, MAX_LOCI, NAME_LEN);
-  CALLOC_ARRAY_DIM1(char, temp_buff, LINE_LEN / 2);
-
-  /* 0th assignment */
-  unique_haplo_count = 0;
-  strcpy(haplo_ar[0], geno_ar[0][0]);
-  xhaplo[0] = 0;
-  xgeno[0][0] = 0;
-
-  /* split haplo_ar[0] into temp_array on GENOTYPE_SEPARATOR and add trailing GENOTYPE_TERMINATOR */
-  strcpy(temp_buff, haplo_ar[0]);
-  temp_ptr = strtok(temp_buff, GENOTYPE_SEPARATOR);
-  if (temp_ptr) 
+  int i;
+  int permu_count; // RS 20031125
+  double pvalue, lr_mean, lr_sd, lr_z;
+
+#ifdef XML_OUTPUT
+  xmlfprintf(fp_permu, "<permutationSummary>");
+#else
+  fprintf(fp_permu, "permu   LR = -2*(LL_0 - LL_1)\n");
+#endif
+  
+  pvalue = 0.0;
+  lr_mean = 0.0;
+  permu_count = 0; // RS 20031125
+
+  if (permu_print == 1) {
+#ifdef XML_OUTPUT
+    xmlfprintf(fp_permu, "<permutation iter=\"%d\">%f</permutation>", 0, like_ratio[0]);
+#else
+    fprintf(fp_permu, "%3d  %f \n", 0, like_ratio[0]); 
+#endif
+  }
+  for (i = 1; i < n_permu; i++)
   {
-    strcpy(temp_array[0], temp_ptr);
-    strcat(temp_array[0], GENOTYPE_TERMINATOR);
-    for (k = 1; k < num_loci; k++) /* start at 1 since 0th is done */
-    {
-      temp_ptr = strtok(NULL, GENOTYPE_SEPARATOR);
-      if (temp_ptr) 
-      {  
-        strcpy(temp_array[k], temp_ptr);
-        strcat(temp_array[k], GENOTYPE_TERMINATOR);
-      }  
+    if (permu_print == 1) {
+#ifdef XML_OUTPUT
+	xmlfprintf(fp_permu, "<permutation iter=\"%d\">%f</permutation>", i, like_ratio[i]);
+#else
+	fprintf(fp_permu, "%3d  %f %d\n", i, like_ratio[i], error_flag[i]); // RS 20031125
+#endif
     }
+    if (error_flag[i]==0) // RS 20031125
+    { 
+      permu_count += 1;
+      if (like_ratio[i] > like_ratio[0]) pvalue += 1;
+      lr_mean += like_ratio[i];
+    } 
   }
+  pvalue = pvalue/permu_count;   // RS 20031125
+  lr_mean = lr_mean/permu_count; // RS 20031125
 
-#if DEBUG == 1
+#ifdef XML_OUTPUT
+  xmlfprintf(fp_out, "\n<pvalue totalperm=\"%d\">%f</pvalue>\n", permu_count, pvalue); 
+#else
+  fprintf(fp_out, "Permutation LR Test for Overall LD based on %d permutations: pvalue = %f\n", permu_count, pvalue); 
+  fprintf(fp_permu, "pvalue = %f \n", pvalue); 
+#endif
 
-  for (k = 0; k < num_loci; k++) 
+  lr_sd = 0.0;
+  for (i = 1; i < n_permu; i++)
   {
-    fprintf(stdout, "haplo_ar[0]: %s temp_array[%d]: %s \n", 
-            haplo_ar[0], k, temp_array[k]); 
+    if (error_flag[i]==0) // RS 20031125 
+    { 
+      lr_sd += pow((like_ratio[i] - lr_mean),2);
+    } 
   }
+  lr_sd = sqrt( lr_sd / ((permu_count) - 1) ); // RS 20031125
+  lr_z = ( sqrt(2.0*df_LRtest)/n_recs ) * ( (like_ratio[0] - lr_mean) / lr_sd ); 
+
+#ifdef XML_OUTPUT
+  xmlfprintf(fp_out, "<lr>%f</lr>\n", lr_z); 
+  xmlfprintf(fp_out, "<lr-mean>%f</lr-mean>\n", lr_mean); 
+  xmlfprintf(fp_out, "<lr-sd>%f</lr-sd>\n", lr_sd); 
+#else
+  fprintf(fp_out, "Standardized LR statistic = %f\n", lr_z); 
+  fprintf(fp_out, "LR mean = %f\n", lr_mean); 
+  fprintf(fp_out, "LR SD = %f\n", lr_sd); 
+#endif
+
+#ifdef XML_OUTPUT
+  xmlfprintf(fp_permu, "</permutationSummary>\n");
 #endif
+}
+
+/************************************************************************/
+int compare_names(const void *a, const void *b)
+{
+  return strcmp(*(char * const *)a, *(char * const *)b);
+}
 
-  /* identify allele# at lth locus for 0th haplotype */
-  for (l = 0; l < num_loci; l++) 
+/************************************************************************/
+void code_alleles(char **data_ar, int n_loci, int n_recs, int *codes,
+		  char **allele_label, int *n_allele)
+{
+  int i, locus, col, n_cols = 2 * n_loci;
+  int offset = 0;
+  char **label;
+
+  CALLOC_ARRAY_DIM1(char *, names, 2 * n_recs);
+
+  for (locus = 0; locus < n_loci; locus++)
   {
-    for (m = 0; m < n_unique_allele[l]; m++) 
+    /* sort the names of all alleles at this locus */
+    for (i = 0; i < 2 * n_recs; i++)
+      names[i] = data_ar[(i / 2) * n_cols + 2 * locus + i % 2];
+    qsort(names, 2 * n_recs, sizeof(char *), compare_names);
+
+    /* keep each distinct name once */
+    label = allele_label + offset;
+    n_allele[locus] = 0;
+    for (i = 0; i < 2 * n_recs; i++)
     {
-      if (!strcmp(temp_array[l], unique_allele[l][m])) 
-        haplocus[0][l] = m;
+      if (n_allele[locus] == 0 || 
+	  strcmp(names[i], label[n_allele[locus] - 1]))
+	label[n_allele[locus]++] = names[i];
     }
-  }
 
-  for (i = 0; i < num_genos; i++)
-  {
-    for (j = 0; j < 2; j++)
+    /* number each allele by the position of its name */
+    for (i = 0; i < n_recs; i++)
     {
-      unique_haplo_flag = TRUE;
-      for (k = 0; k <= unique_haplo_count && unique_haplo_flag == TRUE; k++)
-      {
-        if (!strcmp(geno_ar[i][j], haplo_ar[k]))
-        {  
-          unique_haplo_flag = FALSE;
-          xgeno[i][j] = k;
-        }  
-      }
-      if (unique_haplo_flag == TRUE)
-      {
-        strcpy(haplo_ar[++unique_haplo_count], geno_ar[i][j]);
-        xhaplo[unique_haplo_count] = unique_haplo_count; 
-        xgeno[i][j] = unique_haplo_count;
+      for (col = 2 * locus; col < 2 * locus + 2; col++)
+	codes[i * n_cols + col] = 
+	  (char **)bsearch(&data_ar[i * n_cols + col], label, n_allele[locus],
+			   sizeof(char *), compare_names) - label;
+    }
+    offset += n_allele[locus];
+  }
 
-#if DEBUG == 1
-//	fprintf(stdout, "xgeno[%d][%d]:%d \n", i,j,xgeno[i][j]);
-#endif
+  /* free calloc'ed space */
+  free(names);
+}
 
-        /* split haplo_ar[unique_haplo_count] into temp_array ... */
-        strcpy(temp_buff, haplo_ar[unique_haplo_count]);
-        temp_ptr = strtok(temp_buff, GENOTYPE_TERMINATOR);
-        if (temp_ptr) 
-        {
-          strcpy(temp_array[0], temp_ptr);
-          strcat(temp_array[0], GENOTYPE_TERMINATOR);
-          for (k = 1; k < num_loci; k++) /* start at 1 since 0th is done */
-          {
-            temp_ptr = strtok(NULL, GENOTYPE_SEPARATOR);
-            if (temp_ptr) 
-            {  
-              strcpy(temp_array[k], temp_ptr);
-              strcat(temp_array[k], GENOTYPE_TERMINATOR);
-            }  
-          }
-        }
-#if DEBUG == 1
-/*	
-        for (k = 0; k < num_loci; k++) 
-	  fprintf(stdout, "haplo_ar[%d]: %s temp_array[%d]: %s \n", 
-		  unique_haplo_count, haplo_ar[unique_haplo_count], 
-		  k, temp_array[k]); 
+/************************************************************************/
+int compare_name_refs(const void *a, const void *b)
+{
+  return strcmp(**(char ** const *)a, **(char ** const *)b);
+}
+
+/************************************************************************/
+void recode_alleles(int *data_ar, char **labels, int *n_labels, int n_loci,
+		    int n_recs, int *codes, char **allele_label, int *n_allele)
+/* 
+  * names that no record uses are dropped, and any names that are the
+  * same are given the same number, so the result is as if
+  * code_alleles had been given the names
 */
-#endif
+{
+  int i, locus, col, n_cols = 2 * n_loci;
+  int n_refs, in_offset = 0, offset = 0, max_labels = 0;
+  char **label;
 
-        /* identify allele# at lth locus for unique_haplo_count haplotype */
-        for (l = 0; l < num_loci; l++) 
-        {
-          for (m = 0; m < n_unique_allele[l]; m++) 
-          {
-            if (!strcmp(temp_array[l], unique_allele[l][m])) 
-              haplocus[unique_haplo_count][l] = m;
-          }
-        }
+  for (locus = 0; locus < n_loci; locus++)
+    if (n_labels[locus] > max_labels)
+      max_labels = n_labels[locus];
 
-      }
+  CALLOC_ARRAY_DIM1(char **, refs, max_labels);
+  CALLOC_ARRAY_DIM1(int, new_code, max_labels);
+
+  for (locus = 0; locus < n_loci; locus++)
+  {
+    /* sort the names used at this locus */
+    for (i = 0; i < n_labels[locus]; i++)
+      new_code[i] = -1;
+    for (i = 0; i < n_recs; i++)
+    {
+      for (col = 2 * locus; col < 2 * locus + 2; col++)
+	new_code[data_ar[i * n_cols + col]] = 0;
+    }
+    n_refs = 0;
+    for (i = 0; i < n_labels[locus]; i++)
+      if (new_code[i] == 0)
+	refs[n_refs++] = labels + in_offset + i;
+    qsort(refs, n_refs, sizeof(char **), compare_name_refs);
+
+    /* keep each distinct name once, noting the number of each code */
+    label = allele_label + offset;
+    n_allele[locus] = 0;
+    for (i = 0; i < n_refs; i++)
+    {
+      if (n_allele[locus] == 0 || 
+	  strcmp(*refs[i], label[n_allele[locus] - 1]))
+	label[n_allele[locus]++] = *refs[i];
+      new_code[refs[i] - (labels + in_offset)] = n_allele[locus] - 1;
+    }
+
+    for (i = 0; i < n_recs; i++)
+    {
+      for (col = 2 * locus; col < 2 * locus + 2; col++)
+	codes[i * n_cols + col] = new_code[data_ar[i * n_cols + col]];
     }
+    in_offset += n_labels[locus];
+    offset += n_allele[locus];
   }
-  
-  /* free calloc'ed space */
-  free(temp_array);
-  free(temp_buff);
 
-  return unique_haplo_count + 1;
+  /* free calloc'ed space */
+  free(refs);
+  free(new_code);
 }
 
 /************************************************************************/
-void id_unique_alleles(char (*data_ar)[MAX_COLS][NAME_LEN],
-           char (*unique_allele)[MAX_ALLELES][NAME_LEN],
-           int *n_unique_allele, double (*allele_freq)[MAX_ALLELES],
-           int n_loci, int n_recs)
+int build_genotypes(int *pheno, int n_loci, int *geno)
 /* 
-   * Creates unique_allele[i][j]: jth unique allele for the ith locus        
-   * Creates n_unique_allele[i]: number of unique alleles for the ith locus 
-   * Creates allele_freq[i][j]:  freq for jth allele at the ith locus 
+  * geno holds pairs of haplotypes: the kth haplotype of the ith
+  * genotype is geno[(2 * i + k) * n_loci] onwards
 */
 {
-  int i, j, locus, col_0, col_1 = 0;
-  int unique_allele_flag, unique_allele_count = 0;
+  int i, locus, n_hetero, n_hetero_prev = 0;
+  int n_geno, n_geno_prev = 1;
 
-#if DEBUG == 1
-/*
-  for (i = 0; i < n_recs; i++)
-  for (j = 0; j < 2*n_loci; j++)
-  fprintf(stdout, "data[%d][%d]: %s\n", i, j, data_ar[i][j]); 
-  fprintf(stdout, "data0[%d][%d]: %s, uniq[%d][%d]:\n", i, col_0, 
-    data_ar[i][j], locus, j, unique_allele[locus][j]); 
-*/
-#endif
+#define HAP(i, k) (geno + (2 * (i) + (k)) * n_loci)
+
+  n_hetero = 0;
+  n_geno = 1;
 
   for (locus = 0; locus < n_loci; locus++)
   {
-    col_0 = locus * 2;
-    col_1 = col_0 + 1;
-    strcpy(unique_allele[locus][0], data_ar[0][col_0]);
-    unique_allele_count = 0;
+    if (pheno[2 * locus] != pheno[2 * locus + 1])
+      n_hetero++;
+    n_geno_prev = n_geno;
 
-    for (i = 0; i < n_recs; i++)
+    if (n_hetero > 0)
+      n_geno = 1 << (n_hetero - 1);
+    else
+      n_geno = 1;
+
+    if ((n_geno > 1) && (n_hetero - n_hetero_prev == 1))
     {
-      /* Process col_0 of current locus */
-      unique_allele_flag = TRUE;
-      for (j = 0; j <= unique_allele_count; j++)
+      /* copy current sequence to create multiple genos for this pheno */
+      for (i = n_geno_prev; i < 2 * n_geno_prev; i++)
       {
-        if (!strcmp(data_ar[i][col_0], unique_allele[locus][j]))
-        {
-          unique_allele_flag = FALSE;
-          allele_freq[locus][j] += 1;
-
-        }
+	memcpy(HAP(i, 0), HAP(i - n_geno_prev, 0), locus * sizeof(int));
+	memcpy(HAP(i, 1), HAP(i - n_geno_prev, 1), locus * sizeof(int));
       }
-      if (unique_allele_flag == TRUE)
+
+      /* fill in next portion */
+      for (i = 0; i < n_geno; i++)
       {
-        unique_allele_count += 1;
-        strcpy(unique_allele[locus][unique_allele_count], data_ar[i][col_0]);
-        allele_freq[locus][unique_allele_count] += 1;
+	if (i < n_geno / 2)
+	{
+	  HAP(i, 0)[locus] = pheno[2 * locus];
+	  HAP(i, 1)[locus] = pheno[2 * locus + 1];
+	}
+	else    /* fill in reverse order */
+	{
+	  HAP(i, 0)[locus] = pheno[2 * locus + 1];
+	  HAP(i, 1)[locus] = pheno[2 * locus];
+	}
       }
-
-      /* Process col_1 of current locus */
-      unique_allele_flag = TRUE;
-      for (j = 0; j <= unique_allele_count; j++)
+    }
+    else      /* n_geno == 1 or current site not heterozygous */
+    {
+      for (i = 0; i < n_geno; i++)
       {
-        if (!strcmp(data_ar[i][col_1], unique_allele[locus][j]))
-        {
-          unique_allele_flag = FALSE;
-          allele_freq[locus][j] += 1;
-        }
+	HAP(i, 0)[locus] = pheno[2 * locus];
+	HAP(i, 1)[locus] = pheno[2 * locus + 1];
       }
-      if (unique_allele_flag == TRUE)
+    }
+
+    n_hetero_prev = n_hetero;
+  }
+
+#undef HAP
+
+  return n_geno;
+}
+
+/************************************************************************/
+void id_unique_alleles(int *data_ar, int *allele_offset, char **allele_label,
+		       int *allele_index, char **unique_allele,
+		       int *n_unique_allele, double *allele_freq,
+		       int n_loci, int n_recs)
+/* 
+   * Creates unique_allele[offset + j]: jth unique allele for the ith
+   * locus, in the order the alleles are first seen, where offset is
+   * allele_offset[i]
+   * Creates allele_index[offset + k]: j for the allele coded k
+   * Creates n_unique_allele[i]: number of unique alleles for the ith locus 
+   * Creates allele_freq[offset + j]:  freq for jth allele at the ith locus 
+*/
+{
+  int i, j, locus, col, offset = 0;
+  int *code;
+
+  /* no allele has been seen yet */
+  for (j = 0; j < 2 * n_loci * n_recs; j++)
+    allele_index[j] = -1;
+
+  for (locus = 0; locus < n_loci; locus++)
+  {
+    offset = allele_offset[locus];
+    n_unique_allele[locus] = 0;
+
+    for (i = 0; i < n_recs; i++)
+    {
+      /* process col_0 then col_1 of current locus */
+      for (col = 2 * locus; col < 2 * locus + 2; col++)
       {
-        unique_allele_count += 1;
-        strcpy(unique_allele[locus][unique_allele_count], data_ar[i][col_1]);
-        allele_freq[locus][unique_allele_count] += 1;
+	code = &data_ar[i * 2 * n_loci + col];
+	if (allele_index[offset + *code] < 0)
+	{
+	  j = n_unique_allele[locus]++;
+	  allele_index[offset + *code] = j;
+	  unique_allele[offset + j] = allele_label[offset + *code];
+	  allele_freq[offset + j] = 0;
+	}
+	allele_freq[offset + allele_index[offset + *code]] += 1;
       }
     }
-    n_unique_allele[locus] = unique_allele_count + 1;
 
-    for(j = 0; j < n_unique_allele[locus]; j++)
+    for (j = 0; j < n_unique_allele[locus]; j++)
     {
-      allele_freq[locus][j] = allele_freq[locus][j] / (2*(double)n_recs);
+      allele_freq[offset + j] = allele_freq[offset + j] / (2*(double)n_recs);
     }
   }
 
@@ -1353,31 +1618,43 @@ double min(double a, double b)
 }
 
 /************************************************************************/
-void linkage_diseq(FILE * fp_out, double (*mle), int (*hl)[MAX_LOCI],
-       double (*af)[MAX_ALLELES], 
-       char (*unique_allele)[MAX_ALLELES][NAME_LEN],
-       int *n_unique_allele, int n_loci, int n_haplo, int n_recs)
-       /* hl: haplocus array           */
-       /* af: allele_frequencies array */
+void linkage_diseq(FILE * fp_out, double (*mle), int *hl, double *af, 
+       char **unique_allele, int *n_unique_allele, int *allele_offset,
+       int n_loci, int n_haplo, int n_recs)
+       /* hl: haplocus array, n_loci allele#s for each haplotype */
+       /* af: allele_frequencies array, from allele_offset[locus] for each locus */
 {
   int i, j, k, l, m, coeff_count = 0;
-  double dmax, norm_dij = 0.0; 
+  int n_pairs = n_loci * (n_loci - 1) / 2;
+  double dmax = 0.0, norm_dij = 0.0; 
+  double *d, *af_j, *af_k;
+  char **ua_j, **ua_k;
 
-  static double dij[MAX_LOCI*(MAX_LOCI - 1)/2][MAX_ALLELES][MAX_ALLELES];
+  /* dij[coeff_count][l * n_unique_allele[k] + m] for the lth allele at
+     locus j and mth allele at locus k */
+  CALLOC_ARRAY_DIM1(double *, dij, n_pairs);
 
-  CALLOC_ARRAY_DIM1(double, summary_d, MAX_LOCI*(MAX_LOCI - 1)/2);
-  CALLOC_ARRAY_DIM1(double, summary_dprime, MAX_LOCI*(MAX_LOCI - 1)/2);
-  CALLOC_ARRAY_DIM1(double, summary_q, MAX_LOCI*(MAX_LOCI - 1)/2);
-  CALLOC_ARRAY_DIM1(double, summary_wn, MAX_LOCI*(MAX_LOCI - 1)/2);
+  CALLOC_ARRAY_DIM1(double, summary_d, n_pairs);
+  CALLOC_ARRAY_DIM1(double, summary_dprime, n_pairs);
+  CALLOC_ARRAY_DIM1(double, summary_q, n_pairs);
+  CALLOC_ARRAY_DIM1(double, summary_wn, n_pairs);
 
   double obs = 0.0; 
   double exp = 0.0; 
   double diseq = 0.0; 
   double chisq = 0.0; 
+  double chisq_denom = 0.0;
 
-  /* zero out static array before each run to make code re-entrant */
-  INIT_STATIC_DIM3(double, dij, (MAX_LOCI*(MAX_LOCI-1)/2), \
-		   MAX_ALLELES, MAX_ALLELES);
+  coeff_count = 0;
+  for (j = 0; j < n_loci; j++)
+  {
+    for (k = j+1; k < n_loci; k++)
+    {
+      dij[coeff_count] = (double *)calloc(n_unique_allele[j] * n_unique_allele[k], 
+					  sizeof(double));
+      coeff_count += 1;
+    }
+  }
 
   /* After 1st pass dij[coeff_count][locusA_allele#][locusB_allele#] */
   /*   contains Estimated 2-locus HFs based on full MLE HFs          */
@@ -1389,8 +1666,7 @@ void linkage_diseq(FILE * fp_out, double (*mle), int (*hl)[MAX_LOCI],
     {
       for (k = j+1; k < n_loci; k++)
       {
-        dij[coeff_count][ hl[i][j] ][ hl[i][k] ] = 
-          dij[coeff_count][ hl[i][j] ][ hl[i][k] ] + mle[i];
+        dij[coeff_count][ hl[i*n_loci + j] * n_unique_allele[k] + hl[i*n_loci + k] ] += mle[i];
         coeff_count += 1;
       }
     }
@@ -1401,6 +1677,10 @@ void linkage_diseq(FILE * fp_out, double (*mle), int (*hl)[MAX_LOCI],
   {
     for (k = j+1; k < n_loci; k++)
     {
+      af_j = af + allele_offset[j];
+      af_k = af + allele_offset[k];
+      ua_j = unique_allele + allele_offset[j];
+      ua_k = unique_allele + allele_offset[k];
 #ifdef XML_OUTPUT
       xmlfprintf(fp_out, "<loci first=\"%d\" second=\"%d\">\n", j, k);
 #else
@@ -1411,39 +1691,47 @@ void linkage_diseq(FILE * fp_out, double (*mle), int (*hl)[MAX_LOCI],
       {
         for (m = 0; m < n_unique_allele[k]; m++)
         {
-          obs = 2 * (double)n_recs * dij[coeff_count][l][m];
-          exp = 2 * (double)n_recs * af[j][l] * af[k][m];
-          dij[coeff_count][l][m] -= af[j][l] * af[k][m];
-          diseq = dij[coeff_count][l][m];
-          chisq = pow(dij[coeff_count][l][m], 2) * 2 * (double)n_recs / 
-            ( af[j][l]*(1-af[j][l])*af[k][m]*(1-af[k][m]) );
+          d = &dij[coeff_count][l * n_unique_allele[k] + m];
+          obs = 2 * (double)n_recs * *d;
+          exp = 2 * (double)n_recs * af_j[l] * af_k[m];
+          *d -= af_j[l] * af_k[m];
+          diseq = *d;
+          /* a monomorphic locus gives 0/0: no LD can be measured */
+          chisq_denom = af_j[l]*(1-af_j[l])*af_k[m]*(1-af_k[m]);
+          if (chisq_denom > 0)
+            chisq = pow(*d, 2) * 2 * (double)n_recs / chisq_denom;
+          else
+            chisq = 0;
           summary_q[coeff_count] += 2 * (double)n_recs *
-            pow(dij[coeff_count][l][m], 2) / ( af[j][l] * af[k][m] ) ;
-          if (dij[coeff_count][l][m] > 0)
+            pow(*d, 2) / ( af_j[l] * af_k[m] ) ;
+          if (*d > 0)
           {
-            dmax = min( af[j][l]*(1-af[k][m]), (1-af[j][l])*af[k][m] );
-            norm_dij = dij[coeff_count][l][m] / dmax;
+            dmax = min( af_j[l]*(1-af_k[m]), (1-af_j[l])*af_k[m] );
+            norm_dij = *d / dmax;
           }
-          else if (dij[coeff_count][l][m] < 0)
+          else if (*d < 0)
           {
-            dmax = min( af[j][l]*af[k][m], (1-af[j][l])*(1-af[k][m]) );
-            norm_dij = dij[coeff_count][l][m] / dmax;
+            dmax = min( af_j[l]*af_k[m], (1-af_j[l])*(1-af_k[m]) );
+            norm_dij = *d / dmax;
           }
           else
             norm_dij = 0;
-	  summary_d[coeff_count] += af[j][l] * af[k][m] * fabs(norm_dij) * dmax;
-          summary_dprime[coeff_count] += af[j][l] * af[k][m] * fabs(norm_dij);
+	  summary_d[coeff_count] += af_j[l] * af_k[m] * fabs(norm_dij) * dmax;
+          summary_dprime[coeff_count] += af_j[l] * af_k[m] * fabs(norm_dij);
 #ifdef XML_OUTPUT
 	  xmlfprintf(fp_out,"<allelepair first=\"%s\" second=\"%s\"><observed>%.5f</observed><expected>%.4f</expected><diseq>%.5f</diseq><norm_dij>%.5f</norm_dij><chisq>%.5f</chisq></allelepair>\n", 
-            unique_allele[j][l], unique_allele[k][m], obs, exp, diseq, norm_dij, chisq);
+            ua_j[l], ua_k[m], obs, exp, diseq, norm_dij, chisq);
 #else
           fprintf(fp_out,"%6s%6s %10.4f %10.4f %10.4f %10.4f %10.4f\n", 
-            unique_allele[j][l], unique_allele[k][m], obs, exp, diseq, norm_dij, chisq); 
+            ua_j[l], ua_k[m], obs, exp, diseq, norm_dij, chisq); 
 #endif
         }
       }
-      summary_wn[coeff_count]  = sqrt( summary_q[coeff_count] /
-        ( 2*(double)n_recs * (min(n_unique_allele[j],n_unique_allele[k])-1) ) );
+      if (min(n_unique_allele[j],n_unique_allele[k]) > 1)
+        summary_wn[coeff_count]  = sqrt( summary_q[coeff_count] /
+          ( 2*(double)n_recs * (min(n_unique_allele[j],n_unique_allele[k])-1) ) );
+      else
+        summary_wn[coeff_count] = 0;
       coeff_count += 1;
 #ifdef XML_OUTPUT
       xmlfprintf(fp_out, "</loci>\n");   /* close <loci> tag */
@@ -1481,62 +1769,57 @@ void linkage_diseq(FILE * fp_out, double (*mle), int (*hl)[MAX_LOCI],
   }
 
   /* free calloc'ed space */
+  for (i = 0; i < n_pairs; i++)
+    free(dij[i]);
+  free(dij);
+  free(summary_d);
   free(summary_dprime);
   free(summary_q);
   free(summary_wn);
 }
 
 /************************************************************************/
-void sort2bychar(char (*array1)[LINE_LEN / 2], double *array2, int n_haplo)
-/* insertion sort in ascending order for 1st array also applied to 2nd array */
+int compare_freqs(const void *a, const void *b)
+/* descending order of freq, keeping the original order of equal freqs */
 {
-  int i, j = 0;
-
-  CALLOC_ARRAY_DIM1(char, temp1, LINE_LEN / 2);
-
-  double temp2 = 0.0;
-
-  for (i = 1; i < n_haplo; ++i)
-  {
-    for (j = i; (j - 1) >= 0 && strcmp(array1[j - 1], array1[j]) > 0; --j)
-    {
-      strcpy(temp1, array1[j]);
-      strcpy(array1[j], array1[j - 1]);
-      strcpy(array1[j - 1], temp1);
-      temp2 = array2[j];
-      array2[j] = array2[j - 1];
-      array2[j - 1] = temp2;
-    }
-  }
+  const freq_index *x = (const freq_index *)a;
+  const freq_index *y = (const freq_index *)b;
 
-  /* free calloc'ed space */
-  free(temp1);
+  if (x->freq > y->freq)
+    return -1;
+  else if (x->freq < y->freq)
+    return 1;
+  else
+    return x->index - y->index;
 }
 
 /************************************************************************/
-void sort2byfloat(char (*array1)[LINE_LEN / 2], double *array2, int n_haplo)
-/* insertion sort in descending order for 2nd array also applied to 1st array */
+void sort2byfloat(int *array1, double *array2, int n_haplo)
+/* stable sort in descending order for 2nd array also applied to 1st array */
 {
-  int i, j = 0;
+  int i = 0;
 
-  CALLOC_ARRAY_DIM1(char, temp1, LINE_LEN / 2);
+  CALLOC_ARRAY_DIM1(freq_index, temp, n_haplo);
+  CALLOC_ARRAY_DIM1(int, temp1, n_haplo);
 
-  double temp2 = 0.0;
+  for (i = 0; i < n_haplo; i++)
+  {
+    temp[i].freq = array2[i];
+    temp[i].index = i;
+  }
+  qsort(temp, n_haplo, sizeof(freq_index), compare_freqs);
 
-  for (i = 1; i < n_haplo; ++i)
+  /* array1 is permuted through a copy */
+  for (i = 0; i < n_haplo; i++)
+    temp1[i] = array1[i];
+  for (i = 0; i < n_haplo; i++)
   {
-    for (j = i; (j - 1) >= 0 && array2[j - 1] < array2[j]; --j)
-    {
-      strcpy(temp1, array1[j]);
-      strcpy(array1[j], array1[j - 1]);
-      strcpy(array1[j - 1], temp1);
-      temp2 = array2[j];
-      array2[j] = array2[j - 1];
-      array2[j - 1] = temp2;
-    }
+    array1[i] = temp1[temp[i].index];
+    array2[i] = temp[i].freq;
   }
 
   /* free calloc'ed space */
+  free(temp);
   free(temp1);
 }
 
@@ -1545,23 +1828,29 @@ void emcalc(int *numgeno, int *obspheno,
 	    double *hap_freq, double *mle, int n_haplo, int n_unique_geno,
 	    int n_unique_pheno, int n_recs, int *xhaplo, int (*xgeno)[2], 
 	    int *error_flag, int *iter_count, double *loglike, 
-	    double *haplo_freq_sum, int permu, int (*gp)[MAX_ROWS])
+	    double *haplo_freq_sum, int permu, int *gp_start, int *gp)
 {
   int i, j, k = 0;
   int done, decr_loglike_count, tot_hap = 0;
   int iter, k_pheno, i_geno, j_geno, i_haplo, j_haplo = 0;
+  int n_hp = 0;
 
-  CALLOC_ARRAY_DIM1(double, unambig, MAX_HAPLOS);
-  CALLOC_ARRAY_DIM1(double, ambig, MAX_HAPLOS);
+  CALLOC_ARRAY_DIM1(double, unambig, n_haplo);
+  CALLOC_ARRAY_DIM1(double, ambig, n_haplo);
 
   double ambig_sum = 0.0;
 
-  CALLOC_ARRAY_DIM1(double, addto_ambig, MAX_HAPLOS);
+  CALLOC_ARRAY_DIM1(double, addto_ambig, n_haplo);
 
   double expected_freq, expected_freq_sum, normed_addto_ambig_sum, diff = 0.0; 
 
-  CALLOC_ARRAY_DIM1(double, geno_freq, MAX_GENOS);
-  CALLOC_ARRAY_DIM1(double, pheno_freq, MAX_ROWS);
+  CALLOC_ARRAY_DIM1(double, geno_freq, n_unique_geno);
+  CALLOC_ARRAY_DIM1(double, pheno_freq, n_unique_pheno);
+
+  /* the distinct haplotypes of the ith ambiguous phenotype, in
+     ascending order, are hp[hp_start[i]] up to hp[hp_start[i + 1]] */
+  CALLOC_ARRAY_DIM1(int, hp_start, n_unique_pheno + 1);
+  int *hp = NULL;
 
   double prev_loglike = 0.0, freqsum = 0.0;
 
@@ -1589,9 +1878,13 @@ void emcalc(int *numgeno, int *obspheno,
   /* Pre-process for first iteration */
   for (i = 0; i < n_unique_pheno; i++)
   {
+    hp_start[i] = n_hp;
+    if (numgeno[i] > 1)
+      hp = (int *)xrealloc(hp, (n_hp + 2 * numgeno[i]) * sizeof(int));
+
     for (j = 0; j < numgeno[i]; j++)
     {
-      j_geno = gp[j][i];
+      j_geno = gp[gp_start[i] + j];
       i_haplo = xgeno[j_geno][0]; 
       j_haplo = xgeno[j_geno][1]; 
       if (numgeno[i] == 1)
@@ -1603,9 +1896,23 @@ void emcalc(int *numgeno, int *obspheno,
       {
         ambig[i_haplo] += (double)obspheno[i] / (double)numgeno[i];
         ambig[j_haplo] += (double)obspheno[i] / (double)numgeno[i];
+        hp[n_hp++] = i_haplo;
+        hp[n_hp++] = j_haplo;
       }
     }
+
+    /* keep each haplotype once */
+    if (numgeno[i] > 1)
+    {
+      qsort(hp + hp_start[i], n_hp - hp_start[i], sizeof(int), compare_ints);
+      k = hp_start[i];
+      for (j = hp_start[i] + 1; j < n_hp; j++)
+        if (hp[j] != hp[k])
+          hp[++k] = hp[j];
+      n_hp = k + 1;
+    }
   }
+  hp_start[n_unique_pheno] = n_hp;
 
   iter = 0;
 
@@ -1626,7 +1933,7 @@ void emcalc(int *numgeno, int *obspheno,
       mle[i] = hap_freq[i];
     }
     *loglike = loglikelihood(numgeno, mle, obspheno, n_haplo,
-      n_unique_geno, n_unique_pheno, xhaplo, xgeno, permu, gp);
+      n_unique_geno, n_unique_pheno, xhaplo, xgeno, permu, gp_start, gp);
   }
 
   /* Begin E-M iterations on ambiguous phenos */
@@ -1646,7 +1953,7 @@ void emcalc(int *numgeno, int *obspheno,
           expected_freq_sum = 0;
           for (i = 0; i < numgeno[k_pheno]; i++)
           {
-            i_geno = gp[i][k_pheno];
+            i_geno = gp[gp_start[k_pheno] + i];
             {
               i_haplo = xgeno[i_geno][0];
               j_haplo = xgeno[i_geno][1];
@@ -1677,12 +1984,29 @@ void emcalc(int *numgeno, int *obspheno,
             *error_flag = 2;
           }
           normed_addto_ambig_sum = 0;
-          for (i = 0; i < n_haplo; i++)
+          if (expected_freq_sum != 0 && !isnan(expected_freq_sum))
           {
-            addto_ambig[i] = addto_ambig[i] / expected_freq_sum;
-            normed_addto_ambig_sum += addto_ambig[i];
-            ambig[i] += addto_ambig[i];
-            addto_ambig[i] = 0;             /* reset for next pheno */
+            /* only haplotypes of the current pheno have anything
+               to add, the rest would add exactly zero */
+            for (j = hp_start[k_pheno]; j < hp_start[k_pheno + 1]; j++)
+            {
+              i = hp[j];
+              addto_ambig[i] = addto_ambig[i] / expected_freq_sum;
+              normed_addto_ambig_sum += addto_ambig[i];
+              ambig[i] += addto_ambig[i];
+              addto_ambig[i] = 0;             /* reset for next pheno */
+            }
+          }
+          else
+          {
+            /* 0/0 is NaN, which must reach every haplotype as before */
+            for (i = 0; i < n_haplo; i++)
+            {
+              addto_ambig[i] = addto_ambig[i] / expected_freq_sum;
+              normed_addto_ambig_sum += addto_ambig[i];
+              ambig[i] += addto_ambig[i];
+              addto_ambig[i] = 0;             /* reset for next pheno */
+            }
           }
 
           diff = normed_addto_ambig_sum - 2 * (double)obspheno[k_pheno];
@@ -1722,7 +2046,7 @@ void emcalc(int *numgeno, int *obspheno,
         pheno_freq[i] = 0;
         for (j = 0; j < numgeno[i]; j++)
         {
-          j_geno = gp[j][i];
+          j_geno = gp[gp_start[i] + j];
           pheno_freq[i] += geno_freq[j_geno];
         }
 
@@ -1787,13 +2111,15 @@ void emcalc(int *numgeno, int *obspheno,
   free(addto_ambig);
   free(geno_freq);
   free(pheno_freq);
+  free(hp_start);
+  free(hp);
 }
 
 /************************************************************************/
-void haplo_freqs_no_ld(double *hap_freq, double (*allele_freq)[MAX_ALLELES],
-       int (*haplocus)[MAX_LOCI], int *n_unique_allele, int n_loci, int n_haplo)
+void haplo_freqs_no_ld(double *hap_freq, double *allele_freq, int *haplocus,
+		       int *allele_offset, int n_loci, int n_haplo)
 {
-  int i, j, k = 0;
+  int i, k = 0;
 
   for (k = 0; k < n_haplo; k++) 
   { 
@@ -1802,13 +2128,10 @@ void haplo_freqs_no_ld(double *hap_freq, double (*allele_freq)[MAX_ALLELES],
 
   for (i = 0; i < n_loci; i++)
   {
-    for (j = 0; j < n_unique_allele[i]; j++)
+    for (k = 0; k < n_haplo; k++)
     {
-      for (k = 0; k < n_haplo; k++)
-      {
-        if (haplocus[k][i] == j)
-          hap_freq[k] =  hap_freq[k] * allele_freq[i][j];
-      }
+      hap_freq[k] = hap_freq[k] * 
+	allele_freq[allele_offset[i] + haplocus[k * n_loci + i]];
     }
   }
 }
@@ -1816,14 +2139,14 @@ void haplo_freqs_no_ld(double *hap_freq, double (*allele_freq)[MAX_ALLELES],
 /************************************************************************/
 double loglikelihood(int *numgeno, double (*hap_freq), 
          int *obspheno, int n_haplo, int n_unique_geno, int n_unique_pheno, 
-         int *xhaplo, int (*xgeno)[2], int permu, int (*gp)[MAX_ROWS])
+         int *xhaplo, int (*xgeno)[2], int permu, int *gp_start, int *gp)
 
 {
   int i, j = 0;
   int i_haplo, j_haplo, j_geno;
 
-  CALLOC_ARRAY_DIM1(double, geno_freq, MAX_GENOS);
-  CALLOC_ARRAY_DIM1(double, pheno_freq, MAX_ROWS);
+  CALLOC_ARRAY_DIM1(double, geno_freq, n_unique_geno);
+  CALLOC_ARRAY_DIM1(double, pheno_freq, n_unique_pheno);
 
   double loglike = 0.0; 
 
@@ -1849,7 +2172,7 @@ double loglikelihood(int *numgeno, double (*hap_freq),
     pheno_freq[i] = 0;
     for (j = 0; j < numgeno[i]; j++)
     {
-      j_geno = gp[j][i];
+      j_geno = gp[gp_start[i] + j];
       pheno_freq[i] += geno_freq[j_geno];
     }
 
@@ -1869,10 +2192,10 @@ double loglikelihood(int *numgeno, double (*hap_freq),
 }
 
 /************************************************************************/
-void permute_alleles(char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci, int n_recs)
+void permute_alleles(int *data_ar, int n_loci, int n_recs)
 {
-  int j, locus, col_0, col_1, drawn = 0;
-  CALLOC_ARRAY_DIM1(char, buff, NAME_LEN);
+  int j, locus, col_0, col_1, drawn, buff = 0;
+  int n_cols = 2 * n_loci;
 
   /* last locus not permuted */
   for (locus = 0; locus < n_loci-1; locus ++) 
@@ -1882,17 +2205,125 @@ void permute_alleles(char (*data_ar)[MAX_COLS][NAME_LEN], int n_loci, int n_recs
     for (j = n_recs-1; j >= 0; j--)
     {
       drawn = (int) (j * drand48());
-      strcpy(buff, data_ar[drawn][col_0]);
-      strcpy(data_ar[drawn][col_0], data_ar[j][col_0]);
-      strcpy(data_ar[j][col_0], buff);
+      buff = data_ar[drawn * n_cols + col_0];
+      data_ar[drawn * n_cols + col_0] = data_ar[j * n_cols + col_0];
+      data_ar[j * n_cols + col_0] = buff;
   
-      strcpy(buff, data_ar[drawn][col_1]);
-      strcpy(data_ar[drawn][col_1], data_ar[j][col_1]);
-      strcpy(data_ar[j][col_1], buff);
+      buff = data_ar[drawn * n_cols + col_1];
+      data_ar[drawn * n_cols + col_1] = data_ar[j * n_cols + col_1];
+      data_ar[j * n_cols + col_1] = buff;
     }
   }
+}
 
-  /* free calloc'ed space */
-  free(buff);
+/************************************************************************/
+int compare_ints(const void *a, const void *b)
+{
+  return *(const int *)a - *(const int *)b;
+}
+
+/************************************************************************/
+void *xrealloc(void *ptr, size_t size)
+{
+  void *new_ptr = realloc(ptr, size > 0 ? size : 1);
+
+  if (new_ptr == NULL)
+  {
+    fprintf(stderr, "\nOut of memory.\n\n");
+    exit(EXIT_FAILURE);
+  }
+  return new_ptr;
 }
 
+/************************************************************************/
+/* 
+ * key_table: the keys are sequences of 'key_len' ints, numbered from
+ * 0 in the order they are added, and looked up in an open addressing
+ * hash table that is kept at most half full
+ */
+
+unsigned int table_hash(int *key, int key_len)
+/* FNV-1a hash of the bytes of the key */
+{
+  int i;
+  unsigned int hash = 2166136261u;
+  unsigned char *byte = (unsigned char *)key;
+
+  for (i = 0; i < key_len * (int)sizeof(int); i++)
+  {
+    hash ^= byte[i];
+    hash *= 16777619u;
+  }
+  return hash;
+}
+
+void table_init(key_table *table, int key_len)
+{
+  table->key_len = key_len;
+  table->n_keys = 0;
+  table->keys_size = 16;
+  table->keys = (int *)xrealloc(NULL, table->keys_size * key_len * sizeof(int));
+  table->n_slots = 32;
+  table->slots = (int *)calloc(table->n_slots, sizeof(int));
+}
+
+void table_clear(key_table *table)
+{
+  table->n_keys = 0;
+  memset(table->slots, 0, table->n_slots * sizeof(int));
+}
+
+int table_add(key_table *table, int *key, int *added)
+{
+  int i, slot;
+  int key_len = table->key_len;
+  int *known;
+
+  slot = table_hash(key, key_len) & (table->n_slots - 1);
+  while (table->slots[slot] != 0)
+  {
+    known = table->keys + (table->slots[slot] - 1) * key_len;
+    if (!memcmp(known, key, key_len * sizeof(int)))
+    {
+      if (added != NULL)
+	*added = FALSE;
+      return table->slots[slot] - 1;
+    }
+    slot = (slot + 1) & (table->n_slots - 1);
+  }
+
+  /* a new key */
+  if (table->n_keys == table->keys_size)
+  {
+    table->keys_size *= 2;
+    table->keys = (int *)xrealloc(table->keys, 
+				  table->keys_size * key_len * sizeof(int));
+  }
+  memcpy(table->keys + table->n_keys * key_len, key, key_len * sizeof(int));
+  table->slots[slot] = ++table->n_keys;
+
+  /* rehash into twice the slots when half full */
+  if (2 * table->n_keys > table->n_slots)
+  {
+    free(table->slots);
+    table->n_slots *= 2;
+    table->slots = (int *)calloc(table->n_slots, sizeof(int));
+    for (i = 0; i < table->n_keys; i++)
+    {
+      slot = table_hash(table->keys + i * key_len, key_len) & (table->n_slots - 1);
+      while (table->slots[slot] != 0)
+	slot = (slot + 1) & (table->n_slots - 1);
+      table->slots[slot] = i + 1;
+    }
+  }
+
+  if (added != NULL)
+    *added = TRUE;
+  return table->n_keys - 1;
+}
+
+void table_free(key_table *table)
+{
+  free(table->keys);
+  free(table->slots);
+}
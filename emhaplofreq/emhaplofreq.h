@@ -32,15 +32,14 @@ MODIFICATIONS. */
 
 /* a translation from Richard Single's awk programme */ 
 
-#define NAME_LEN    22       /* 10 chars for allele name, plus colon and null */ 
 #define LINE_LEN    132      /* RS changed from 120 to 132=6*2*(10+1) */ 
-#define MAX_ROWS    5000     /* increased from 1023                   */ 
-#define MAX_ALLELES 200      /* increased from 80 for a large dataset */
 #define MAX_LOCI    20 
-#define MAX_COLS    MAX_LOCI * 2 
-                             /* max genotypes:  2^max_loci*max_rows */ 
-#define MAX_GENOS   40000    /* RS changed from 64*MAX_ROWS and then 20000 */
-#define MAX_HAPLOS  30000    /* RS added and changed declaration in main_proc */
+
+/* 
+ * the arrays for the records, alleles, genotypes and haplotypes are
+ * sized from the data, the only fixed limits are MAX_LOCI and the
+ * input line length (LINE_LEN) of the command-line program
+ */
  
 #define CRITERION   0.000001 
 #define MAX_ITER    400      /* RS changed from 200 */
@@ -50,8 +49,6 @@ MODIFICATIONS. */
  
 #define MAX_INIT 50 
 
-#define MAX_GENOS_PER_PHENO 64 /* 2^(max_loci - 1) */
-
 #define MAX_PERMU 1001
 #define MAX_INIT_FOR_PERMU 5 
 
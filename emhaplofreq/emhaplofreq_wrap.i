@@ -41,13 +41,51 @@ MODIFICATIONS. */
 /* 
  * Python entry point to program.
  *
- * Redeclare parameter to extern function as a 3 dimensional array.
- * This is different from the emhaplofreq.c file to coax SWIG into *
- * generating the right typemap for converting a Python list-of-a-list
- * of strings into the appropriate C data structure.
+ * The parameter name 'InMatrix' selects the typemap for converting a
+ * Python list-of-a-list of strings into the array of strings, one
+ * record after another, that emhaplofreq.c expects.
  */
 
-extern int main_proc(FILE *fp, char [MAX_ROWS][MAX_COLS][NAME_LEN], int, int, int, int, int, int, int, int, int, char [1], char [1]);
+extern int main_proc(FILE *fp, char **InMatrix, int, int, int, int, int, int, int, int, int);
+
+/*
+ * Runs a single batch of permutations for the LD permutation test,
+ * returns the status, whether the observed data could be fitted, the
+ * degrees of freedom of the LR test and lists of the likelihood
+ * ratios and error flags of the observed data followed by each
+ * permutation.
+ */
+
+extern int main_proc_batch(FILE *fp, char **InMatrix, int, int, int, int, int, int, int, int, int,
+			   int *OutValue,            // ok_perm0
+			   int *OutValue,            // df_LRtest
+			   int len, double *OutList, // like_ratio
+			   int len, int *OutList);   // error_flag
+
+/*
+ * Integer-coded entry points: the records are given as a buffer of
+ * 2 * n_loci allele codes per record (see 'InBuffer'), each the
+ * position of the allele's name in the list of names of its locus.
+ * The names are a list of lists of strings, one per locus, and the
+ * number of names of each locus is a list of ints.
+ */
+
+extern int main_proc_coded(FILE *fp, int *InBuffer, char **InMatrix, int [MAX_LOCI], int, int, int, int, int, int, int, int, int);
+
+extern int main_proc_batch_coded(FILE *fp, int *InBuffer, char **InMatrix, int [MAX_LOCI], int, int, int, int, int, int, int, int, int,
+				 int *OutValue,            // ok_perm0
+				 int *OutValue,            // df_LRtest
+				 int len, double *OutList, // like_ratio
+				 int len, int *OutList);   // error_flag
+
+/*
+ * Writes the permutation summary for the lists of likelihood ratios
+ * and error flags of the observed data followed by each permutation,
+ * as merged from several runs of main_proc_batch.  The array sizes
+ * only select the typemaps for Python lists, any length is accepted.
+ */
+
+extern int permu_summary(FILE *fp, int, int, int, int, double [MAX_PERMU], int [MAX_PERMU]);
 
 /* 
  * Local variables:
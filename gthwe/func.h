@@ -59,7 +59,10 @@ double cal_const();
 int check_file();
 int read_data();
 long init_rand();
+void init_rand_seed(unsigned int seed);
 int run_data();
+int run_data_chain();
+int run_randomization_counts();
 void print_data();
 void get_interval();
 void select_index();
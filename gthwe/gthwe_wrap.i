@@ -41,11 +41,24 @@ MODIFICATIONS. */
  */
 %{
 extern int run_data(int [], int [], int, int, int, int, int, char *, FILE *, int, int);
+extern int run_data_chain(int [], int [], int, int, int, int, int, int,
+			  int, double *, int, int *, int, int *, int, int *);
 extern int run_randomization(int [], int [], int, int, int, FILE *, int, int);
+extern int run_randomization_counts(int [], int [], int, int, int, int, int *,
+				    int, int *, int, int *);
 %}
 
 extern int run_data(int [], int [], int, int, int, int, int, char *, FILE *, int, int);
+extern int run_data_chain(int [], int [], int, int, int, int, int, int,
+			  int len, double *OutList, // p-value of each chunk
+			  int len, int *OutList,    // switch counts
+			  int len, int *OutList,    // chen_statistic counts by genotype
+			  int len, int *OutList);   // diff_statistic counts by genotype
 extern int run_randomization(int [], int [], int, int, int, FILE *, int, int);
+extern int run_randomization_counts(int [], int [], int, int, int, int,
+				    int *OutValue,            // permutations at most as probable as observed
+				    int len, int *OutList,    // chen_statistic counts by genotype
+				    int len, int *OutList);   // diff_statistic counts by genotype
 
 /* 
  * Local variables:
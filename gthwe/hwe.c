@@ -98,23 +98,37 @@ int main(int argc, char *argv[])
  */
 long init_rand(int testing) 
 {
-  register int i, j;
-  unsigned long xxx[12];
-  
-  unsigned long  conorig=0;
-  unsigned long  tauorig=0;
   long t1;
-  extern unsigned long congrval, tausval;
 
   if (!testing) 
     {
-      srand(time(NULL)); 
+      init_rand_seed(time(NULL)); 
     }
   else {
     /* if invoked in testing mode, fix random number seed so output is deterministic */
-    srand(1234);  
+    init_rand_seed(1234);  
   }
 
+  time(&t1); 
+
+  return (t1);
+}
+
+/* 
+ * init_rand_seed(): initializes random number generator from the
+ * given seed
+ */
+void init_rand_seed(unsigned int seed) 
+{
+  register int i, j;
+  unsigned long xxx[12];
+  
+  unsigned long  conorig=0;
+  unsigned long  tauorig=0;
+  extern unsigned long congrval, tausval;
+
+  srand(seed);
+
   /* seeds selection for Splus type random number generator. */	
   for (i = 0; i < 12; i++) {
     
@@ -136,9 +150,6 @@ long init_rand(int testing)
   while (tauorig > 4294967295. )
     tauorig -= 4294967295.;
   tausval = (unsigned long) tauorig;
-  time(&t1); 
-
-  return (t1);
 }
 
 
@@ -326,9 +337,119 @@ int run_data(int *genotypes, int *allele_array, int no_allele,
   return (0);
 }
 
-int run_randomization(int *genotypes, int *allele_array, int no_allele, 
-		      int total_individuals, int iterations, FILE *outfile,
-		      int header, int testing)
+/* 
+ * run_data_chain(): runs a single Markov chain of 'thegroup' chunks
+ * of 'thesize' steps (after 'thestep' dememorization steps), with
+ * the random number generator seeded from 'seed'.  Nothing is
+ * printed, instead the raw results are returned in the output arrays
+ * so that several independent chains (e.g. run in separate
+ * processes) can be merged by the caller:
+ *
+ * chunk_pvalues: p-value of each chunk (length 'thegroup')
+ * switch_counts: number of steps with no, partial and full switches (length 3)
+ * chen_counts, diff_counts: per-genotype number of steps with a
+ *   statistic at least as large as the observed one (length
+ *   no_allele * (no_allele + 1) / 2)
+ */
+int run_data_chain(int *genotypes, int *allele_array, int no_allele, 
+		   int total_individuals, int thestep, int thegroup, 
+		   int thesize, int seed,
+		   int chunk_len, double *chunk_pvalues,
+		   int switch_len, int *switch_counts,
+		   int chen_len, int *chen_counts,
+		   int diff_len, int *diff_counts)
+{
+  int actual_switch, counter;
+  Index index;
+  double ln_p_observed, ln_p_simulated, constant;
+  register int i, j;
+  int num_genotypes = no_allele * (no_allele + 1) / 2;
+
+  init_rand_seed((unsigned int) seed);
+
+  /* calculate number of alleles of each gamete */
+  cal_n(no_allele, genotypes, allele_array);
+
+  for (i = 0; i < 3; ++i)
+    switch_counts[i] = 0;
+  for (i = 0; i < num_genotypes; ++i)
+    chen_counts[i] = diff_counts[i] = 0;
+
+#ifdef INDIVID_GENOTYPES
+  double *obs_chen_statistic = (double *)calloc(num_genotypes, sizeof(double));
+  double *obs_diff_statistic = (double *)calloc(num_genotypes, sizeof(double));
+
+  init_stats("chen_statistic", chen_statistic, obs_chen_statistic, 
+	     no_allele, total_individuals, 
+	     allele_array, genotypes, stdout);
+  init_stats("diff_statistic", diff_statistic, obs_diff_statistic, 
+	     no_allele, total_individuals, 
+	     allele_array, genotypes, stdout);
+#endif
+
+  constant = cal_const(no_allele, allele_array, total_individuals);
+  
+  ln_p_observed = ln_p_value(genotypes, no_allele, constant);  
+  
+  ln_p_simulated = ln_p_observed; 
+
+  for (i = 0; i < thestep; ++i)
+    {        
+      /* de-memorization for given steps */
+      select_index(&index, no_allele);
+      ln_p_simulated = cal_prob(genotypes, index, ln_p_simulated, &actual_switch);
+      ++switch_counts[actual_switch];
+    }
+  
+  for (i = 0; i < thegroup; ++i)
+    {
+      counter = 0;
+      
+      for (j = 0; j < thesize; ++j)
+	{
+	  select_index(&index, no_allele);
+	  ln_p_simulated = cal_prob(genotypes, index, 
+				    ln_p_simulated, &actual_switch);
+	  
+	  if (LESS_OR_EQUAL(ln_p_simulated, ln_p_observed))  
+	    ++counter;
+	  ++switch_counts[actual_switch];
+
+#ifdef INDIVID_GENOTYPES	  
+	  store_stats("chen_statistic", chen_statistic, obs_chen_statistic, 
+		      chen_counts, no_allele, total_individuals, 
+		      allele_array, genotypes, stdout);
+	  store_stats("diff_statistic", diff_statistic, obs_diff_statistic, 
+		      diff_counts, no_allele, total_individuals, 
+		      allele_array, genotypes, stdout);
+#endif
+	}
+      chunk_pvalues[i] = (double) counter / thesize;
+    }
+
+#ifdef INDIVID_GENOTYPES
+  /* free dynamically-allocated memory  */
+  free(obs_chen_statistic);
+  free(obs_diff_statistic);
+#endif
+
+  return (0);
+}
+
+/*
+ * randomization_counts(): core of the plain Monte Carlo test, runs
+ * 'iterations' permutations of the gametes and counts in 'K' those
+ * at most as probable as the observed data, and in
+ * 'chen_statistic_count' and 'diff_statistic_count' the per-genotype
+ * statistics at least as large as the observed ones.  If 'seed' is
+ * non-zero, the random number generator is seeded with it, otherwise
+ * the GSL default seed is used.
+ */
+static void randomization_counts(int *genotypes, int *allele_array, 
+				 int no_allele, int total_individuals, 
+				 int iterations, int seed, int *K,
+				 int *chen_statistic_count, 
+				 int *diff_statistic_count, FILE *outfile)
 {
   double ln_p_observed; 
   double constant;
@@ -344,11 +465,7 @@ int run_randomization(int *genotypes, int *allele_array, int no_allele,
   /* calculate ln(probability) in observed data */
   ln_p_observed = ln_p_value(genotypes, no_allele, constant);   
 
-#ifdef XML_OUTPUT
-  if (header)
-    xmlfprintf(outfile, 
-	    "\n<hardyweinbergGuoThompson type=\"monte-carlo\">\n");
-#else
+#ifndef XML_OUTPUT
   fprintf(outfile, "Constant: %e, Observed: %e\n", constant, ln_p_observed);
 #endif
 
@@ -363,11 +480,6 @@ int run_randomization(int *genotypes, int *allele_array, int no_allele,
   init_stats("diff_statistic", diff_statistic, obs_diff_statistic, 
 	     no_allele, total_individuals, 
 	     allele_array, genotypes, outfile);
-
-  /* allocate memory for per-genotype counts */
-  int *chen_statistic_count = (int *)calloc(num_genotypes, sizeof(int));
-  int *diff_statistic_count = (int *)calloc(num_genotypes, sizeof(int));
-
 #endif
 
   /* calculate the number of gametes */
@@ -408,13 +520,15 @@ int run_randomization(int *genotypes, int *allele_array, int no_allele,
   gsl_rng_env_setup();
   T = gsl_rng_default;
   r = gsl_rng_alloc (T);
+  if (seed)
+    gsl_rng_set(r, (unsigned long) seed);
 
   /* create empty genotype array */
   int *g = (int *)calloc(num_genotypes, sizeof(int));
 
   /* start permuting index of gametes */
   int permu = 0;
-  int K = 0;
+  *K = 0;
 
   double ln_p_perm;
   for (permu=0; permu < iterations; permu++) {
@@ -458,7 +572,7 @@ int run_randomization(int *genotypes, int *allele_array, int no_allele,
 #endif
 
     if (LESS_OR_EQUAL(ln_p_perm, ln_p_observed))
-      K++;
+      (*K)++;
 
 #ifdef INDIVID_GENOTYPES	  
     /* store the individual genotype stats */
@@ -476,6 +590,39 @@ int run_randomization(int *genotypes, int *allele_array, int no_allele,
       g[i] = 0;
   }
 
+#ifdef INDIVID_GENOTYPES
+  /* free dynamically-allocated memory for stats  */
+  free(obs_chen_statistic);
+  free(obs_diff_statistic);
+#endif
+
+  /* free dynamically-allocated memory  */
+  free(g);
+  free(s);
+  gsl_rng_free(r);
+}
+
+int run_randomization(int *genotypes, int *allele_array, int no_allele, 
+		      int total_individuals, int iterations, FILE *outfile,
+		      int header, int testing)
+{
+  int K;
+  int num_genotypes = no_allele * (no_allele + 1) / 2;
+
+#ifdef XML_OUTPUT
+  if (header)
+    xmlfprintf(outfile, 
+	    "\n<hardyweinbergGuoThompson type=\"monte-carlo\">\n");
+#endif
+
+  /* allocate memory for per-genotype counts */
+  int *chen_statistic_count = (int *)calloc(num_genotypes, sizeof(int));
+  int *diff_statistic_count = (int *)calloc(num_genotypes, sizeof(int));
+
+  randomization_counts(genotypes, allele_array, no_allele, 
+		       total_individuals, iterations, 0, &K,
+		       chen_statistic_count, diff_statistic_count, outfile);
+
   double p_value = (double)K/iterations;
 
 #ifdef XML_OUTPUT
@@ -492,21 +639,39 @@ int run_randomization(int *genotypes, int *allele_array, int no_allele,
 	      no_allele, iterations, outfile);
   print_stats("diff_statistic", diff_statistic_count, 
 	      no_allele, iterations, outfile);
+#endif
 
-  /* free dynamically-allocated memory for stats  */
-  free(obs_chen_statistic);
   free(chen_statistic_count);
-
-  free(obs_diff_statistic);
   free(diff_statistic_count);
-#endif
-
-
-  /* free dynamically-allocated memory  */
-  free(g);
-  free(s);
 
   if (header)
     xmlfprintf(outfile, "</hardyweinbergGuoThompson>\n");
   return (0);
 }
+
+/* 
+ * run_randomization_counts(): runs the plain Monte Carlo test like
+ * run_randomization(), but instead of printing the results returns
+ * them to the caller, with the random number generator seeded from
+ * 'seed' (if non-zero): the number of permutations at most as probable
+ * as the observed data and the per-genotype counts of statistics at
+ * least as large as the observed ones (each of length 
+ * no_allele * (no_allele + 1) / 2)
+ */
+int run_randomization_counts(int *genotypes, int *allele_array, 
+			     int no_allele, int total_individuals, 
+			     int iterations, int seed, int *K,
+			     int chen_len, int *chen_counts,
+			     int diff_len, int *diff_counts)
+{
+  register int i;
+  int num_genotypes = no_allele * (no_allele + 1) / 2;
+
+  for (i = 0; i < num_genotypes; ++i)
+    chen_counts[i] = diff_counts[i] = 0;
+
+  randomization_counts(genotypes, allele_array, no_allele, 
+		       total_individuals, iterations, seed, K,
+		       chen_counts, diff_counts, stdout);
+  return (0);
+}
@@ -50,3 +50,29 @@ def run_pypop_process(inifile, popfile, args=[]):
     process.communicate()
     exit_code = process.wait()  # wait until script completed
     return exit_code
+
+def semi_typed_matrix(matrixClass=None):
+    """Matrix of 12 individuals at loci 'A', 'B' and 'C' with
+    semi-typed individuals (only one allele typed), untyped
+    individuals and one unsequenced site ('####') at 'A'.  At 'C' only
+    one semi-typed individual has any data."""
+    from PyPop.Utils import StringMatrix
+    if matrixClass is None:
+        matrixClass = StringMatrix
+    rows = [(('02', '01'), ('B07', 'B02'), ('****', '****')),
+            (('01', '01'), ('B02', 'B02'), ('****', '****')),
+            (('03', '01'), ('****', 'B07'), ('C1', '****')),
+            (('****', '02'), ('B11', 'B02'), ('****', '****')),
+            (('02', '02'), ('B02', '****'), ('****', '****')),
+            (('01', '02'), ('B07', 'B07'), ('****', '****')),
+            (('03', '****'), ('B11', 'B11'), ('****', '****')),
+            (('****', '****'), ('B02', 'B07'), ('****', '****')),
+            (('01', '####'), ('****', '****'), ('****', '****')),
+            (('02', '01'), ('B07', 'B11'), ('****', '****')),
+            (('01', '03'), ('B02', 'B11'), ('****', '****')),
+            (('02', '03'), ('B07', 'B02'), ('****', '****'))]
+    matrix = matrixClass(len(rows), ['A', 'B', 'C'])
+    for row in range(len(rows)):
+        for locus, genotype in zip(['A', 'B', 'C'], rows[row]):
+            matrix[row, locus] = genotype
+    return matrix
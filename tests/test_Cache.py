@@ -0,0 +1,123 @@
+import base
+import unittest
+import os, shutil, tempfile
+import numpy as np
+from ConfigParser import ConfigParser
+from PyPop.ParseFile import ParseGenotypeFile
+from PyPop.Cache import DataCache
+
+POPFILE = './tests/data/USAFEL-UchiTelle-small.pop'
+
+class DataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, 'USAFEL-UchiTelle-small.pop')
+        shutil.copy(POPFILE, self.fileName)
+        self.config = ConfigParser()
+        self.config.read('./tests/data/minimal.ini')
+        self.config.add_section('Filters')
+        self.config.set('Filters', 'filtersToApply', 'AnthonyNolan')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def dataCache(self, version='x'):
+        return DataCache(fileName=self.fileName, config=self.config,
+                         sections=['ParseGenotypeFile', 'Filters'],
+                         version=version)
+
+    def parse(self, **kw):
+        return ParseGenotypeFile(self.fileName,
+                                 validPopFields=self.config.get('ParseGenotypeFile', 'validPopFields'),
+                                 validSampleFields=self.config.get('ParseGenotypeFile', 'validSampleFields'),
+                                 **kw)
+
+    def test_hit(self):
+        for codedMatrix in [0, 1]:
+            parsed = self.parse(codedMatrix=codedMatrix)
+            matrix = parsed.getMatrix()
+            self.dataCache().save(parsed, matrix, '####', '<filter/>')
+            self.assertTrue(os.path.isfile(self.fileName + '.cache'))
+
+            cachedParsed, unsequencedSite, filterLog = self.dataCache().load()
+            cachedMatrix = cachedParsed.getMatrix()
+            self.assertEqual(cachedMatrix.__class__, matrix.__class__)
+            self.assertEqual(cachedMatrix.colList, matrix.colList)
+            self.assertEqual(cachedMatrix.extraList, matrix.extraList)
+            self.assertEqual(cachedMatrix.headerLines, matrix.headerLines)
+            self.assertEqual(cachedMatrix.array.tolist(), matrix.array.tolist())
+            self.assertEqual(cachedParsed.getPopData().items(),
+                             parsed.getPopData().items())
+            self.assertEqual(cachedParsed.popName, parsed.popName)
+            self.assertEqual(unsequencedSite, '####')
+            self.assertEqual(filterLog, '<filter/>')
+
+    def test_format(self):
+        parsed = self.parse(codedMatrix=1)
+        self.dataCache().save(parsed, parsed.getMatrix())
+        # only the input file and the cache, no temporary file left over
+        self.assertEqual(sorted(os.listdir(self.tmpDir)),
+                         ['USAFEL-UchiTelle-small.pop',
+                          'USAFEL-UchiTelle-small.pop.cache'])
+
+        # plain arrays, readable without unpickling
+        data = np.load(self.fileName + '.cache', allow_pickle=False)
+        self.assertEqual(sorted(data.files),
+                         ['codes0', 'codes1', 'codes2', 'state'])
+        self.assertEqual(data['codes0'].dtype, np.int32)
+        self.assertEqual(data['codes0'].tolist(),
+                         parsed.getMatrix().getCodes('A').tolist())
+        data.close()
+
+    def test_non_ascii(self):
+        parsed = self.parse()
+        parsed.getPopData()['ethnic'] = 'T\xe9lle'
+        matrix = parsed.getMatrix()
+        matrix.setColumn('A', ['0\xb01'] * matrix.rowCount,
+                         ['02'] * matrix.rowCount)
+        self.dataCache().save(parsed, matrix, filterLog='<f>\xe9</f>')
+
+        cachedParsed, unsequencedSite, filterLog = self.dataCache().load()
+        self.assertEqual(cachedParsed.getPopData()['ethnic'], 'T\xe9lle')
+        self.assertEqual(type(cachedParsed.getPopData()['ethnic']), str)
+        self.assertEqual(cachedParsed.getMatrix()['A'], matrix['A'])
+        self.assertEqual(cachedParsed.getMatrix()['A'][0], ['0\xb01', '02'])
+        self.assertEqual(filterLog, '<f>\xe9</f>')
+
+    def test_miss(self):
+        self.assertEqual(self.dataCache().load(), None)
+        # an unreadable cache is ignored
+        open(self.fileName + '.cache', 'wb').write('not a cache')
+        self.assertEqual(self.dataCache().load(), None)
+
+    def test_file_changed(self):
+        parsed = self.parse()
+        self.dataCache().save(parsed, parsed.getMatrix())
+        self.assertNotEqual(self.dataCache().load(), None)
+
+        # change one allele
+        data = open(self.fileName).read()
+        open(self.fileName, 'w').write(data[:-1] + '2')
+        self.assertEqual(self.dataCache().load(), None)
+
+    def test_config_changed(self):
+        parsed = self.parse()
+        self.dataCache().save(parsed, parsed.getMatrix())
+
+        # sections that don't determine the data don't matter
+        self.config.set('HardyWeinberg', 'lumpBelow', '2')
+        self.assertNotEqual(self.dataCache().load(), None)
+
+        # options of parsing and filtering sections do
+        self.config.set('Filters', 'filtersToApply', 'DigitBinning')
+        self.assertEqual(self.dataCache().load(), None)
+        self.config.set('Filters', 'filtersToApply', 'AnthonyNolan')
+        self.assertNotEqual(self.dataCache().load(), None)
+        self.config.set('ParseGenotypeFile', 'untypedAllele', '0000')
+        self.assertEqual(self.dataCache().load(), None)
+
+        # as does the version
+        self.config.set('ParseGenotypeFile', 'untypedAllele', '****')
+        self.assertNotEqual(self.dataCache().load(), None)
+        self.assertEqual(self.dataCache(version='y').load(), None)
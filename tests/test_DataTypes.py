@@ -0,0 +1,77 @@
+import base
+import pytest
+from PyPop.Utils import StringMatrix, CodedStringMatrix
+from PyPop.DataTypes import Genotypes
+
+# expected (alleleTable, total, untypedIndividuals, unsequencedSites)
+# and genotypes for 'base.semi_typed_matrix()', as computed by the
+# original per-individual code
+
+# semi-typed individuals are dropped, but unsequenced sites counted
+GENOTYPED = {
+    'A': (({'01': 7, '02': 6, '03': 3}, 16, 3, 1),
+          [('01', '02'), ('01', '01'), ('01', '03'), ('02', '02'),
+           ('01', '02'), ('01', '02'), ('01', '03'), ('02', '03')]),
+    'B': (({'B02': 7, 'B07': 6, 'B11': 5}, 18, 3, 0),
+          [('B02', 'B07'), ('B02', 'B02'), ('B02', 'B11'), ('B07', 'B07'),
+           ('B11', 'B11'), ('B02', 'B07'), ('B07', 'B11'), ('B02', 'B11'),
+           ('B02', 'B07')]),
+    'C': (({}, 0, 12, 0), []),
+    }
+
+# every individual is kept, untyped alleles count as half an
+# individual, and unsequenced sites are not tallied
+SEMI_TYPED = {
+    'A': (({'01': 8, '02': 7, '03': 4}, 19, 2.0, 0),
+          [('01', '02'), ('01', '01'), ('01', '03'), ('****', '02'),
+           ('02', '02'), ('01', '02'), ('****', '03'), ('****', '****'),
+           ('####', '01'), ('01', '02'), ('01', '03'), ('02', '03')]),
+    'B': (({'B02': 8, 'B07': 7, 'B11': 5}, 20, 2.0, 0),
+          [('B02', 'B07'), ('B02', 'B02'), ('****', 'B07'), ('B02', 'B11'),
+           ('****', 'B02'), ('B07', 'B07'), ('B11', 'B11'), ('B02', 'B07'),
+           ('****', '****'), ('B07', 'B11'), ('B02', 'B11'), ('B02', 'B07')]),
+    'C': (({'C1': 1}, 1, 11.5, 0),
+          [('****', '****')] * 2 + [('****', 'C1')] + [('****', '****')] * 9),
+    }
+
+@pytest.mark.parametrize("matrixClass", [StringMatrix, CodedStringMatrix])
+@pytest.mark.parametrize("allowSemiTyped, expected, lociWithData",
+                         [(0, GENOTYPED, 2), (1, SEMI_TYPED, 3)])
+def test_Genotypes_semi_typed(matrixClass, allowSemiTyped, expected,
+                              lociWithData):
+    genotypes = Genotypes(matrix=base.semi_typed_matrix(matrixClass),
+                          unsequencedSite='####',
+                          allowSemiTyped=allowSemiTyped)
+    assert genotypes.totalIndivCount == 12
+    assert genotypes.totalLociWithData == lociWithData
+
+    for locus in ['A', 'B', 'C']:
+        alleleCount, locusData = expected[locus]
+        assert genotypes.getAlleleCountAt(locus) == alleleCount
+        # untyped individuals are a float only when counted in halves
+        assert type(genotypes.getAlleleCountAt(locus)[2]) == \
+               type(alleleCount[2])
+        assert genotypes.getLocusDataAt(locus) == locusData
+
+@pytest.mark.parametrize("allowSemiTyped", [0, 1])
+def test_Genotypes_semi_typed_lumped(allowSemiTyped):
+    genotypes = Genotypes(matrix=base.semi_typed_matrix(),
+                          unsequencedSite='####',
+                          allowSemiTyped=allowSemiTyped)
+    alleleTable, total, untyped, unsequenced = \
+                 genotypes.getAlleleCountAt('A', lumpValue=4)
+    if allowSemiTyped:
+        assert alleleTable == {'01': 8, '02': 7, 'lump': 4}
+        assert genotypes.getLocusDataAt('A', lumpValue=4) == \
+               [('01', '02'), ('01', '01'), ('01', 'lump'), ('****', '02'),
+                ('02', '02'), ('01', '02'), ('****', 'lump'),
+                ('****', '****'), ('####', '01'), ('01', '02'),
+                ('01', 'lump'), ('02', 'lump')]
+    else:
+        assert alleleTable == {'01': 7, '02': 6, 'lump': 3}
+        assert genotypes.getLocusDataAt('A', lumpValue=4) == \
+               [('01', '02'), ('01', '01'), ('01', 'lump'), ('02', '02'),
+                ('01', '02'), ('01', '02'), ('01', 'lump'), ('02', 'lump')]
+    # no allele at 'B' is below the lump threshold
+    assert genotypes.getAlleleCountAt('B', lumpValue=4)[0] == \
+           genotypes.getAlleleCountAt('B')[0]
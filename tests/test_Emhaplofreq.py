@@ -0,0 +1,81 @@
+import base
+import re
+import random
+from py.test import approx
+from cStringIO import StringIO
+from PyPop.Utils import StringMatrix, XMLOutputStream
+from PyPop.Haplo import Emhaplofreq
+
+def random_matrix(numRows, numAlleles, loci=['A', 'B'], seed=1234):
+    """Matrix of 'numRows' individuals with every one of 'numAlleles'
+    alleles present at each locus"""
+    rng = random.Random(seed)
+    matrix = StringMatrix(numRows, loci)
+    for locus in loci:
+        alleles = ['%s*%03d' % (locus, i) for i in range(numAlleles)]
+        # every allele at least once, the rest drawn at random
+        column = alleles + [rng.choice(alleles) \
+                            for i in range(2*numRows - numAlleles)]
+        rng.shuffle(column)
+        for row in range(numRows):
+            matrix[row, locus] = (column[2*row], column[2*row + 1])
+    return matrix
+
+def run_allPairwise(matrix, **kw):
+    output = StringIO()
+    haplo = Emhaplofreq(matrix, stream=XMLOutputStream(output), testMode=True)
+    haplo.allPairwise(haplosToShow=[], **kw)
+    return output.getvalue()
+
+def test_Emhaplofreq_beyond_old_limits():
+    """
+    More individuals (5000) and alleles per locus (200) than the old
+    compile-time limits of emhaplofreq
+    """
+    numRows, numAlleles = 5100, 260
+    output = run_allPairwise(random_matrix(numRows, numAlleles),
+                             numInitCond=1, numPermutations=0,
+                             numPermuInitCond=1, haploSuppressFlag=0)
+
+    assert '<individcount role="after-filtering">%d</individcount>' \
+           % numRows in output
+    assert '<condition role="converged"/>' in output
+
+    freqs = [float(f) for f in
+             re.findall(r'<haplotype name="[^"]*"><frequency>([^<]*)<', output)]
+    assert len(freqs) > 0
+    # frequencies are printed to 5 decimal places
+    assert sum(freqs) == approx(1.0, abs=len(freqs) * 0.5e-5)
+
+    ld = re.search(r'<linkagediseq>(.*)</linkagediseq>', output, re.S).group(1)
+    values = re.findall(r'>([^<>]*\d[^<>]*)<', ld)
+    assert len(values) > 0
+    for value in values:
+        assert not re.search('nan|inf', value, re.I), value
+
+def test_Emhaplofreq_permutation_processes():
+    """
+    Permutations run in worker processes are all counted, and the
+    observed data is estimated as when run in this process.  The
+    p-value itself depends on the number of processes, each permuting
+    from its own seed
+    """
+    numPermutations = 21
+    matrix = random_matrix(40, 5)
+
+    outputs = []
+    for numProcesses in [1, 2]:
+        output = StringIO()
+        haplo = Emhaplofreq(matrix, stream=XMLOutputStream(output),
+                            testMode=True)
+        haplo.estLinkageDisequilibrium('A:B', numInitCond=5,
+                                       numPermutations=numPermutations,
+                                       numPermuInitCond=2,
+                                       numProcesses=numProcesses)
+        outputs.append(output.getvalue())
+
+    observed = []
+    for output in outputs:
+        assert '<pvalue totalperm="%d">' % (numPermutations - 1) in output
+        observed.append(output[:output.index('<permutationSummary>')])
+    assert observed[0] == observed[1]
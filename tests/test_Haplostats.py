@@ -242,6 +242,76 @@ def test_Haplostats_PyPopStringMatrix():
     assert ALD_1_2 == approx(0.86953788372)
     assert ALD_2_1 == approx(0.849835490713)
         
+def test_Haplostats_allPairwise_processes():
+    """
+    Pairs estimated in worker processes give the same output as
+    estimating them one after the other
+    """
+
+    from PyPop.Utils import StringMatrix, XMLOutputStream
+    from PyPop.Haplo import Haplostats
+    from cStringIO import StringIO
+
+    control = {'max_iter': 5000,
+               'min_posterior': 0.000000001,
+               'tol': 0.00001,
+               'insert_batch_size': 2,
+               'random_start': 0,
+               'verbose': 0,
+               'max_haps_limit': 10000 }
+
+    geno = StringMatrix(5, ["DRB", "B", "C"])
+    genotypes = {'DRB': [('4', '11'), ('2', '7'), ('1', '13'), ('7', '7'), ('8', '11')],
+                 'B': [('62', '61'), ('7', '44'), ('27', '62'), ('7', '44'), ('51', '55')],
+                 'C': [('3', '12'), ('10', '88'), ('1', '12'), ('3', '10'), ('1', '7')]}
+    for locus in genotypes:
+        for row in range(5):
+            geno[row, locus] = genotypes[locus][row]
+
+    outputs = []
+    for numProcesses in [1, 2]:
+        output = StringIO()
+        haplo = Haplostats(geno, stream=XMLOutputStream(output), testMode=True)
+        haplo.allPairwise(weight=None, control=control, numInitCond=3,
+                          numProcesses=numProcesses)
+        outputs.append(output.getvalue())
+
+    assert outputs[0].count('<group') == 3
+    assert outputs[0] == outputs[1]
+
+def test_Haplostats_initial_conditions_processes():
+    """
+    Initial conditions run in worker processes pick the same best fit
+    as running them one after the other
+    """
+
+    from PyPop.Utils import StringMatrix
+    from PyPop.Haplo import Haplostats
+
+    control = {'max_iter': 5000,
+               'min_posterior': 0.000000001,
+               'tol': 0.00001,
+               'insert_batch_size': 2,
+               'random_start': 0,
+               'verbose': 0,
+               'max_haps_limit': 10000 }
+
+    geno = StringMatrix(5, ["DRB", "B"])
+    genotypes = {'DRB': [('4', '11'), ('2', '7'), ('1', '13'), ('7', '7'), ('8', '11')],
+                 'B': [('62', '61'), ('7', '44'), ('27', '62'), ('7', '44'), ('51', '55')]}
+    for locus in genotypes:
+        for row in range(5):
+            geno[row, locus] = genotypes[locus][row]
+
+    haplo = Haplostats(geno)
+    serial = haplo.estHaplotypes(weight=None, control=control, numInitCond=10, testMode=True)
+    parallel = haplo.estHaplotypes(weight=None, control=control, numInitCond=10, testMode=True,
+                                   numProcesses=3)
+
+    # same as the serial result in test_Haplostats_PyPopStringMatrix
+    assert parallel[1] == -18.173826527916734
+    assert parallel[:11] == serial[:11]
+
 def test_Haplostats_compute_LD_sym():
     """
     Test LD computations in a standalone mode
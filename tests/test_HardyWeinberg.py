@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+import base
+import unittest
+from numpy import isnan
+from py.test import approx
+import PyPop.HardyWeinberg
+from PyPop.HardyWeinberg import HardyWeinberg, HardyWeinbergBatch, \
+     HardyWeinbergEnumeration, HardyWeinbergGuoThompson, GuoThompsonResult, \
+     genotypeTable, GENOTYPE_SEPARATOR
+from PyPop.Utils import XMLOutputStream
+from PyPop.Cache import ResultCache
+from PyPop.DataTypes import Genotypes
+from cStringIO import StringIO
+import os, re, sys, time, types, tempfile, shutil, json
+
+def locus_data(genotypes):
+    # expand a list of (allele1, allele2, count) into genotype tuples
+    data = []
+    for allele1, allele2, count in genotypes:
+        data.extend([(allele1, allele2)] * count)
+    return data
+
+def allele_count(data):
+    counts = {}
+    for genotype in data:
+        for allele in genotype:
+            counts[allele] = counts.get(allele, 0) + 1
+    return counts, 2 * len(data)
+
+class HardyWeinbergBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loci = [
+            locus_data([('01', '01', 30), ('01', '02', 40), ('02', '02', 20),
+                        ('01', '03', 6), ('02', '03', 3), ('03', '03', 1)]),
+            locus_data([('01', '01', 10), ('01', '02', 15), ('02', '02', 9)]),
+            locus_data([('05', '05', 12)]),
+            ]
+
+    def test_matches_HardyWeinberg(self):
+        tables = [genotypeTable(data)[1] for data in self.loci]
+        batch = HardyWeinbergBatch(tables, lumpBelow=5)
+
+        self.assertEqual(batch.tableCount, 3)
+        for i, data in enumerate(self.loci):
+            hw = HardyWeinberg(data, allele_count(data), lumpBelow=5)
+            self.assertEqual(batch.totalHomsObs[i], hw.totalHomsObs)
+            self.assertEqual(batch.totalHetsObs[i], hw.totalHetsObs)
+            self.assertEqual(batch.totalHomsExp[i], approx(hw.totalHomsExp))
+            self.assertEqual(batch.flagCommons[i], hw.flagCommons)
+            self.assertEqual(batch.flagLumps[i], hw.flagLumps)
+            if hw.flagCommons:
+                self.assertEqual(batch.HWChisq[i], approx(hw.HWChisq))
+                self.assertEqual(batch.HWChisqDf[i], hw.HWChisqDf)
+                # NaN for a monomorphic locus (no degrees of freedom)
+                self.assertEqual(batch.HWChisqPval[i],
+                                 approx(hw.HWChisqPval, nan_ok=True))
+            else:
+                self.assertTrue(isnan(batch.HWChisq[i]))
+
+            # per-genotype statistics
+            for j in (batch.genotypeTable == i).nonzero()[0]:
+                genotype = sorted([hw.observedAlleles[batch.genotypeRows[j]],
+                                   hw.observedAlleles[batch.genotypeCols[j]]])
+                genotype = GENOTYPE_SEPARATOR.join(genotype)
+                self.assertEqual(batch.expectedGenotypeCounts[j],
+                                 approx(hw.expectedGenotypeCounts[genotype]))
+                if hw.chisqByGenotype.has_key(genotype):
+                    self.assertEqual(batch.pvalByGenotype[j],
+                                     approx(hw.pvalByGenotype[genotype]))
+                else:
+                    self.assertTrue(isnan(batch.pvalByGenotype[j]))
+
+    def test_heterozygote_orientation(self):
+        # heterozygotes may be counted on either side of the diagonal
+        tables = [[[30, 25], [15, 20]], [[30, 40], [0, 20]]]
+        batch = HardyWeinbergBatch(tables)
+        self.assertEqual(list(batch.observedGenotypeCounts), [30, 40, 20] * 2)
+        self.assertEqual(batch.HWChisq[0], batch.HWChisq[1])
+
+class HardyWeinbergOutputTest(unittest.TestCase):
+
+    def test_semi_typed(self):
+        # the semi-typed individuals are dropped from genotyped data,
+        # the output must be byte-identical to that of the original
+        # per-genotype table code
+        genotypes = Genotypes(matrix=base.semi_typed_matrix(),
+                              unsequencedSite='####', allowSemiTyped=0)
+        output = StringIO()
+        stream = XMLOutputStream(output)
+        for lumpValue in [0, 4]:
+            for locus in ['A', 'B']:
+                hw = HardyWeinberg(genotypes.getLocusDataAt(locus, lumpValue),
+                                   genotypes.getAlleleCountAt(locus, lumpValue),
+                                   lumpBelow=2)
+                hw.serializeTo(stream, allelelump=lumpValue)
+        gold = open('./tests/data/output/semi-typed-hardyweinberg.xml').read()
+        self.assertEqual(output.getvalue(), gold)
+
+class GuoThompsonResultTest(unittest.TestCase):
+
+    def test_merge_chains(self):
+        result = GuoThompsonResult(2, dememorizationSteps=10,
+                                   samplingNum=4, samplingSize=100)
+        result.addChain([0.1, 0.2], [30, 20, 160], [1, 2, 3], [4, 5, 6])
+        result.addChain([0.3, 0.4], [40, 10, 160], [1, 0, 1], [0, 0, 0])
+
+        self.assertEqual(result.chains, 2)
+        self.assertEqual(result.steps, 400)
+        self.assertEqual(result.getPvalue(), approx(0.25))
+        self.assertEqual(result.switchCounts, [70, 30, 320])
+        self.assertEqual(result.getGenotypePvalues('chen_statistic'),
+                         [0.005, 0.005, 0.01])
+
+        stream = StringIO()
+        result.serializeTo(XMLOutputStream(stream))
+        self.assertTrue('<chains>2</chains>' in stream.getvalue())
+        self.assertTrue('<percent-partial>  7.14</percent-partial>' in stream.getvalue())
+
+    def test_monte_carlo(self):
+        result = GuoThompsonResult(2, monteCarlo=1)
+        result.addPermutations(1000, 50, [0, 10, 20], [0, 0, 1000])
+        self.assertEqual(result.getPvalue(), 0.05)
+
+        stream = StringIO()
+        result.serializeTo(XMLOutputStream(stream))
+        self.assertTrue(stream.getvalue().startswith(
+            '<steps>1000</steps>\n<pvalue type="overall">0.05</pvalue>\n'))
+
+    def test_adaptive_stopping(self):
+        result = GuoThompsonResult(2, monteCarlo=1)
+        result.addPermutations(1000, 50, [0, 10, 20], [0, 0, 1000])
+        result.addPermutations(1000, 50, [0, 10, 20], [0, 0, 1000])
+        result.stoppingRule = 'stderr'
+        self.assertEqual(result.getStderr(), approx((0.05*0.95/2000)**0.5))
+
+        stream = StringIO()
+        result.serializeTo(XMLOutputStream(stream))
+        self.assertTrue(stream.getvalue().startswith(
+            '<steps>2000</steps>\n<stoppingRule>stderr</stoppingRule>\n'))
+
+    def test_stopping_stderr(self):
+        # no extreme permutation: the standard error is 0, but the
+        # stopping rules use that of the estimate 1 / (n + 2)
+        result = GuoThompsonResult(2, monteCarlo=1)
+        result.addPermutations(50, 0, [0, 0, 0], [0, 0, 0])
+        self.assertEqual(result.getStderr(), 0.0)
+        self.assertEqual(result.getStoppingStderr(),
+                         approx((1/52. * 51/52. / 52)**0.5))
+        # same for a p-value of 1
+        result = GuoThompsonResult(2, monteCarlo=1)
+        result.addPermutations(50, 50, [0, 0, 0], [0, 0, 0])
+        self.assertEqual(result.getStoppingStderr(),
+                         approx((51/52. * 1/52. / 52)**0.5))
+        # and close to the standard error otherwise
+        result = GuoThompsonResult(2, monteCarlo=1)
+        result.addPermutations(2000, 100, [0, 0, 0], [0, 0, 0])
+        self.assertEqual(result.getStoppingStderr(),
+                         approx(result.getStderr(), rel=0.01))
+
+    def test_state(self):
+        result = GuoThompsonResult(2, dememorizationSteps=10,
+                                   samplingNum=4, samplingSize=100)
+        result.addChain([0.1, 0.2], [30, 20, 160], [1, 2, 3], [4, 5, 6])
+        result.stoppingRule = 'stderr'
+        result.elapsedTime = 50
+        result.timestamp = 'Thu Jan  1 00:00:00 1970'
+
+        restored = GuoThompsonResult(2)
+        restored.setState(json.loads(json.dumps(result.getState())))
+        self.assertEqual(restored.getState(), result.getState())
+        # the times are those of the restored, not the original, run
+        self.assertEqual(restored.elapsedTime, 0)
+        self.assertNotEqual(restored.timestamp, result.timestamp)
+
+class HardyWeinbergGuoThompsonTest(unittest.TestCase):
+
+    def test_adaptive_deviating_table(self):
+        # no heterozygotes at all: no permutation is as extreme
+        data = locus_data([('01', '01', 50), ('02', '02', 50)])
+        hw = HardyWeinbergGuoThompson(data, allele_count(data),
+                                      runPlainMCTest=1,
+                                      monteCarloSteps=20000, alpha=0.001,
+                                      testing=True)
+        hw.dumpTable('A', XMLOutputStream(StringIO()))
+        result = hw.monteCarloResult
+        self.assertEqual(result.extremeCount, 0)
+        self.assertEqual(result.stoppingRule, 'alpha')
+        # not after the first round of 1000: only once 3 standard
+        # errors of 1 / (n + 2) are below alpha
+        self.assertEqual(result.steps, 3000)
+
+def slow_enumeration(genotypes, k, doOverall):
+    # never finishes within the time limit
+    time.sleep(60)
+
+class HardyWeinbergEnumerationTest(unittest.TestCase):
+
+    def setUp(self):
+        # the enumeration extension is not needed for the fallback
+        self.savedModule = sys.modules.get('_HweEnum')
+        sys.modules['_HweEnum'] = types.ModuleType('_HweEnum')
+        self.savedEnumeration = PyPop.HardyWeinberg._runEnumeration
+        PyPop.HardyWeinberg._runEnumeration = slow_enumeration
+
+        self.data = locus_data([('01', '01', 30), ('01', '02', 40),
+                                ('02', '02', 20), ('01', '03', 6),
+                                ('02', '03', 3), ('03', '03', 1)])
+
+    def tearDown(self):
+        PyPop.HardyWeinberg._runEnumeration = self.savedEnumeration
+        if self.savedModule is None:
+            del sys.modules['_HweEnum']
+        else:
+            sys.modules['_HweEnum'] = self.savedModule
+
+    def serialize(self, hw):
+        output = StringIO()
+        hw.serializeTo(XMLOutputStream(output))
+        return output.getvalue()
+
+    def test_timeout_monte_carlo(self):
+        for numProcesses in [1, 3]:
+            hw = HardyWeinbergEnumeration(self.data, allele_count(self.data),
+                                          doOverall=1, timeLimit=0.2,
+                                          monteCarloSteps=1000,
+                                          numProcesses=numProcesses,
+                                          testing=True)
+            self.assertEqual(hw.role, 'monte-carlo')
+            # the permutations of all the processes are merged
+            self.assertEqual(hw.monteCarloResult.steps, 1000)
+            self.assertEqual(hw.observedPValue, None)
+
+            output = self.serialize(hw)
+            self.assertTrue(re.match(
+                '<hardyweinbergEnumeration [^>]*role="monte-carlo"', output))
+            self.assertTrue('<steps>1000</steps>' in output)
+            self.assertTrue('<pvalue type="overall">%f</pvalue>' % \
+                            hw.exactPValue in output)
+            self.assertTrue('<pvalue type="observed" role="not-calculated"/>' \
+                            in output)
+            self.assertEqual(output.count('method="monte-carlo"'), 2 * 6)
+
+    def test_timeout_adaptive(self):
+        # the stopping rules apply to the permutations of all the
+        # processes, after each round
+        data = locus_data([('01', '01', 50), ('02', '02', 50)])
+        for numProcesses in [1, 3]:
+            hw = HardyWeinbergEnumeration(data, allele_count(data),
+                                          doOverall=1, timeLimit=0.2,
+                                          monteCarloSteps=20000, alpha=0.001,
+                                          numProcesses=numProcesses,
+                                          testing=True)
+            self.assertEqual(hw.role, 'monte-carlo')
+            self.assertEqual(hw.monteCarloResult.stoppingRule, 'alpha')
+            self.assertEqual(hw.monteCarloResult.steps, 3000)
+            output = self.serialize(hw)
+            self.assertTrue('<steps>3000</steps>\n'
+                            '<stoppingRule>alpha</stoppingRule>' in output)
+
+    def test_enumeration(self):
+        results = (0.5, 0.25, [0.1] * 6, [0.2] * 6)
+        PyPop.HardyWeinberg._runEnumeration = \
+            lambda genotypes, k, doOverall: results
+        for timeLimit in [0, 10]:
+            hw = HardyWeinbergEnumeration(self.data, allele_count(self.data),
+                                          doOverall=1, timeLimit=timeLimit,
+                                          testing=True)
+            self.assertEqual(hw.role, 'enumeration')
+            output = self.serialize(hw)
+            self.assertTrue(re.match(
+                '<hardyweinbergEnumeration [^>]*role="enumeration"', output))
+            self.assertFalse('<steps>' in output)
+            self.assertTrue('<pvalue type="observed">0.250000</pvalue>' \
+                            in output)
+            self.assertEqual(output.count('method="full"'), 2 * 6)
+
+class ResultCacheTest(unittest.TestCase):
+
+    def test_lru_persistence(self):
+        fd, fileName = tempfile.mkstemp(suffix='.cache')
+        os.close(fd)
+        os.remove(fileName)
+        try:
+            cache = ResultCache(fileName, maxEntries=2, version='x')
+            keys = [cache.makeKey('mcmc', [i, 1, 2], (1000, 0)) for i in range(3)]
+            self.assertNotEqual(cache.makeKey('mcmc', [0, 1, 2], (1000, 1)), keys[0])
+
+            cache.put(keys[0], 'a')
+            cache.put(keys[1], 'b')
+            self.assertEqual(cache.get(keys[0]), 'a')
+            # keys[1] is now the least recently used
+            cache.put(keys[2], 'c')
+            self.assertEqual(cache.get(keys[1]), None)
+            cache.save()
+
+            cache = ResultCache(fileName, maxEntries=2, version='x')
+            self.assertEqual(cache.get(keys[0]), 'a')
+            self.assertEqual(cache.get(keys[2]), 'c')
+            # a new version does not reuse old results
+            newCache = ResultCache(fileName, maxEntries=2, version='y')
+            self.assertEqual(newCache.get(newCache.makeKey('mcmc', [0, 1, 2], (1000, 0))), None)
+        finally:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def test_concurrent_saves(self):
+        tmpDir = tempfile.mkdtemp()
+        fileName = os.path.join(tmpDir, 'results.cache')
+        try:
+            # two runs open the same (missing) file
+            first = ResultCache(fileName, maxEntries=3, version='x')
+            second = ResultCache(fileName, maxEntries=3, version='x')
+            keys = [first.makeKey('mcmc', [i, 1, 2]) for i in range(4)]
+            first.put(keys[0], 'a')
+            first.put(keys[1], ['b', 1.5, None])
+            second.put(keys[2], {'c': [1, 2]})
+            first.save()
+            second.save()
+
+            # the last writer keeps the entries of the first
+            cache = ResultCache(fileName, maxEntries=3, version='x')
+            self.assertEqual(cache.get(keys[0]), 'a')
+            self.assertEqual(cache.get(keys[1]), ['b', 1.5, None])
+            self.assertEqual(cache.get(keys[2]), {'c': [1, 2]})
+
+            # plain JSON, and no temporary file left over
+            self.assertEqual(os.listdir(tmpDir), ['results.cache'])
+            state = json.load(open(fileName))
+            self.assertEqual([key for key, value in state['entries']], keys[:3])
+
+            # beyond the size, the entries saved by other runs are
+            # evicted before those of this run
+            first.put(keys[3], 'd')
+            first.save()
+            cache = ResultCache(fileName, maxEntries=3, version='x')
+            self.assertEqual(cache.entries.keys(), [keys[0], keys[1], keys[3]])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_unreadable(self):
+        fd, fileName = tempfile.mkstemp(suffix='.cache')
+        os.write(fd, 'not a cache')
+        os.close(fd)
+        try:
+            cache = ResultCache(fileName, version='x')
+            self.assertEqual(len(cache.entries), 0)
+            cache.put(cache.makeKey('mcmc', [1, 2, 3]), 'a')
+            cache.save()
+            self.assertEqual(len(ResultCache(fileName, version='x').entries), 1)
+        finally:
+            os.remove(fileName)
+
+    def test_cached_run(self):
+        fd, fileName = tempfile.mkstemp(suffix='.cache')
+        os.close(fd)
+        os.remove(fileName)
+        data = locus_data([('01', '01', 30), ('01', '02', 40), ('02', '02', 20),
+                           ('01', '03', 6), ('02', '03', 3), ('03', '03', 1)])
+        try:
+            outputs = []
+            for i in range(2):
+                cache = ResultCache(fileName, version='x')
+                hw = HardyWeinbergGuoThompson(data, allele_count(data),
+                                              runMCMCTest=1, runPlainMCTest=1,
+                                              dememorizationSteps=100,
+                                              samplingNum=10, samplingSize=100,
+                                              monteCarloSteps=1000,
+                                              resultCache=cache, testing=True)
+                output = StringIO()
+                hw.dumpTable('A', XMLOutputStream(output))
+                cache.save()
+                outputs.append(output.getvalue())
+            self.assertEqual(cache.hits, 2)
+            self.assertEqual(hw.mcmcResult.elapsedTime, 0)
+            # the same results, apart from the times of the MCMC run
+            times = re.compile('<elapsed-time>.*</timestamp>', re.S)
+            self.assertEqual(times.sub('', outputs[1]), times.sub('', outputs[0]))
+        finally:
+            if os.path.exists(fileName):
+                os.remove(fileName)
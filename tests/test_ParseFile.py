@@ -0,0 +1,68 @@
+import base
+import pytest
+from ConfigParser import ConfigParser
+from PyPop.ParseFile import ParseGenotypeFile
+
+# 10 individuals, the last line has no trailing newline
+POPFILE = './tests/data/USAFEL-UchiTelle-small.pop'
+
+def parse_USAFEL(**kw):
+    config = ConfigParser()
+    config.read('./tests/data/minimal.ini')
+    return ParseGenotypeFile(POPFILE,
+                             validPopFields=config.get('ParseGenotypeFile',
+                                                       'validPopFields'),
+                             validSampleFields=config.get('ParseGenotypeFile',
+                                                          'validSampleFields'),
+                             **kw)
+
+def assert_same_matrix(matrix, other):
+    assert matrix.colList == other.colList
+    assert matrix.extraList == other.extraList
+    assert matrix.headerLines == other.headerLines
+    assert matrix.array.tolist() == other.array.tolist()
+
+def assert_same_parse(parsed, other):
+    assert parsed.totalIndivCount == other.totalIndivCount
+    assert parsed.getPopData().items() == other.getPopData().items()
+    assert parsed.popName == other.popName
+    assert parsed.getLocusList() == other.getLocusList()
+    assert_same_matrix(parsed.getMatrix(), other.getMatrix())
+
+# chunk sizes that do and don't divide the 10 individuals, or exceed them
+@pytest.mark.parametrize("readChunkSize", [1, 3, 4, 5, 10, 11])
+def test_ParseGenotypeFile_readChunkSize(readChunkSize):
+    whole = parse_USAFEL()
+    assert whole.totalIndivCount == 10
+    assert_same_parse(whole, parse_USAFEL(readChunkSize=readChunkSize))
+
+def test_ParseGenotypeFile_codedMatrix_readChunkSize():
+    whole = parse_USAFEL(codedMatrix=1)
+    chunked = parse_USAFEL(codedMatrix=1, readChunkSize=4)
+    assert_same_parse(whole, chunked)
+    # same allele dictionaries, so the same codes
+    for locus in whole.getLocusList():
+        assert whole.getMatrix().getLabels(locus) == \
+               chunked.getMatrix().getLabels(locus)
+        assert whole.getMatrix().getCodes(locus).tolist() == \
+               chunked.getMatrix().getCodes(locus).tolist()
+    # and the same alleles as the uncoded matrix
+    assert_same_parse(parse_USAFEL(), chunked)
+
+@pytest.mark.parametrize("codedMatrix", [0, 1])
+def test_ParseGenotypeFile_getLocusMatrix(codedMatrix):
+    whole = parse_USAFEL(codedMatrix=codedMatrix)
+    chunked = parse_USAFEL(codedMatrix=codedMatrix, readChunkSize=3,
+                           residentLoci=['B'])
+    assert chunked.getMatrix().colList == ['B']
+    assert chunked.getLocusList() == whole.getLocusList()
+    assert chunked.getPopData().items() == whole.getPopData().items()
+
+    for loci in [['A'], ['A', 'C'], whole.getLocusList()]:
+        matrix = chunked.getLocusMatrix(loci)
+        assert_same_matrix(whole.getLocusMatrix(loci), matrix)
+        for locus in loci:
+            assert matrix[locus] == whole.getMatrix()[locus]
+
+    with pytest.raises(KeyError):
+        chunked.getLocusMatrix(['DRB1'])
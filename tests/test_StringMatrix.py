@@ -3,11 +3,23 @@ import subprocess
 import hashlib
 import unittest
 import pytest
-from PyPop.Utils import StringMatrix, appendTo2dList
+from PyPop.Utils import StringMatrix, CodedStringMatrix, MatrixHistory, appendTo2dList
 
 def new_matrix():
     return StringMatrix(3, ['A', 'B', 'C'])
 
+def fill_matrix(matrix):
+    matrix[0, 'B'] = ('B0', 'B0')
+    matrix[1, 'B'] = ('B1', 'B1')
+    matrix[2, 'B'] = ('B3', 'B1')
+    matrix[0, 'A'] = ('A0', 'A0')
+    matrix[1, 'A'] = ('A1', 'A2')
+    matrix[0, 'C'] = ('C10', 'C9')
+    matrix[1, 'C'] = ('****', 'C2')
+    matrix[0, 'foo'] = "bar"
+    matrix[1, 'foo'] = "baz"
+    return matrix
+
 class StringMatrixTest(unittest.TestCase):
     def test_new(self):
         # check everything is zero upon first assignment
@@ -25,6 +37,16 @@ class StringMatrixTest(unittest.TestCase):
         assert A_matrix['B'] == [['B0', 'B0'], ['B1', 'B1'], [0, 0]]
         assert A_matrix['C'] == [[0, 0], [0, 0], [0, 0]]
 
+    def test_get_cell(self):
+        # a single cell returns the first allele at that locus
+        A_matrix = StringMatrix(3, ['A', 'B', 'C'], ['foo'])
+        A_matrix[1, 'B'] = ('B1', 'B2')
+        A_matrix[1, 'C'] = ('C1', 'C2')
+        A_matrix[1, 'foo'] = 'bar'
+        assert A_matrix[1, 'B'] == 'B1'
+        assert A_matrix[1, 'C'] == 'C1'
+        assert A_matrix['foo:B'] == [[0, 0, 0], ['bar', 'B1', 'B2'], [0, 0, 0]]
+
     def test_copy(self):
         # check copies are independent
         A_matrix = new_matrix()
@@ -169,6 +191,12 @@ class StringMatrixTest(unittest.TestCase):
 
         assert flattened_list == [3, 2, 1, 4, 5, 6, 4, 7, 4, 6, 7, 1, 2, 1, 4, 6, 3, 7, 3, 5]
 
+        # factorizing in one step gives the same vector and labels
+        geno_vec, allele_labels = geno.factorize()
+        assert geno_vec == flattened_list
+        assert allele_labels == [['1', '2', '4', '7', '8', '11', '13'],
+                                 ['7', '27', '44', '51', '55', '61', '62']]
+
     def test_CountPairs_Small(self):
 
         geno = StringMatrix(5, ["DRB", "B"])
@@ -333,3 +361,155 @@ class StringMatrixTest(unittest.TestCase):
 
         assert pairs == [4, 4, 4, 4, 4, 4, 1, 4, 2, 4, 1, 1, 1, 1, 4, 4, 1, 4, 1, 1, 1, 2, 4, 2, 2, 1, 4, 1, 1, 4, 1, 4, 4, 2, 4, 1, 4, 4, 4, 2, 2, 4, 1, 1, 4]
         assert max_haps == 236
+
+class CodedStringMatrixTest(unittest.TestCase):
+    def setUp(self):
+        self.plain = fill_matrix(StringMatrix(3, ['A', 'B', 'C'], ['foo']))
+        self.coded = fill_matrix(CodedStringMatrix(3, ['A', 'B', 'C'], ['foo']))
+
+    def test_getitem(self):
+        # coded backend returns exactly the same lists
+        for key in ['A', 'B', 'C', 'foo', 'A:B', 'foo:A:B:C']:
+            assert self.coded[key] == self.plain[key]
+        assert self.coded.shape == self.plain.shape
+        assert len(self.coded) == 3
+
+    def test_codes(self):
+        # one allele dictionary per locus, code 0 is the empty cell
+        assert self.coded.getLabels('B') == [0, 'B0', 'B1', 'B3']
+        assert self.coded.getCodes('B').tolist() == [[1, 1], [2, 2], [3, 2]]
+        assert self.coded.getCodes('A').tolist() == [[1, 1], [2, 3], [0, 0]]
+
+    def test_codes_read_only(self):
+        # the codes can't be used to modify the matrix, which would
+        # leave stale typed masks behind
+        assert self.coded.getTypedRows('B', 'B1').tolist() == [0]
+        codes = self.coded.getCodes('B')
+        self.assertRaises(ValueError, codes.__setitem__, (0, 0), 2)
+        assert self.coded['B'] == self.plain['B']
+
+        # the internal accessor does, and discards the masks
+        self.coded._getWritableCodes('B')[0] = (2, 2)
+        assert self.coded['B'] == [['B1', 'B1'], ['B1', 'B1'], ['B3', 'B1']]
+        assert self.coded.getTypedRows('B', 'B1').tolist() == []
+        # the earlier view shares the storage
+        assert codes[0].tolist() == [2, 2]
+
+    def test_copy_and_submatrix(self):
+        B_matrix = self.coded.copy()
+        B_matrix[2, 'A'] = ('A9', 'A9')
+        assert self.coded['A'] == [['A0', 'A0'], ['A1', 'A2'], [0, 0]]
+        assert B_matrix['A'] == [['A0', 'A0'], ['A1', 'A2'], ['A9', 'A9']]
+        assert 'A9' not in self.coded.getLabels('A')
+
+        C_matrix = self.coded.getNewStringMatrix("C:foo")
+        assert C_matrix.colList == ['C']
+        assert C_matrix.shape == (3, 3)
+        assert C_matrix['C'] == self.plain['C']
+        assert C_matrix['foo'] == self.plain['foo']
+
+    def test_haplostats_helpers(self):
+        for key in ['A', 'B', 'C']:
+            assert self.coded.getUniqueAlleles(key) == \
+                   self.plain.getUniqueAlleles(key)
+        plainInts = self.plain.getNewStringMatrix('A:B:C').convertToInts()
+        codedInts = self.coded.getNewStringMatrix('A:B:C').convertToInts()
+        assert codedInts['A:B:C'] == plainInts['A:B:C']
+        assert codedInts.flattenCols() == plainInts.flattenCols()
+        assert codedInts.countPairs() == plainInts.countPairs()
+        assert self.coded.getNewStringMatrix('A:B:C').factorize() == \
+               self.plain.getNewStringMatrix('A:B:C').factorize()
+
+    def test_filterout(self):
+        for key in ['A:B:C', 'C', 'foo:C']:
+            assert self.coded.filterOut(key, '****') == \
+                   self.plain.filterOut(key, '****')
+        assert self.coded.filterOut('A:B', 'B1') == \
+               self.plain.filterOut('A:B', 'B1')
+
+    def test_typed_codes(self):
+        # decoding the codes gives back the filtered rows as strings
+        for matrix in [self.plain, self.coded]:
+            for key, blank in [('A:B', '****'), ('C', '****'), ('A:B', 'B1')]:
+                codes, labels = matrix.getTypedCodes(key, blank)
+                assert codes.flags.c_contiguous
+                assert codes.dtype.itemsize == 4
+                decoded = [[labels[i / 2][row[i]] for i in range(len(row))]
+                           for row in codes.tolist()]
+                assert decoded == [[str(allele) for allele in row] for row in
+                                   self.plain.filterOut(key, blank)]
+        # only the alleles present in the typed rows are named
+        codes, labels = self.coded.getTypedCodes('A:B', 'B1')
+        assert labels == [['A0'], ['B0']]
+
+    def test_typed_rows(self):
+        for matrix in [self.plain, self.coded]:
+            assert matrix.getTypedRows('A:B:C', '****').tolist() == \
+                   [i for i in range(len(matrix['A']))
+                    if '****' not in matrix['A:B:C'][i]]
+            assert matrix.getTypedRows('B', 'B1').tolist() == [0]
+            # cached masks are invalidated by any assignment
+            matrix[1, 'B'] = ('B0', 'B2')
+            assert matrix.getTypedRows('B', 'B1').tolist() == [0, 1]
+            matrix.setColumn('foo', ['****'] * 3)
+            assert len(matrix.getTypedRows('foo:A', '****')) == 0
+
+    def test_setcolumn(self):
+        # bulk assignment is identical to assigning one cell at a time
+        for matrixClass in [StringMatrix, CodedStringMatrix]:
+            A_matrix = matrixClass(3, ['A', 'B', 'C'], ['foo'])
+            A_matrix.setColumn('B', ['B0', 'B1', 'B3'], ['B0', 'B1', 'B1'])
+            A_matrix.setColumn('A', ['A0', 'A1', 0], ['A0', 'A2', 0])
+            A_matrix.setColumn('C', ['C10', '****', 0], ['C9', 'C2', 0])
+            A_matrix.setColumn('foo', ['bar', 'baz', 0])
+            for key in ['A', 'B', 'C', 'foo:A:B:C']:
+                assert A_matrix[key] == self.plain[key]
+        assert A_matrix.getLabels('B') == self.coded.getLabels('B')
+
+    def test_column_view(self):
+        for matrix in [self.plain, self.coded]:
+            view = matrix.getColumnView('A')
+            assert view.shape == (3, 2)
+            assert view.tolist() == matrix['A']
+            assert matrix.getColumnView('foo').tolist() == ['bar', 'baz', 0]
+            # views can't be used to modify the matrix
+            self.assertRaises(ValueError, view.__setitem__, (0, 0), 'A9')
+
+        # plain backend returns a true view that tracks later changes
+        view = self.plain.getColumnView('A')
+        self.plain[2, 'A'] = ('A5', 'A6')
+        assert view[2].tolist() == ['A5', 'A6']
+
+class MatrixHistoryTest(unittest.TestCase):
+    def test_history(self):
+        for matrixClass in [StringMatrix, CodedStringMatrix]:
+            history = MatrixHistory()
+            history.append(fill_matrix(matrixClass(3, ['A', 'B', 'C'], ['foo'])))
+            original = history[0]['foo:A:B:C']
+
+            B_matrix = history[-1].copy()
+            B_matrix[2, 'A'] = ('A9', 'A9')
+            history.append(B_matrix)
+            C_matrix = history[-1].copy()
+            C_matrix.setColumn('foo', ['x', 'y', 'z'])
+            history.append(C_matrix)
+
+            # only the changed columns are kept for earlier stages
+            assert history._reverse[0].keys() == ['A']
+            assert history._reverse[1].keys() == ['foo']
+
+            assert len(history) == 3
+            assert history[-1] is C_matrix
+            assert history[0]['foo:A:B:C'] == original
+            assert history[-3]['foo:A:B:C'] == original
+            assert history[1]['A'] == [['A0', 'A0'], ['A1', 'A2'], ['A9', 'A9']]
+            assert history[1]['foo'] == history[0]['foo']
+            # rebuilding a stage leaves the later ones unchanged
+            assert C_matrix['foo'] == [['x'], ['y'], ['z']]
+            self.assertRaises(IndexError, history.__getitem__, 3)
+
+            # a stage with a new layout is kept in full
+            D_matrix = matrixClass(3, ['D'])
+            history.append(D_matrix)
+            assert history[-2]['foo'] == [['x'], ['y'], ['z']]
+            assert history[0]['foo:A:B:C'] == original
@@ -4,6 +4,8 @@ import hashlib
 import pytest
 import os.path
 import filecmp
+import tempfile
+import shutil
 
 def test_USAFEL():
     exit_code = base.run_pypop_process('./tests/data/minimal.ini', './tests/data/USAFEL-UchiTelle-small.pop')
@@ -13,3 +15,33 @@ def test_USAFEL():
     out_filename = "USAFEL-UchiTelle-small-out.txt"
     gold_out_filename = os.path.join('./tests/data/output', out_filename)
     assert filecmp.cmp(out_filename, gold_out_filename)
+
+def test_USAFEL_locusChunkSize():
+    # analyse the loci two at a time, reading three individuals at a
+    # time, the output must be the same as for the whole file
+    tmpDir = tempfile.mkdtemp()
+    try:
+        iniFilename = os.path.join(tmpDir, 'chunked.ini')
+        ini = open('./tests/data/minimal.ini').read()
+        ini = ini.replace('[ParseGenotypeFile]\n',
+                          '[ParseGenotypeFile]\nlocusChunkSize=2\nreadChunkSize=3\n')
+        open(iniFilename, 'w').write(ini)
+
+        outDirs = {}
+        for name, inifile in [('whole', './tests/data/minimal.ini'),
+                              ('chunked', iniFilename)]:
+            outDirs[name] = os.path.join(tmpDir, name)
+            os.mkdir(outDirs[name])
+            exit_code = base.run_pypop_process(inifile, './tests/data/USAFEL-UchiTelle-small.pop', ['-o', outDirs[name]])
+            assert exit_code == 0
+
+        for out_filename in ["USAFEL-UchiTelle-small-out.xml",
+                             "USAFEL-UchiTelle-small-out.txt"]:
+            assert filecmp.cmp(os.path.join(outDirs['whole'], out_filename),
+                               os.path.join(outDirs['chunked'], out_filename),
+                               shallow=False)
+
+        gold_out_filename = os.path.join('./tests/data/output', "USAFEL-UchiTelle-small-out.txt")
+        assert filecmp.cmp(os.path.join(outDirs['chunked'], "USAFEL-UchiTelle-small-out.txt"), gold_out_filename, shallow=False)
+    finally:
+        shutil.rmtree(tmpDir)
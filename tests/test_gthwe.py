@@ -16,3 +16,34 @@ def test_gthwe():
     f.close()
 
     # FIXME, incomplete: need to add an assert function
+
+def test_gthwe_chain():
+    a = [0, 3, 1 ,5, 18, 1, 3, 7, 5, 2]
+    n = [0]*4
+    status, chunk_pvalues, switches, chen_counts, diff_counts = \
+            _Gthwe.run_data_chain(a, n, 4, 45, 200, 10, 100, 1234,
+                                  10, 3, 10, 10)
+    assert status == 0
+    assert len(chunk_pvalues) == 10
+    assert min(chunk_pvalues) >= 0.0 and max(chunk_pvalues) <= 1.0
+    # every dememorization and sampling step is counted as a switch type
+    assert sum(switches) == 200 + 10*100
+    assert len(chen_counts) == len(diff_counts) == 10
+
+    # same seed gives the same chain
+    assert _Gthwe.run_data_chain(a, n, 4, 45, 200, 10, 100, 1234,
+                                 10, 3, 10, 10)[1] == chunk_pvalues
+
+def test_gthwe_randomization_counts():
+    a = [0, 3, 1 ,5, 18, 1, 3, 7, 5, 2]
+    n = [0]*4
+    status, extreme_count, chen_counts, diff_counts = \
+            _Gthwe.run_randomization_counts(a, n, 4, 45, 1000, 0, 10, 10)
+    assert status == 0
+    assert 0 <= extreme_count <= 1000
+    assert len(chen_counts) == len(diff_counts) == 10
+    assert max(chen_counts) <= 1000
+
+    # a fixed seed gives the same permutations
+    assert _Gthwe.run_randomization_counts(a, n, 4, 45, 1000, 99, 10, 10) == \
+           _Gthwe.run_randomization_counts(a, n, 4, 45, 1000, 99, 10, 10)
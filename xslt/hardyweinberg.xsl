@@ -59,6 +59,7 @@ MODIFICATIONS.
   <text col="steps">Steps in Monte-Carlo randomization</text>
   <text col="pvalue">p-value</text>
   <text col="stderr">Std. error</text>
+  <text col="stoppingRule">Stopped by</text>
  </data:hardyweinberg-guo-thompson>
 
  <data:hardyweinberg-guo-thompson-arlequin>
@@ -771,14 +772,29 @@ MODIFICATIONS.
       </xsl:choose>
 
       <!-- if we are doing MCMC calculate *total steps* to allow comparison with MC-only -->
+      <!-- (an adaptive run reports the steps actually taken) -->
       <xsl:if test="dememorizationSteps">
        <xsl:text>Total steps in MCMC: </xsl:text>
-       <xsl:value-of select="samplingNum * samplingSize"/>
+       <xsl:choose>
+	<xsl:when test="steps">
+	 <xsl:value-of select="steps"/>
+	</xsl:when>
+	<xsl:otherwise>
+	 <xsl:value-of select="samplingNum * samplingSize"/>
+	</xsl:otherwise>
+       </xsl:choose>
+       <xsl:call-template name="newline"/>
+      </xsl:if>
+
+      <xsl:if test="stoppingRule">
+       <xsl:value-of select="$hw-guo-thompson[@col='stoppingRule']"/>
+       <xsl:text>: </xsl:text>
+       <xsl:value-of select="stoppingRule"/>
        <xsl:call-template name="newline"/>
       </xsl:if>
       
       <xsl:for-each
-       select="stderr|dememorizationSteps|samplingNum|samplingSize|steps">
+       select="stderr|dememorizationSteps|samplingNum|samplingSize|steps[not(../dememorizationSteps)]">
        <xsl:variable name="node-name" select="name(.)"/>
        <xsl:value-of 
 	select="$hw-guo-thompson[@col=$node-name]"/>  
@@ -906,6 +922,18 @@ MODIFICATIONS.
    </xsl:with-param>
    <xsl:with-param name="level" select="3"/>
    <xsl:with-param name="text">
+    <xsl:if test="@role='monte-carlo'">
+     <xsl:text>Enumeration ran out of time, p-values estimated by Monte Carlo (</xsl:text>
+     <xsl:value-of select="steps"/>
+     <xsl:text> steps)</xsl:text>
+     <xsl:call-template name="newline"/>
+     <xsl:if test="stoppingRule">
+      <xsl:value-of select="$hw-guo-thompson[@col='stoppingRule']"/>
+      <xsl:text>: </xsl:text>
+      <xsl:value-of select="stoppingRule"/>
+      <xsl:call-template name="newline"/>
+     </xsl:if>
+    </xsl:if>
     <!-- do pvalue separately -->
     <xsl:text>p-value (overall): </xsl:text>
     <xsl:apply-templates select="pvalue[@type='overall']"/>